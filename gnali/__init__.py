@@ -0,0 +1,29 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+# The Python API (see gnali.api) is imported on first use, so that
+# importing one of gNALI's modules doesn't load all of them
+API_NAMES = ['query', 'QueryService', 'QueryResults']
+
+
+def __getattr__(name):
+    if name in API_NAMES:
+        from gnali import api
+        return getattr(api, name)
+    raise AttributeError("module {} has no attribute {}"
+                         .format(__name__, name))
@@ -0,0 +1,174 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import sqlite3
+from pathlib import Path
+
+GNALI_PATH = Path(__file__).parent.absolute()
+DATA_PATH = "{}/data".format(str(GNALI_PATH))
+ANNOTATION_CACHE_PATH = "{}/annotation-cache".format(DATA_PATH)
+# Bump when the layout of the cache changes, older caches are ignored
+ANNOTATION_CACHE_FORMAT = 1
+# Time (in seconds) to wait for another gNALI process writing to the cache
+ANNOTATION_CACHE_TIMEOUT = 600
+# Largest gap (in bases) between variants looked up in a single range scan
+CLUSTER_MAX_GAP = 100000
+
+
+class AnnotationCache:
+    """Persistent cache of VEP/LOFTEE annotations, stored as an
+        SQLite database. Annotations are keyed by assembly, VEP
+        version, LOFTEE version and variant (chromosome, position,
+        reference and alternate alleles), so that upgrading VEP or
+        LOFTEE never returns stale annotations.
+    """
+    def __init__(self, assembly, vep_version, loftee_version,
+                 cache_dir=None):
+        """Args:
+            assembly: name of reference genome (ex. GRCh37)
+            vep_version: version of VEP annotations are made with
+            loftee_version: version of LOFTEE annotations are made with
+            cache_dir: directory holding the annotation cache
+        """
+        if cache_dir is None:
+            cache_dir = ANNOTATION_CACHE_PATH
+        self.assembly = assembly
+        self.vep_version = str(vep_version)
+        self.loftee_version = str(loftee_version)
+        self.path = "{}/annotations_v{}.sqlite".format(
+            cache_dir, ANNOTATION_CACHE_FORMAT)
+        self._version = (self.assembly, self.vep_version,
+                         self.loftee_version)
+
+    def _connect(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=ANNOTATION_CACHE_TIMEOUT)
+        conn.execute("CREATE TABLE IF NOT EXISTS annotations "
+                     "(assembly TEXT NOT NULL, vep TEXT NOT NULL, "
+                     "loftee TEXT NOT NULL, chrom TEXT NOT NULL, "
+                     "pos INTEGER NOT NULL, ref TEXT NOT NULL, "
+                     "alt TEXT NOT NULL, annotation TEXT, "
+                     "PRIMARY KEY (assembly, vep, loftee, chrom, pos, "
+                     "ref, alt)) WITHOUT ROWID")
+        conn.execute("CREATE TABLE IF NOT EXISTS headers "
+                     "(assembly TEXT NOT NULL, vep TEXT NOT NULL, "
+                     "loftee TEXT NOT NULL, position INTEGER NOT NULL, "
+                     "line TEXT NOT NULL, "
+                     "PRIMARY KEY (assembly, vep, loftee, position))")
+        return conn
+
+    def lookup(self, keys):
+        """Get cached annotations for a list of variants.
+            Variants VEP didn't annotate are cached with an
+            annotation of None.
+
+        Args:
+            keys: list of (chrom, pos, ref, alt) tuples
+
+        Returns:
+            dictionary of annotations by key, for the keys found
+        """
+        found = {}
+        if len(keys) == 0:
+            return found
+        wanted = set(keys)
+        conn = self._connect()
+        try:
+            # Variants come from gene regions, so they are looked up
+            # with one primary key range scan per cluster of positions
+            for chrom, start, end in cluster_positions(wanted):
+                rows = conn.execute("SELECT pos, ref, alt, annotation "
+                                    "FROM annotations WHERE assembly = ? "
+                                    "AND vep = ? AND loftee = ? "
+                                    "AND chrom = ? AND pos BETWEEN ? AND ?",
+                                    self._version + (chrom, start, end))
+                found.update(((chrom, str(pos), ref, alt), annotation)
+                             for pos, ref, alt, annotation
+                             in rows.fetchall())
+        finally:
+            conn.close()
+        # drop cached variants that are only near a wanted one
+        return {key: annotation for key, annotation in found.items()
+                if key in wanted}
+
+    def get_header(self):
+        """Get the header lines VEP/LOFTEE add to annotated VCF
+            files, or None if no annotations were cached yet.
+        """
+        conn = self._connect()
+        try:
+            lines = [line for line, in
+                     conn.execute("SELECT line FROM headers "
+                                  "WHERE assembly = ? AND vep = ? "
+                                  "AND loftee = ? ORDER BY position",
+                                  self._version)]
+        finally:
+            conn.close()
+        return lines if len(lines) > 0 else None
+
+    def store(self, annotations, header):
+        """Add annotations to the cache.
+
+        Args:
+            annotations: dictionary of annotations (or None) by
+                         (chrom, pos, ref, alt) key
+            header: header lines VEP/LOFTEE add to annotated VCF files
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO annotations "
+                                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [self._version +
+                                  (chrom, int(pos), ref, alt, annotation)
+                                  for (chrom, pos, ref, alt), annotation
+                                  in annotations.items()])
+                conn.execute("DELETE FROM headers WHERE assembly = ? "
+                             "AND vep = ? AND loftee = ?", self._version)
+                conn.executemany("INSERT INTO headers VALUES "
+                                 "(?, ?, ?, ?, ?)",
+                                 [self._version + (position, line)
+                                  for position, line
+                                  in enumerate(header)])
+        finally:
+            conn.close()
+
+
+def cluster_positions(keys, max_gap=CLUSTER_MAX_GAP):
+    """Group variant positions into (chrom, start, end) spans,
+        splitting wherever consecutive positions are further
+        than max_gap apart.
+
+    Args:
+        keys: iterable of (chrom, pos, ref, alt) tuples
+        max_gap: largest gap (in bases) kept within a span
+    """
+    by_chrom = {}
+    for chrom, pos, _, _ in keys:
+        by_chrom.setdefault(chrom, []).append(pos)
+    spans = []
+    for chrom, positions in by_chrom.items():
+        positions = sorted(map(int, positions))
+        start = end = positions[0]
+        for pos in positions:
+            if pos - end > max_gap:
+                spans.append((chrom, start, end))
+                start = pos
+            end = pos
+        spans.append((chrom, start, end))
+    return spans
@@ -0,0 +1,235 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from gnali import gnali
+from gnali.dbconfig import RuntimeConfig
+from gnali.exceptions import InvalidConfigurationError, \
+                             NoVariantsAvailableError
+from gnali.filter import parse_info_types
+from gnali.variants import Gene
+
+
+class QueryResults:
+    """Results of a query: the contents of gNALI's basic, detailed
+        and VCF outputs.
+    """
+    def __init__(self, basic, detailed, vcf_header, vcf_records):
+        """Args:
+            basic: DataFrame with the status of every gene
+            detailed: DataFrame of the variants passing filtering
+                      (without rows, but with the same columns, if
+                      there are none)
+            vcf_header: VCF header lines of the variants
+            vcf_records: iterator over the VCF records of the
+                         variants, as strings
+        """
+        self.basic = basic
+        self.detailed = detailed
+        self.vcf_header = vcf_header
+        self.vcf_records = vcf_records
+
+
+class ServedDatabase:
+    """A database kept open by a QueryService: its configuration,
+        gene index and opened files.
+    """
+    def __init__(self, db_config, gene_index, opened_files):
+        self.db_config = db_config
+        self.gene_index = gene_index
+        self.opened_files = opened_files
+
+
+class QueryService:
+    """Runs gNALI queries in a long-lived process. Databases are
+        opened on their first query (configuration, gene index,
+        indexes and Tabix handles) and kept open for later queries.
+        Regions are fetched on a shared pool of worker threads, so
+        every thread keeps its Tabix handles between queries.
+    """
+    def __init__(self, config_file=None, workers=1):
+        """Args:
+            config_file: database configuration file, gNALI's own
+                         configuration file by default
+            workers: number of worker threads used to fetch regions
+        """
+        self.config_file = config_file or gnali.DB_CONFIG_FILE
+        config = gnali.get_db_config(self.config_file, '')
+        self.default = config.default
+        self.database_names = [db.name for db in config.configs]
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # only created for the compressed copies of uncompressed
+        # HTTP databases
+        self.temp_dir = None
+        self.databases = {}
+        self.lock = threading.Lock()
+        # databases are opened under their own lock, so opening one
+        # doesn't hold up queries to the others
+        self.database_locks = {name: threading.Lock()
+                               for name in self.database_names}
+
+    def get_database(self, name=None):
+        """Get an open database, opening it if this is its first query.
+
+        Args:
+            name: name of the database, the configuration file's
+                  default database if None
+        """
+        if name is None:
+            name = self.default
+        if name not in self.database_names:
+            raise InvalidConfigurationError("Unknown database {}"
+                                            .format(name))
+        database = self.databases.get(name)
+        if database is not None:
+            return database
+        with self.database_locks[name]:
+            database = self.databases.get(name)
+            if database is None:
+                database = self.open_database(name)
+                with self.lock:
+                    self.databases[name] = database
+        return database
+
+    def open_database(self, name):
+        """Open a database: load its configuration and gene index,
+            and open its files.
+
+        Args:
+            name: name of the database
+        """
+        db_config = RuntimeConfig(gnali.get_db_config(self.config_file,
+                                                      name))
+        if not db_config.has_lof_annots:
+            gnali.verify_files_present(db_config.ref_genome_name,
+                                       db_config.cache_path)
+        gene_index = gnali.load_gene_index(db_config)
+        temp_dir = None
+        if any(data_file.is_http and not data_file.is_compressed
+               for data_file in db_config.files):
+            with self.lock:
+                if self.temp_dir is None:
+                    self.temp_dir = tempfile.TemporaryDirectory()
+                temp_dir = self.temp_dir.name
+        opened_files = gnali.open_db_files(db_config, temp_dir,
+                                           self.workers)
+        return ServedDatabase(db_config, gene_index, opened_files)
+
+    def query(self, genes, database=None, predefined_filters=None,
+              additional_filters=None, pop_freqs=False, typed=False):
+        """Find the loss-of-function variants of a list of genes.
+
+        Args:
+            genes: list of HGNC symbols (or a single one)
+            database: name of the database to query, the default
+                      database if None
+            predefined_filters: list of predefined filters
+            additional_filters: list of additional filters
+            pop_freqs: whether or not to add population frequencies
+                       to the detailed results
+            typed: whether or not the detailed results have typed
+                   columns (as with --output_format parquet), instead
+                   of text as in the tab-separated output
+        """
+        if isinstance(genes, str):
+            genes = [genes]
+        served = self.get_database(database)
+        db_config = served.db_config
+        if pop_freqs and db_config.population_frequencies is None:
+            raise InvalidConfigurationError("Population frequencies are "
+                                            "not available for database "
+                                            "selected: {}"
+                                            .format(db_config.name))
+        gnali.validate_filters(db_config, predefined_filters,
+                               additional_filters)
+        filters = gnali.transform_filters(db_config, predefined_filters,
+                                          additional_filters)
+
+        genes = [Gene(gene) for gene in genes]
+        genes, gene_descs, locations = gnali.get_test_gene_descriptions(
+            genes, db_config, None, False,
+            gene_descriptions=served.gene_index.query(
+                [gene.name for gene in genes]))
+        genes = gnali.find_test_locations(genes, gene_descs, db_config,
+                                          locations)
+        header = gnali.get_variants(genes, db_config, filters, None, None,
+                                    False, self.workers,
+                                    opened_files=served.opened_files,
+                                    executor=self.executor)
+        info_types = parse_info_types(header) if typed else None
+        try:
+            detailed, records = gnali.extract_lof_annotations(
+                genes, db_config, pop_freqs, info_types)
+        except NoVariantsAvailableError:
+            detailed = gnali.build_results([], db_config, pop_freqs,
+                                           info_types, allow_empty=True)
+            records = []
+        basic = pd.DataFrame([[gene.name, gene.status] for gene in genes],
+                             columns=['HGNC_Symbol', 'Status'])
+        return QueryResults(basic, detailed, header, iter(records))
+
+    def close(self):
+        with self.lock:
+            for database in self.databases.values():
+                for handles, _, _ in database.opened_files:
+                    handles.close()
+            self.databases = {}
+        self.executor.shutdown(wait=True)
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+
+
+def query(genes, database=None, predefined_filters=None,
+          additional_filters=None, pop_freqs=False, typed=False,
+          config_file=None, workers=1):
+    """Find the loss-of-function variants of a list of genes, as
+        gNALI's command line does, and return the results instead
+        of writing them to an output directory. No output directory
+        or log is written, but gNALI's caches are updated, and
+        temporary files are still written for uncompressed HTTP
+        databases and, for databases without loss-of-function
+        annotations, for the VEP/LOFTEE run. Use a QueryService to
+        keep databases open across queries.
+
+    Args:
+        genes: list of HGNC symbols
+        database: name of the database to query, the default
+                  database of the configuration file if None
+        predefined_filters: list of predefined filters
+        additional_filters: list of additional filters
+        pop_freqs: whether or not to add population frequencies
+                   to the detailed results
+        typed: whether or not the detailed results have typed
+               columns, instead of text
+        config_file: database configuration file, gNALI's own
+                     configuration file by default
+        workers: number of worker threads used to fetch regions
+
+    Returns:
+        a QueryResults object
+    """
+    service = QueryService(config_file, workers)
+    try:
+        return service.query(genes, database, predefined_filters,
+                             additional_filters, pop_freqs, typed)
+    finally:
+        service.close()
@@ -0,0 +1,361 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import argparse
+import bisect
+import os
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+import yaml
+from gnali import gnali
+import gnali.outputs as outputs
+from gnali.dbconfig import RuntimeConfig
+from gnali.exceptions import InvalidConfigurationError, \
+                             NoVariantsAvailableError
+from gnali.filter import parse_info_types
+from gnali.logging import Logger
+from gnali.region_cache import overlaps
+from gnali.regions import plan_regions, record_interval
+from gnali.variants import Gene
+
+BATCH_NAME = 'gNALI batch'
+BATCH_INFO = "Run gNALI on several gene lists in one process. Genes are \
+              looked up and regions fetched from the database once for \
+              all gene lists, and each gene list gets the same output \
+              as a separate gNALI run."
+REQUIRED_OPTIONS = ['input_file', 'output_dir']
+# Options of a job, as gNALI's command line options, and their defaults
+JOB_OPTIONS = {'predefined_filters': None,
+               'additional_filters': None,
+               'pop_freqs': False,
+               'vcf': False,
+               'vcf_format': 'vcf',
+               'output_format': 'tsv'}
+
+
+class BatchJob:
+    """A gene list of a batch, queried like gnali -i <input_file>
+        -o <output_dir> with the job's options.
+    """
+    def __init__(self, options):
+        """Args:
+            options: options of the job from the manifest, with
+                     input_file and output_dir
+        """
+        self.input_file = options['input_file']
+        self.output_dir = options['output_dir']
+        self.predefined_filters = options['predefined_filters']
+        self.additional_filters = options['additional_filters']
+        self.pop_freqs = options['pop_freqs']
+        self.vcf = options['vcf']
+        self.vcf_format = options['vcf_format']
+        self.output_format = options['output_format']
+        self.genes = []
+        self.filters = []
+        self.logger = None
+
+
+def read_manifest(manifest_file):
+    """Read the jobs of a batch manifest: a YAML file with a list of
+        jobs, each with an input file, an output directory and
+        optionally the output and filtering options of gNALI's
+        command line. Relative paths are relative to the manifest.
+
+    Args:
+        manifest_file: path of the manifest
+    """
+    with open(manifest_file, 'r') as manifest_stream:
+        manifest = yaml.load(manifest_stream.read(), Loader=yaml.FullLoader)
+    jobs_info = manifest.get('jobs') if isinstance(manifest, dict) else None
+    if not isinstance(jobs_info, list) or len(jobs_info) == 0:
+        raise InvalidConfigurationError("Missing jobs in manifest {}"
+                                        .format(manifest_file))
+
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    for job_num, job_info in enumerate(jobs_info, 1):
+        if not isinstance(job_info, dict):
+            raise InvalidConfigurationError("Invalid job {} in manifest"
+                                            .format(job_num))
+        for option in REQUIRED_OPTIONS:
+            if job_info.get(option) is None:
+                raise InvalidConfigurationError("Missing {} in job {} in "
+                                                "manifest"
+                                                .format(option, job_num))
+        for option in job_info:
+            if option not in REQUIRED_OPTIONS and \
+               option not in JOB_OPTIONS:
+                raise InvalidConfigurationError("Unknown option {} in job "
+                                                "{} in manifest"
+                                                .format(option, job_num))
+        options = dict(JOB_OPTIONS)
+        options.update(job_info)
+        for option in REQUIRED_OPTIONS:
+            options[option] = os.path.join(manifest_dir,
+                                           str(options[option]))
+        if options['vcf_format'] not in outputs.VCF_FORMATS or \
+           options['output_format'] not in outputs.RESULTS_FORMATS:
+            raise InvalidConfigurationError("Invalid output format in job "
+                                            "{} in manifest".format(job_num))
+        jobs.append(BatchJob(options))
+
+    output_dirs = [os.path.normpath(job.output_dir) for job in jobs]
+    if len(set(output_dirs)) < len(output_dirs):
+        raise InvalidConfigurationError("Jobs in manifest {} must have "
+                                        "different output directories"
+                                        .format(manifest_file))
+    return jobs
+
+
+class SharedRegionCache:
+    """Region cache of a database file shared by the jobs of a batch,
+        with the same interface as RegionCache. The first job needing
+        part of a batch region fetches the whole region once, its
+        records are then kept in memory until every job whose genes
+        it covers has run (see evict()).
+    """
+    def __init__(self, opened_file, regions):
+        """Args:
+            opened_file: database file from gnali.open_db_files()
+            regions: list of Region objects covering the genes of
+                     all jobs, from plan_regions()
+        """
+        self.opened_file = opened_file
+        self.regions = {}
+        for region in regions:
+            self.regions.setdefault(region.contig, []).append(region)
+        for contig_regions in self.regions.values():
+            contig_regions.sort(key=lambda region: region.start)
+        self.starts = {contig: [region.start for region in contig_regions]
+                       for contig, contig_regions in self.regions.items()}
+        self.records = {}
+        self.locks = {region: threading.Lock() for region in regions}
+
+    def find_region(self, contig, start, end):
+        """Get the batch region containing an interval, or None.
+
+        Args:
+            contig: contig of the interval
+            start: start of the interval (1-based, inclusive)
+            end: end of the interval (1-based, inclusive)
+        """
+        index = bisect.bisect_right(self.starts.get(contig, []), start) - 1
+        if index < 0:
+            return None
+        region = self.regions[contig][index]
+        return region if region.end >= end else None
+
+    def get(self, contig, start, end):
+        """Get the records of a region, fetching the batch region
+            containing it if no job has yet. Returns None if no batch
+            region contains it or its contig isn't in the file.
+
+        Args:
+            contig: contig of the region
+            start: start of the region (1-based, inclusive)
+            end: end of the region (1-based, inclusive)
+        """
+        region = self.find_region(contig, start, end)
+        if region is None:
+            return None
+        with self.locks[region]:
+            if region not in self.records:
+                try:
+                    self.records[region] = \
+                        gnali.fetch_records(self.opened_file, region)
+                except ValueError:
+                    # the job gets the error when it fetches it itself
+                    return None
+            records = self.records[region]
+        return [record for record in records
+                if overlaps(record_interval(record), start, end)]
+
+    def put(self, contig, start, end, records):
+        """Regions are only added by get(), records the jobs fetch
+            themselves aren't kept.
+        """
+
+    def evict(self, region):
+        """Remove the records of a batch region.
+
+        Args:
+            region: Region object
+        """
+        with self.locks[region]:
+            self.records.pop(region, None)
+
+
+def get_job_regions(jobs, regions):
+    """Get the batch regions covering the genes of each job.
+
+    Args:
+        jobs: list of BatchJob objects, with their genes located
+        regions: list of Region objects planned from the genes of
+                 all jobs, from plan_regions()
+
+    Returns:
+        list of sets of Region objects, in the order of the jobs
+    """
+    gene_regions = {id(gene): region for region in regions
+                    for gene in region.get_genes()}
+    return [set(gene_regions[id(gene)] for gene in job.genes
+                if id(gene) in gene_regions)
+            for job in jobs]
+
+
+def run_job(job, db_config, opened_files, workers, verbose_on):
+    """Query the variants of a job's genes and write its output,
+        as gNALI's command line does.
+
+    Args:
+        job: BatchJob object, with its genes located
+        db_config: RuntimeConfig object
+        opened_files: database files reading from SharedRegionCache
+                      objects
+        workers: number of worker threads
+        verbose_on: boolean for verbose mode
+    """
+    try:
+        header = gnali.get_variants(job.genes, db_config, job.filters,
+                                    job.output_dir, job.logger, verbose_on,
+                                    workers, opened_files=opened_files)
+        gnali.write_run_metadata(db_config, job.output_dir)
+
+        info_types = parse_info_types(header) \
+            if job.output_format != 'tsv' else None
+        results, results_as_vcf = \
+            gnali.extract_lof_annotations(job.genes, db_config,
+                                          job.pop_freqs, info_types)
+        gnali.write_results_all(results, job.genes, header, results_as_vcf,
+                                job.output_dir, job.vcf, job.output_format,
+                                job.vcf_format)
+        print("Finished. Output in {}".format(job.output_dir))
+    except NoVariantsAvailableError:
+        gnali.write_results_basic(job.genes, job.output_dir)
+        print("No variants passed filtering")
+        print("Finished. Output in {}".format(job.output_dir))
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(prog=BATCH_NAME,
+                                     description=BATCH_INFO)
+    parser.add_argument('-m', '--manifest',
+                        required=True,
+                        help='YAML manifest of the jobs to run')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Force existing output folders to be '
+                             'overwritten')
+    parser.add_argument('-d', '--database',
+                        help='Database to query. Default: default database '
+                             'of the configuration file')
+    parser.add_argument('-c', '--config',
+                        help='Use a custom config file')
+    parser.add_argument('-w', '--workers',
+                        type=int, default=1,
+                        help='Number of worker threads used to fetch and '
+                             'filter variants. Default: 1')
+    parser.add_argument('-v', '--verbose',
+                        help='increase verbosity',
+                        action='store_true')
+    parser.add_argument('--refresh_gene_index',
+                        help='Rebuild the local gene index from Ensembl '
+                             'before running',
+                        action='store_true')
+    return parser
+
+
+def main(argv=None):
+    parser = init_parser()
+    args = parser.parse_args(argv)
+    jobs = read_manifest(args.manifest)
+    for output_format in set(job.output_format for job in jobs):
+        if output_format != 'tsv':
+            try:
+                outputs.import_pyarrow(output_format)
+            except ImportError as error:
+                parser.error(str(error))
+
+    config_file = args.config or gnali.DB_CONFIG_FILE
+    db_config = gnali.get_db_config(config_file, args.database)
+    if any(job.pop_freqs for job in jobs):
+        db_config.validate_pop_freqs_present()
+    db_config = RuntimeConfig(db_config)
+    # check that VEP dependencies are present if necessary
+    if not db_config.has_lof_annots:
+        gnali.verify_files_present(db_config.ref_genome_name,
+                                   db_config.cache_path)
+    for job in jobs:
+        gnali.validate_filters(db_config, job.predefined_filters,
+                               job.additional_filters)
+
+    for job in jobs:
+        job.logger = Logger(job.output_dir)
+        try:
+            Path(job.output_dir).mkdir(parents=True, exist_ok=args.force)
+        except FileExistsError:
+            print("Output directory {} already exists. Use a different "
+                  "name or --force to overwrite".format(job.output_dir))
+            raise
+        job.genes = [Gene(gene) for gene
+                     in gnali.open_test_file(job.input_file)]
+
+    # genes of all jobs are looked up in a single query
+    gene_names = list(dict.fromkeys(gene.name for job in jobs
+                                    for gene in job.genes))
+    gene_index = gnali.load_gene_index(db_config, args.refresh_gene_index)
+    gene_descs = gene_index.query(gene_names)
+    for job in jobs:
+        job.genes, job_gene_descs, locations = \
+            gnali.get_test_gene_descriptions(job.genes, db_config,
+                                             job.logger, args.verbose,
+                                             gene_descriptions=gene_descs)
+        job.genes = gnali.find_test_locations(job.genes, job_gene_descs,
+                                              db_config, locations)
+        job.filters = gnali.transform_filters(db_config,
+                                              job.predefined_filters,
+                                              job.additional_filters)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        opened_files = gnali.open_db_files(db_config, temp_dir, args.workers)
+        try:
+            # regions shared by several jobs are only fetched once,
+            # and dropped once the last job using them has run
+            regions = plan_regions([gene for job in jobs
+                                    for gene in job.genes])
+            caches = [SharedRegionCache(opened_file, regions)
+                      for opened_file in opened_files]
+            shared_files = [(handles, header, cache)
+                            for (handles, header, _), cache
+                            in zip(opened_files, caches)]
+            job_regions = get_job_regions(jobs, regions)
+            remaining_jobs = Counter(region for regions in job_regions
+                                     for region in regions)
+            for job, regions in zip(jobs, job_regions):
+                run_job(job, db_config, shared_files, args.workers,
+                        args.verbose)
+                for region in regions:
+                    remaining_jobs[region] -= 1
+                    if remaining_jobs[region] == 0:
+                        for cache in caches:
+                            cache.evict(region)
+        finally:
+            for handles, _, _ in opened_files:
+                handles.close()
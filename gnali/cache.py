@@ -20,9 +20,7 @@ import os
 import subprocess
 import re
 import shutil
-import magic
 import gzip
-import bgzip
 from pathlib import Path
 from gnali.exceptions import ReferenceDownloadError
 from gnali.files import download_file
@@ -62,6 +60,8 @@ def install_cache_manual_lib(vep_version, assembly, cache_path,
 
 def install_cache_manual_fasta(vep_version, assembly, cache_path,
                                homo_sapiens_path, index_path):
+    import bgzip
+    import magic
     dest_dir = "{}/{}_{}".format(homo_sapiens_path, vep_version, assembly)
     fasta_names = {"GRCh37": "Homo_sapiens.GRCh37.75.dna."
                              "primary_assembly.fa.gz",
@@ -141,8 +141,9 @@ def get_vep_version():
     return vep_version
 
 
-def verify_cache(assembly, cache_root_path):
-    vep_version = get_vep_version()
+def verify_cache(assembly, cache_root_path, vep_version=None):
+    if vep_version is None:
+        vep_version = get_vep_version()
     homo_sapiens_path = "{}/homo_sapiens".format(cache_root_path)
     index_path = "{}/cache_index_{}.txt".format(cache_root_path,
                                                 assembly.lower())
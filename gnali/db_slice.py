@@ -0,0 +1,234 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import argparse
+import copy
+import os
+import tempfile
+from pathlib import Path
+import pysam
+import yaml
+from gnali import gnali
+from gnali.dbconfig import RuntimeConfig
+from gnali.exceptions import EmptyFileError
+from gnali.files import TabixHandles, build_index
+from gnali.logging import Logger
+from gnali.outputs import write_lines
+from gnali.regions import plan_regions
+from gnali.variants import Gene
+
+SLICE_NAME = 'gNALI slice'
+SLICE_INFO = "Write a local copy of the part of a database covering a \
+              gene panel, along with a configuration file to query it."
+SLICE_CONFIG_FILE = "db-config.yaml"
+MAX_TIME = 180
+
+
+def open_bed_file(bed_file):
+    """Read regions from a BED file as genes named after the
+        region's name (4th column) or location.
+
+    Args:
+        bed_file: BED file (0-based, half-open intervals)
+    """
+    genes = []
+    with open(bed_file, 'r') as stream:
+        for line in stream:
+            if line.startswith(("#", "track", "browser")) or \
+               len(line.strip()) == 0:
+                continue
+            fields = line.rstrip("\n").split("\t")
+            location = "{}:{}-{}".format(fields[0], int(fields[1]) + 1,
+                                         int(fields[2]))
+            name = fields[3] if len(fields) > 3 and fields[3] else location
+            genes.append(Gene(name, location=location))
+    if len(genes) == 0:
+        raise EmptyFileError("input file {} is empty".format(bed_file))
+    return genes
+
+
+def iter_region_records(handles, regions, workers):
+    """Fetch the records of a database file covering a list of
+        regions, in region order. Records overlapping two regions
+        are only yielded once.
+
+    Args:
+        handles: TabixHandles of the database file
+        regions: list of Region objects from plan_regions()
+        workers: number of worker threads used to fetch regions
+    """
+    def fetch(region):
+        try:
+            return list(handles.get().fetch(reference=str(region)))
+        except ValueError:
+            # region does not exist in the database
+            return []
+
+    previous = None
+    for region, records in zip(regions, gnali.iter_tasks(fetch, regions,
+                                                         workers)):
+        for record in records:
+            # records starting in the previous region were fetched
+            # with it, regions of a contig are sorted and disjoint
+            if previous is not None and previous.contig == region.contig:
+                if int(record.split("\t", 2)[1]) <= previous.end:
+                    continue
+            yield record
+        previous = region
+
+
+def slice_file(data_file, regions, output_dir, temp_dir, workers):
+    """Write the records of a database file covering a list of
+        regions to a local BGZF-compressed, Tabix-indexed VCF file
+        (with a CSI index if the file's index_min_shift is set).
+
+    Args:
+        data_file: DataFile object
+        regions: list of Region objects from plan_regions()
+        output_dir: directory to write the slice to
+        temp_dir: directory for intermediate files
+        workers: number of worker threads used to fetch regions
+
+    Returns:
+        path of the slice, and the number of records written
+    """
+    if data_file.is_http and data_file.is_compressed:
+        tbi = gnali.get_db_tbi(data_file, gnali.DATA_PATH, MAX_TIME)
+        handles = TabixHandles(data_file.path, tbi)
+    else:
+        tbi = gnali.get_db_tbi(data_file, temp_dir, MAX_TIME)
+        handles = TabixHandles(data_file.compressed_path, tbi)
+
+    slice_path = "{}/{}.vcf.bgz".format(output_dir, data_file.name)
+    plain_path = "{}/{}.vcf".format(temp_dir, data_file.name)
+    num_records = 0
+    try:
+        with open(plain_path, 'w') as stream:
+            write_lines(stream, handles.get().header)
+            for record in iter_region_records(handles, regions, workers):
+                write_lines(stream, [record])
+                num_records += 1
+    finally:
+        handles.close()
+    pysam.tabix_compress(plain_path, slice_path, force=True)
+    build_index(slice_path, min_shift=data_file.index_min_shift)
+    os.remove(plain_path)
+    return slice_path, num_records
+
+
+def write_slice_config(config_file, db_name, files, output_dir):
+    """Write a configuration file with the database entry of a
+        slice, a copy of the original database's entry pointing
+        at the local files.
+
+    Args:
+        config_file: configuration file the database is from
+        db_name: name of the original database
+        files: path of the slice of every database file, by name
+        output_dir: directory to write the configuration file to
+
+    Returns:
+        path of the configuration file, and name of the slice's
+        database entry
+    """
+    config = gnali.read_config_file(config_file)
+    if db_name is None:
+        db_name = config['default']
+    slice_name = "{}-slice".format(db_name)
+    db_info = copy.deepcopy(config['databases'][db_name])
+    for file_name, path in files.items():
+        db_info['files'][file_name]['path'] = str(Path(path).absolute())
+    config['databases'] = {slice_name: db_info}
+    config['default'] = slice_name
+    slice_config = "{}/{}".format(output_dir, SLICE_CONFIG_FILE)
+    with open(slice_config, 'w') as config_stream:
+        yaml.dump(config, config_stream, default_flow_style=False,
+                  sort_keys=False)
+    return slice_config, slice_name
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(prog=SLICE_NAME,
+                                     description=SLICE_INFO)
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('-i', '--input_file',
+                       help='File of genes to slice. '
+                            'Accepted formats: csv, txt')
+    group.add_argument('-b', '--bed',
+                       help='BED file of regions to slice')
+    parser.add_argument('-o', '--output_dir',
+                        required=True,
+                        help='Name of output directory')
+    parser.add_argument('-f', '--force',
+                        action='store_true',
+                        help='Force existing output folder to be overwritten')
+    parser.add_argument('-d', '--database',
+                        help='Database to slice. Default: default database '
+                             'of the configuration file')
+    parser.add_argument('-c', '--config',
+                        help='Use a custom config file')
+    parser.add_argument('-w', '--workers',
+                        type=int, default=1,
+                        help='Number of worker threads used to fetch '
+                             'regions. Default: 1')
+    parser.add_argument('-v', '--verbose',
+                        help='increase verbosity',
+                        action='store_true')
+    parser.add_argument('--refresh_gene_index',
+                        help='Rebuild the local gene index from Ensembl '
+                             'before running',
+                        action='store_true')
+    return parser
+
+
+def main(argv=None):
+    args = init_parser().parse_args(argv)
+    config_file = args.config or gnali.DB_CONFIG_FILE
+    db_config = RuntimeConfig(gnali.get_db_config(config_file,
+                                                  args.database))
+    output_dir = args.output_dir
+    Path(output_dir).mkdir(parents=True, exist_ok=args.force)
+    logger = Logger(output_dir)
+
+    if args.bed is not None:
+        genes = open_bed_file(args.bed)
+    else:
+        genes = [Gene(gene) for gene in gnali.open_test_file(args.input_file)]
+        genes, gene_descs, locations = gnali.get_test_gene_descriptions(
+            genes, db_config, logger, args.verbose, args.refresh_gene_index)
+        genes = gnali.find_test_locations(genes, gene_descs, db_config,
+                                          locations)
+    regions = plan_regions(genes)
+    unknown = [gene.name for gene in genes if gene.location is None]
+    if len(unknown) > 0:
+        print("Skipping {} genes not found in the gene index"
+              .format(len(unknown)))
+
+    files = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for data_file in db_config.files:
+            files[data_file.name], num_records = \
+                slice_file(data_file, regions, output_dir, temp_dir,
+                           args.workers)
+            print("Wrote {} records of {} to {}"
+                  .format(num_records, data_file.name,
+                          files[data_file.name]))
+    slice_config, slice_name = write_slice_config(config_file, args.database,
+                                                  files, output_dir)
+    print("Finished. Query the slice with: gnali -c {} -d {} -i <genes>"
+          .format(slice_config, slice_name))
@@ -17,7 +17,11 @@ specific language governing permissions and limitations under the License.
 """
 
 from gnali.exceptions import InvalidConfigurationError, InvalidFilterError
-from gnali.cache import get_vep_version
+from gnali.environment import get_vep_version
+from gnali.files import get_index_type
+from gnali.gene_index import DEFAULT_GENE_INDEX_TTL
+from gnali.remote_cache import DEFAULT_REMOTE_INDEX_TTL
+from gnali.region_cache import DEFAULT_REGION_CACHE_SIZE
 import urllib
 import pathlib
 import shutil
@@ -37,6 +41,7 @@ class Config:
         self.is_full = False
         self.configs = []
         self.default = None
+        self.local_cache = config.get('local-cache') or {}
 
         if db == '':
             self.name = 'help'
@@ -75,9 +80,21 @@ class Config:
                     self.validate_db(db)
             else:
                 self.validate_db(self)
+            self.validate_local_cache()
         except Exception:
             raise
 
+    def validate_local_cache(self):
+        if not isinstance(self.local_cache, dict):
+            raise InvalidConfigurationError("Invalid local-cache in "
+                                            "configuration file")
+        for key, value in self.local_cache.items():
+            if not isinstance(value, (int, float)) or value < 0:
+                raise InvalidConfigurationError("Invalid local-cache "
+                                                "value for {}: must be a "
+                                                "non-negative number"
+                                                .format(key))
+
     def validate_db(self, config):
         if config.files is None:
             raise InvalidConfigurationError("Missing files in {}"
@@ -193,6 +210,15 @@ class RuntimeConfig:
         self.ref_genome_name = config.ref_genome.get('name')
         self.ref_genome_path = config.ref_genome.get('path')
         self.has_lof_annots = (config.lof is not None)
+        self.vep_version = None
+        self.gene_index_ttl = config.local_cache.get('gene-index-ttl',
+                                                     DEFAULT_GENE_INDEX_TTL)
+        self.remote_index_ttl = config.local_cache.get(
+            'remote-index-ttl', DEFAULT_REMOTE_INDEX_TTL)
+        self.region_cache_size = config.local_cache.get(
+            'region-cache-size', DEFAULT_REGION_CACHE_SIZE)
+        self.index_min_shift = int(config.local_cache.get('index-min-shift',
+                                                          0))
 
         if self.has_lof_annots:
             self.lof = config.lof
@@ -206,6 +232,7 @@ class RuntimeConfig:
                                                    config.ref_files
                                                    .get('human-ancestor'))
             vep_version = get_vep_version()
+            self.vep_version = vep_version
             self.ref_assembly_fasta_path = "{}/{}" \
                                            .format(GNALI_ROOT_DIR,
                                                    config.ref_files
@@ -228,7 +255,9 @@ class RuntimeConfig:
         self.files = []
 
         for file_name, file_info in config.files.items():
-            self.files.append(DataFile(file_name, file_info))
+            self.files.append(DataFile(file_name, file_info,
+                                       self.remote_index_ttl,
+                                       self.index_min_shift))
 
     def validate_predefined_filter(self, filt):
         if filt not in self.predefined_filters:
@@ -251,15 +280,22 @@ class DataFile:
     """Contains information pertaining to a file in the database
         used to make the current RuntimeConfig.
     """
-    def __init__(self, file_name, file_info):
+    def __init__(self, file_name, file_info,
+                 index_ttl=DEFAULT_REMOTE_INDEX_TTL, index_min_shift=0):
         # default values
         self.is_http = False
         self.is_local = False
         self.is_compressed = False
         self.compressed_path = None
+        self.index_path = None
+        self.index_type = None
 
         self.name = file_name
         self.path = file_info['path']
+        # time (in hours) before a cached remote index is revalidated
+        self.index_ttl = index_ttl
+        # min shift of the CSI indexes gNALI builds (0 means TBI)
+        self.index_min_shift = index_min_shift
 
         path_info = urllib.parse.urlparse(file_info.get('path'))
         self.is_local = (path_info.scheme == b'' or
@@ -277,6 +313,10 @@ class DataFile:
     def set_compressed_path(self, path):
         self.compressed_path = path
 
+    def set_index_path(self, path):
+        self.index_path = path
+        self.index_type = get_index_type(path)
+
     def __str__(self):
         return "name: {}\n" \
                "path: {}\n" \
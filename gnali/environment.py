@@ -0,0 +1,323 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+import gnali.cache as cache
+import gnali.gnali_get_data as gnali_get_data
+import gnali.vep as vep
+
+GNALI_PATH = Path(__file__).parent.absolute()
+DATA_PATH = "{}/data".format(str(GNALI_PATH))
+ENVIRONMENT_CACHE_PATH = "{}/environment-cache".format(DATA_PATH)
+# Bump when the layout of the cache changes, older entries are probed again
+ENVIRONMENT_CACHE_FORMAT = 2
+# Time (in seconds) to wait for another gNALI process writing to the cache
+ENVIRONMENT_CACHE_TIMEOUT = 600
+VEP_COMMAND = "vep"
+
+# Results of the probes made by this process, by probe
+probe_results = {}
+probe_lock = threading.RLock()
+
+
+class EnvironmentCache:
+    """Persistent cache of what gNALI probes of its environment, so
+        that VEP is only started to get its version when it changes,
+        and the LOFTEE version and reference files are only checked
+        again when they change. There is one entry per VEP executable
+        path, valid as long as the executable's size and modification
+        time are the ones it was probed with. An entry also holds the
+        LOFTEE version of each assembly, keyed by the state of its
+        checkout, and the reference files verified for each assembly
+        and VEP cache directory, keyed by the state of these files.
+    """
+    def __init__(self, cache_dir=None):
+        """Args:
+            cache_dir: directory holding the cache
+        """
+        if cache_dir is None:
+            cache_dir = ENVIRONMENT_CACHE_PATH
+        self.cache_dir = cache_dir
+        self.path = "{}/vep.json".format(cache_dir)
+
+    def get_entry(self, vep_path, source):
+        """Get the entry of a VEP executable, or an empty entry if it
+            was not probed with its current size and modification time.
+
+        Args:
+            vep_path: path of the VEP executable
+            source: executable_source() of the executable
+        """
+        entry = self.read().get(vep_path)
+        return entry if is_current(entry, source) else {}
+
+    def get_vep_version(self, vep_path):
+        """Get the version of a VEP executable, running it only if
+            it has no entry for the executable's current size and
+            modification time.
+
+        Args:
+            vep_path: path of the VEP executable
+        """
+        source = executable_source(vep_path)
+        entry = self.get_entry(vep_path, source)
+        if 'vep_version' in entry:
+            return entry['vep_version']
+
+        vep_version = cache.get_vep_version()
+        self.update(vep_path, source, {'vep_version': vep_version})
+        return vep_version
+
+    def get_loftee_version(self, vep_path, assembly):
+        """Get the version of the LOFTEE plugin installed for an
+            assembly, reading its checkout only if it changed since
+            it was last read.
+
+        Args:
+            vep_path: path of the VEP executable
+            assembly: name of reference genome (ex. GRCh37)
+        """
+        source = executable_source(vep_path)
+        checkout = checkout_source(vep.get_loftee_path(assembly))
+        loftee = self.get_entry(vep_path, source).get('loftee', {})
+        probed = loftee.get(assembly)
+        if isinstance(probed, dict) and \
+           probed.get('checkout') == checkout and 'version' in probed:
+            return probed['version']
+
+        loftee_version = vep.get_loftee_version(assembly)
+        self.update(vep_path, source,
+                    {'loftee': {assembly: {'checkout': checkout,
+                                           'version': loftee_version}}})
+        return loftee_version
+
+    def verify_files_present(self, vep_path, assembly, cache_root_path):
+        """Check that the VEP cache and LOFTEE references of an
+            assembly are installed, see
+            gnali_get_data.verify_files_present(), unless they were
+            verified and haven't changed since.
+
+        Args:
+            vep_path: path of the VEP executable
+            assembly: name of reference genome (ex. GRCh37)
+            cache_root_path: directory of the VEP cache
+        """
+        source = executable_source(vep_path)
+        key = "{}:{}".format(assembly, os.path.abspath(cache_root_path))
+        files = self.get_entry(vep_path, source).get('files', {})
+        if files.get(key) == data_source(assembly, cache_root_path):
+            return
+
+        gnali_get_data.verify_files_present(
+            assembly, cache_root_path, self.get_vep_version(vep_path))
+        self.update(vep_path, source,
+                    {'files': {key: data_source(assembly, cache_root_path)}})
+
+    def read(self):
+        try:
+            with open(self.path, 'r') as stream:
+                entries = json.load(stream)
+        except (OSError, ValueError):
+            return {}
+        return entries if isinstance(entries, dict) else {}
+
+    def update(self, vep_path, source, values):
+        """Update the entry of an executable with the results of
+            probes, merged with the ones other gNALI processes wrote
+            while holding the cache's lock. The cache is written to a
+            temporary file first, so that other gNALI processes never
+            read a partially written cache. Nothing is written if the
+            lock can't be acquired, probes are then run again later.
+
+        Args:
+            vep_path: path of the VEP executable
+            source: executable_source() of the executable
+            values: results of probes, results of the LOFTEE and
+                    reference files probes are merged by assembly
+        """
+        from filelock import FileLock
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        lock = FileLock("{}.lock".format(self.path))
+        try:
+            with lock.acquire(timeout=ENVIRONMENT_CACHE_TIMEOUT):
+                entries = self.read()
+                entry = entries.get(vep_path)
+                entry = dict(entry if is_current(entry, source) else source)
+                for key, value in values.items():
+                    if isinstance(value, dict):
+                        merged = dict(entry.get(key) or {})
+                        merged.update(value)
+                        value = merged
+                    entry[key] = value
+                entries[vep_path] = entry
+                handle, temp_path = tempfile.mkstemp(dir=self.cache_dir,
+                                                     suffix=".tmp")
+                with os.fdopen(handle, 'w') as stream:
+                    json.dump(entries, stream)
+                os.replace(temp_path, self.path)
+        except TimeoutError:
+            pass
+
+
+def executable_source(path):
+    """Get what the cache entry of an executable is keyed by,
+        besides its path.
+
+    Args:
+        path: path of the executable
+    """
+    stat = os.stat(path)
+    return {'format': ENVIRONMENT_CACHE_FORMAT,
+            'real_path': os.path.realpath(path),
+            'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_current(entry, source):
+    """Check that a cache entry was probed from the given source.
+
+    Args:
+        entry: entry of a VEP executable
+        source: executable_source() of the executable
+    """
+    return isinstance(entry, dict) and \
+        all(entry.get(key) == value for key, value in source.items())
+
+
+def path_state(path):
+    """Get the size and modification time of a file or directory,
+        or None if it doesn't exist.
+
+    Args:
+        path: path of the file or directory
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def checkout_source(loftee_path):
+    """Get what the LOFTEE version of an assembly is keyed by: the
+        state of its checkout's HEAD and branches, which change
+        when the checkout is replaced or another commit is checked
+        out.
+
+    Args:
+        loftee_path: directory of the LOFTEE checkout
+    """
+    git_path = "{}/.git".format(loftee_path)
+    return {'path': os.path.realpath(loftee_path),
+            'state': [path_state("{}/{}".format(git_path, name))
+                      for name in ["", "HEAD", "refs/heads",
+                                   "packed-refs"]]}
+
+
+def data_source(assembly, cache_root_path):
+    """Get what the reference files verified for an assembly are
+        keyed by: the state of the VEP cache's index files and of
+        the installed references' version file.
+
+    Args:
+        assembly: name of reference genome (ex. GRCh37)
+        cache_root_path: directory of the VEP cache
+    """
+    paths = ["{}/homo_sapiens".format(cache_root_path),
+             "{}/cache_index_{}.txt".format(cache_root_path,
+                                            assembly.lower()),
+             "{}/cache_lib_{}.txt".format(cache_root_path,
+                                          assembly.lower()),
+             gnali_get_data.Dependencies.files[assembly]]
+    return {'deps_version': gnali_get_data.Dependencies.versions[assembly],
+            'state': [path_state(path) for path in paths]}
+
+
+def probe_once(probe, function):
+    """Run a probe of the environment, unless this process already
+        ran it.
+
+    Args:
+        probe: key of the probe
+        function: function running the probe
+    """
+    with probe_lock:
+        if probe not in probe_results:
+            probe_results[probe] = function()
+        return probe_results[probe]
+
+
+def get_vep_version():
+    """Get the version of VEP. VEP is only run when the vep
+        executable found on the PATH changes, see EnvironmentCache.
+    """
+    vep_path = shutil.which(VEP_COMMAND)
+    if vep_path is None:
+        # VEP isn't installed, fail as running it does
+        return cache.get_vep_version()
+    source = executable_source(vep_path)
+    return probe_once(('vep', vep_path, source['real_path'], source['size'],
+                       source['mtime_ns']),
+                      lambda: EnvironmentCache().get_vep_version(vep_path))
+
+
+def get_loftee_version(assembly):
+    """Get the version of the LOFTEE plugin installed for an
+        assembly, see vep.get_loftee_version(). The checkout is only
+        read again when it changes, see EnvironmentCache.
+
+    Args:
+        assembly: name of reference genome (ex. GRCh37)
+    """
+    vep_path = shutil.which(VEP_COMMAND)
+    if vep_path is None:
+        return probe_once(('loftee', assembly),
+                          lambda: vep.get_loftee_version(assembly))
+    return probe_once(('loftee', assembly, vep_path),
+                      lambda: EnvironmentCache().get_loftee_version(
+                          vep_path, assembly))
+
+
+def verify_files_present(assembly, cache_root_path):
+    """Check that the VEP cache and LOFTEE references of an assembly
+        are installed, installing them if they are missing, see
+        gnali_get_data.verify_files_present(). Files are only checked
+        once per process, and again when they change, see
+        EnvironmentCache.
+
+    Args:
+        assembly: name of reference genome (ex. GRCh37)
+        cache_root_path: directory of the VEP cache
+    """
+    vep_path = shutil.which(VEP_COMMAND)
+
+    def verify():
+        if vep_path is None:
+            # VEP isn't installed, fail as verifying the files does
+            gnali_get_data.verify_files_present(assembly, cache_root_path,
+                                                get_vep_version())
+        else:
+            EnvironmentCache().verify_files_present(vep_path, assembly,
+                                                    cache_root_path)
+
+    probe_once(('files', assembly, os.path.abspath(cache_root_path)),
+               verify)
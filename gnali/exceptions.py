@@ -120,3 +120,18 @@ class ReferenceDownloadError(Exception):
             return "ReferenceDownloadError: " + format(self.message)
         else:
             return "ReferenceDownloadError"
+
+
+class GeneIndexError(Exception):
+
+    def __init__(self, *args):
+        if args:
+            self.message = args[0]
+        else:
+            self.message = None
+
+    def __str__(self):
+        if self.message:
+            return "GeneIndexError: " + format(self.message)
+        else:
+            return "GeneIndexError"
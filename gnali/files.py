@@ -16,12 +16,25 @@ CONDITIONS OF ANY KIND, either express or implied. See the License for the
 specific language governing permissions and limitations under the License.
 """
 
+import gzip
 import shutil
 import os
+import threading
 from contextlib import closing
+import urllib.error
+import urllib.parse
 import urllib.request as request
 from gnali.exceptions import ReferenceDownloadError
 
+# Size (in bytes) of the chunks VCF files are compressed in
+COMPRESS_CHUNK_SIZE = 4 * 1024 * 1024
+# Index files of compressed VCF files, in the order they are looked for
+INDEX_EXTENSIONS = [".tbi", ".csi"]
+# Min shift of CSI indexes built for files TBI can't index (positions
+# past 2^29), the same as htslib's default
+DEFAULT_CSI_MIN_SHIFT = 14
+INDEX_TYPES = {b'TBI\x01': 'tbi', b'CSI\x01': 'csi'}
+
 
 def download_file(url, dest_path, max_time):
     """Download a file from a url.
@@ -50,3 +63,122 @@ def download_file(url, dest_path, max_time):
         if os.path.exists(dest_path):
             os.remove(dest_path)
         raise ReferenceDownloadError("Error downloading {}".format(url))
+
+
+def compress_vcf(path, data_path, file_name, max_time=None,
+                 num_threads=None):
+    """Compress a VCF file to BGZF (required for Tabix). The file
+        is streamed in fixed-size chunks, so memory use doesn't
+        depend on its size, and BGZF blocks are deflated on
+        several threads.
+
+    Args:
+        path: path or HTTP url of the uncompressed VCF file
+        data_path: where to save the compressed file
+        file_name: name of the file
+        max_time: maximum time to wait for the server
+                  when reading from an HTTP url
+        num_threads: number of compression threads,
+                     defaults to the number of CPUs
+    """
+    import bgzip
+    data_bgz = "{}/{}.bgz".format(data_path, file_name)
+    num_threads = num_threads or os.cpu_count() or 1
+    is_url = urllib.parse.urlparse(path).scheme in ('http', 'https', 'ftp')
+    try:
+        if is_url:
+            data_stream = request.urlopen(path, timeout=max_time)
+        else:
+            data_stream = open(path, 'rb')
+        with data_stream:
+            with open(data_bgz, 'wb') as bgz_stream:
+                with bgzip.BGZipWriter(bgz_stream,
+                                       num_threads=num_threads) as fh:
+                    shutil.copyfileobj(data_stream, fh, COMPRESS_CHUNK_SIZE)
+    except (urllib.error.URLError, OSError) as error:
+        if os.path.exists(data_bgz):
+            os.remove(data_bgz)
+        if is_url:
+            raise ReferenceDownloadError("Error downloading {}: {}"
+                                         .format(path, error))
+        raise
+    return data_bgz
+
+
+def build_index(path, index_dir=None, min_shift=0):
+    """Build a Tabix index of a BGZF-compressed VCF file. A TBI
+        index is built unless a min shift is given, and a CSI index
+        if the file has positions past what TBI can store.
+
+    Args:
+        path: path of the compressed VCF file
+        index_dir: where to save the index, next to the file
+                   by default
+        min_shift: min shift of a CSI index (0 to build a TBI index)
+
+    Returns:
+        path of the index
+    """
+    import pysam
+    if index_dir is None:
+        index_dir = os.path.dirname(path) or "."
+    index_base = "{}/{}".format(index_dir, os.path.basename(path))
+    if not min_shift:
+        index = "{}.tbi".format(index_base)
+        try:
+            pysam.tabix_index(path, preset='vcf', force=True, index=index)
+            return index
+        except OSError:
+            # htslib refuses positions past 2^29 in TBI indexes
+            min_shift = DEFAULT_CSI_MIN_SHIFT
+    index = "{}.csi".format(index_base)
+    pysam.tabix_index(path, preset='vcf', force=True, csi=True,
+                      min_shift=int(min_shift), index=index)
+    return index
+
+
+def get_index_type(path):
+    """Get the type of a Tabix index file ('tbi' or 'csi') from
+        its content, or None if it isn't a Tabix index.
+
+    Args:
+        path: path of the index file
+    """
+    try:
+        with gzip.open(path, 'rb') as stream:
+            return INDEX_TYPES.get(stream.read(4))
+    except (OSError, EOFError):
+        return None
+
+
+class TabixHandles:
+    """Opens one pysam.TabixFile per thread for a database file,
+        since a TabixFile can't be shared between threads.
+    """
+    def __init__(self, path, index):
+        """Args:
+            path: path or url of the compressed database file
+            index: path of the file's index
+        """
+        self.path = path
+        self.index = index
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.handles = []
+
+    def get(self):
+        tbx = getattr(self.local, 'tbx', None)
+        if tbx is None:
+            import pysam
+            tbx = pysam.TabixFile(self.path, index=self.index)
+            self.local.tbx = tbx
+            with self.lock:
+                self.handles.append(tbx)
+        return tbx
+
+    def close(self):
+        with self.lock:
+            for tbx in self.handles:
+                tbx.close()
+            self.handles = []
+        self.local = threading.local()
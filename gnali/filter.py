@@ -16,10 +16,77 @@ CONDITIONS OF ANY KIND, either express or implied. See the License for the
 specific language governing permissions and limitations under the License.
 """
 
+import operator
 import re
+from gnali.exceptions import InvalidFilterError
+
+# Longer operators first, so that '>=' isn't split as '>'
+OPERATOR_PATTERN = re.compile('(>=|<=|==|!=|>|<|=)')
+OPERATORS = {'>': operator.gt,
+             '>=': operator.ge,
+             '<': operator.lt,
+             '<=': operator.le,
+             '==': operator.eq,
+             '=': operator.eq,
+             '!=': operator.ne}
+INFO_PATTERN = re.compile('^##INFO=<ID=([^,>]+)')
+INFO_FIELD_PATTERN = re.compile('[<,](Number|Type)=([^,>]+)')
+TRUE_VALUES = ('1', 'true', 'yes')
+FALSE_VALUES = ('0', 'false', 'no')
+
+
+def parse_info_types(header):
+    """Get the declared Number and Type of every INFO field
+        in a VCF header.
+
+    Args:
+        header: VCF header lines
+
+    Returns:
+        dictionary of (Number, Type) tuples by INFO ID
+    """
+    info_types = {}
+    for line in header:
+        match = INFO_PATTERN.match(str(line))
+        if match is None:
+            continue
+        fields = dict(INFO_FIELD_PATTERN.findall(str(line)))
+        info_types[match.group(1)] = (fields.get('Number'),
+                                      fields.get('Type'))
+    return info_types
+
+
+def infer_type(value):
+    """Get the VCF type of a filter value with no header declaration."""
+    for vcf_type, converter in (('Integer', int), ('Float', float)):
+        try:
+            converter(value)
+            return vcf_type
+        except ValueError:
+            pass
+    return 'String'
+
+
+def parse_flag(value):
+    """Convert a filter value for a Flag field to a boolean."""
+    value = value.strip().lower()
+    if value in TRUE_VALUES:
+        return True
+    if value in FALSE_VALUES:
+        return False
+    raise ValueError("Invalid flag value {}".format(value))
 
 
 class Filter:
+    """A comparison of an INFO field to a value (ex. AC>3), compiled
+        into a predicate over records. Values are compared with the
+        type declared for the field in the VCF header (Integer, Float,
+        Flag or String), or the type of the filter value if the field
+        isn't declared. A record fails the filter if it doesn't have
+        the field, its value is missing ('.') or can't be converted.
+        Fields with several values (ex. Number=A on multi-allelic
+        records) pass if any of their values does.
+    """
     attribute = ""
     operator = ""
     value = ""
@@ -28,12 +95,75 @@ class Filter:
     def __init__(self, name, expression):
         self.name = name
         self.attribute, self.operator, \
-            self.value = re.split('(>|>=|<|<=|==|!=)', expression)
+            self.value = OPERATOR_PATTERN.split(expression, maxsplit=1)
+        self.attribute = self.attribute.strip()
+        self.value = self.value.strip()
+        if self.attribute == "" or OPERATOR_PATTERN.search(self.value):
+            raise ValueError("Invalid filter {}".format(expression))
+        self.compile({})
+
+    def compile(self, info_types):
+        """Build the predicate used by apply(). Raises an
+            InvalidFilterError if a Flag field is compared to
+            something other than a boolean, or a numeric field to
+            something other than a number.
+
+        Args:
+            info_types: dictionary of (Number, Type) tuples by INFO ID,
+                        from parse_info_types()
+        """
+        attribute = self.attribute
+        compare = OPERATORS[self.operator]
+        vcf_type = info_types.get(attribute, (None, None))[1]
+        if vcf_type is None:
+            vcf_type = infer_type(self.value)
+
+        if vcf_type == 'Flag':
+            try:
+                value = parse_flag(self.value)
+            except ValueError:
+                raise InvalidFilterError(self.name)
+            self.predicate = self._compile_flag(attribute, compare, value)
+            return
+
+        converter = str
+        if vcf_type == 'Integer':
+            converter = int
+        elif vcf_type == 'Float':
+            converter = float
+        try:
+            value = converter(self.value)
+        except ValueError:
+            # ex. Integer field compared to a decimal
+            try:
+                value = float(self.value)
+            except ValueError:
+                raise InvalidFilterError(self.name)
+        # only numeric fields are lists, strings may contain commas
+        is_list = converter is not str
+
+        def predicate(record):
+            record_value = record.info.get(attribute)
+            if record_value is None or record_value == '.':
+                return False
+            try:
+                if not is_list or ',' not in record_value:
+                    return compare(converter(record_value), value)
+                return any(compare(converter(item), value)
+                           for item in record_value.split(',')
+                           if item != '.')
+            except ValueError:
+                return False
+        self.predicate = predicate
+
+    @staticmethod
+    def _compile_flag(attribute, compare, value):
+        def predicate(record):
+            return compare(attribute in record.flags(), value)
+        return predicate
 
     def apply(self, record):
-        self.record_value = record.info[self.attribute]
-        return eval("self.record_value {operator} self.value"
-                    .format(operator=self.operator))
+        return self.predicate(record)
 
     def __str__(self):
         return ("attribute = {}, operator = {}, value = {}"
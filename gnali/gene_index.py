@@ -0,0 +1,184 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import os
+import re
+import sqlite3
+import time
+import urllib.parse
+from contextlib import closing
+from pathlib import Path
+
+GNALI_PATH = Path(__file__).parent.absolute()
+DATA_PATH = "{}/data".format(str(GNALI_PATH))
+GENE_INDEX_PATH = "{}/gene-index".format(DATA_PATH)
+# Bump when the layout of the index changes, older indexes are rebuilt
+GENE_INDEX_FORMAT = 1
+# Default time (in hours) before a gene index is refreshed from Ensembl
+DEFAULT_GENE_INDEX_TTL = 720
+GENE_COLUMNS = ['hgnc_symbol', 'chromosome_name',
+                'start_position', 'end_position']
+
+
+class GeneIndex:
+    """Local gene-coordinate index for one reference genome,
+        built from the Ensembl human gene dataset and stored as
+        an SQLite database indexed on HGNC symbol.
+    """
+    def __init__(self, ref_genome_name, ref_genome_path, index_dir=None):
+        """Args:
+            ref_genome_name: name of reference genome (ex. GRCh37)
+            ref_genome_path: Ensembl host the index is built from
+            index_dir: directory holding gene indexes
+        """
+        if index_dir is None:
+            index_dir = GENE_INDEX_PATH
+        self.ref_genome_name = ref_genome_name
+        self.ref_genome_path = ref_genome_path
+        host = urllib.parse.urlparse(ref_genome_path).netloc or \
+            ref_genome_path
+        host = re.sub('[^A-Za-z0-9.-]', '_', host)
+        self.path = "{}/{}_{}.sqlite".format(index_dir, ref_genome_name,
+                                             host)
+        self.lock_path = "{}.lock".format(self.path)
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def get_meta(self):
+        """Return the metadata the index was built with,
+            or None if there is no usable index.
+        """
+        if not self.exists():
+            return None
+        try:
+            with closing(sqlite3.connect(self.path)) as conn:
+                return dict(conn.execute("SELECT key, value FROM meta")
+                            .fetchall())
+        except sqlite3.Error:
+            return None
+
+    def needs_refresh(self, ttl):
+        """Determine if the index must be (re)built.
+            This is the case if it doesn't exist, was built with
+            an older format or for another host, or is older
+            than the TTL.
+
+        Args:
+            ttl: time (in hours) an index stays valid, an index
+                 never expires if ttl is 0
+        """
+        meta = self.get_meta()
+        if meta is None:
+            return True
+        if int(meta.get('format', 0)) != GENE_INDEX_FORMAT or \
+           meta.get('ref_genome_path') != self.ref_genome_path:
+            return True
+        if ttl:
+            age = time.time() - float(meta.get('built_at', 0))
+            return age > float(ttl) * 3600
+        return False
+
+    def build(self, genes):
+        """Write the index from a gene dataset. The index is
+            written to a temporary file first, so readers never
+            see a partially built index.
+
+        Args:
+            genes: DataFrame of genes with hgnc_symbol,
+                   chromosome_name, start_position and
+                   end_position (in that order)
+        """
+        genes = genes.copy()
+        genes.columns = GENE_COLUMNS
+        genes = genes[genes['hgnc_symbol'].notna() &
+                      (genes['hgnc_symbol'] != '')]
+        genes = genes[~genes['chromosome_name'].astype(str)
+                      .str.contains('PATCH')]
+
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        with closing(sqlite3.connect(temp_path)) as conn, conn:
+            conn.execute("CREATE TABLE genes (hgnc_symbol TEXT NOT NULL, "
+                         "chromosome_name TEXT NOT NULL, "
+                         "start_position INTEGER NOT NULL, "
+                         "end_position INTEGER NOT NULL)")
+            conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, "
+                         "value TEXT)")
+            conn.executemany("INSERT INTO genes VALUES (?, ?, ?, ?)",
+                             zip(genes['hgnc_symbol'].astype(str),
+                                 genes['chromosome_name'].astype(str),
+                                 genes['start_position'].astype(int)
+                                 .tolist(),
+                                 genes['end_position'].astype(int)
+                                 .tolist()))
+            conn.execute("CREATE INDEX genes_symbol ON genes (hgnc_symbol)")
+            conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                             [('format', str(GENE_INDEX_FORMAT)),
+                              ('ref_genome_name', self.ref_genome_name),
+                              ('ref_genome_path', self.ref_genome_path),
+                              ('built_at', str(time.time()))])
+        os.replace(temp_path, self.path)
+
+    def query(self, symbols):
+        """Get coordinates for a list of genes. Rows are returned in
+            the order of the Ensembl dataset the index was built from.
+
+        Args:
+            symbols: list of HGNC symbols
+        """
+        import pandas as pd
+        with closing(sqlite3.connect(self.path)) as conn:
+            conn.execute("CREATE TEMP TABLE targets "
+                         "(symbol TEXT PRIMARY KEY)")
+            conn.executemany("INSERT OR IGNORE INTO targets VALUES (?)",
+                             [(symbol,) for symbol in symbols])
+            rows = conn.execute("SELECT g.hgnc_symbol, g.chromosome_name, "
+                                "g.start_position, g.end_position "
+                                "FROM genes g JOIN targets t "
+                                "ON g.hgnc_symbol = t.symbol "
+                                "ORDER BY g.rowid").fetchall()
+        genes = pd.DataFrame(rows, columns=GENE_COLUMNS)
+        genes['start_position'] = genes['start_position'].astype('int64')
+        genes['end_position'] = genes['end_position'].astype('int64')
+        return genes
+
+
+def index_gene_locations(gene_descs):
+    """Build a symbol -> (chromosome, start, end) lookup from gene
+        coordinates in a single pass over the table. Symbols that
+        map to several loci keep their first locus.
+
+    Args:
+        gene_descs: DataFrame of genes from GeneIndex.query()
+
+    Returns:
+        the lookup, and a list of symbols that map to several loci
+    """
+    loci = gene_descs.drop_duplicates(subset=GENE_COLUMNS)
+    symbols = loci['hgnc_symbol']
+    duplicated = symbols.duplicated(keep='first')
+    duplicates = list(dict.fromkeys(symbols[duplicated]))
+    first_loci = loci[~duplicated]
+    locations = dict(zip(first_loci['hgnc_symbol'],
+                         zip(first_loci['chromosome_name'],
+                             first_loci['start_position'],
+                             first_loci['end_position'])))
+    return locations, duplicates
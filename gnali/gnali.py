@@ -17,33 +17,37 @@ specific language governing permissions and limitations under the License.
 """
 
 import argparse
+import copy
 import csv
-from pybiomart import Server
-import pysam
-from pathlib import Path
+import itertools
 import os
+from collections import deque
+from pathlib import Path
 import sys
-import numpy as np
-import pandas as pd
 import uuid
-import urllib
 import tempfile
 import yaml
-from filelock import FileLock
-import subprocess
-import bgzip
-from gnali.exceptions import EmptyFileError, TBIDownloadError, \
+from concurrent.futures import ThreadPoolExecutor
+# pandas, numpy, pybiomart and filelock are imported in the functions
+# using them: they are slow to import and not needed to parse the
+# command line
+from gnali.exceptions import EmptyFileError, \
                              InvalidConfigurationError, InvalidFilterError, \
-                             NoVariantsAvailableError
-from gnali.filter import Filter
+                             NoVariantsAvailableError, GeneIndexError
+from gnali.filter import Filter, parse_info_types
 from gnali.variants import Variant, Gene
 from gnali.dbconfig import Config, RuntimeConfig, create_template
+from gnali.gene_index import GeneIndex, index_gene_locations
+from gnali.regions import plan_regions
 import gnali.outputs as outputs
-from gnali.vep import VEP
-from gnali.gnali_get_data import verify_files_present
-from gnali.files import download_file
+from gnali.vep import VEP, add_annotation, record_key
+from gnali.annotation_cache import AnnotationCache
+from gnali.remote_cache import RemoteIndexCache
+from gnali.region_cache import RegionCache
+from gnali.local_cache import LocalFileCache
+from gnali.environment import get_loftee_version, verify_files_present
+from gnali.files import TabixHandles, build_index, compress_vcf
 from gnali.logging import Logger
-import pkg_resources
 
 SCRIPT_NAME = 'gNALI'
 SCRIPT_INFO = "Given a list of genes to test, gNALI finds all potential \
@@ -51,6 +55,22 @@ SCRIPT_INFO = "Given a list of genes to test, gNALI finds all potential \
 GNALI_PATH = Path(__file__).parent.absolute()
 DATA_PATH = "{}/data".format(str(GNALI_PATH))
 DB_CONFIG_FILE = "{}/db-config.yaml".format(str(DATA_PATH))
+RESULTS_BASIC_FILE = "Nonessential_Host_Genes_(Basic).txt"
+RESULTS_DETAILED_FILE = "Nonessential_Host_Genes_(Detailed).txt"
+RESULTS_VCF_FILE = "Nonessential_Gene_Variants.vcf"
+RUN_METADATA_FILE = "run_metadata.yaml"
+# Columns of the detailed output taken from the VCF record
+RECORD_COLUMNS = ["Chromosome", "Position_Start", "RSID",
+                  "Reference_Allele", "Alternate_Allele",
+                  "Score", "Quality"]
+# Columns of the detailed output taken from the transcript annotation,
+# and the annotation fields (by position) they are taken from
+ANNOTATION_COLUMNS = ["LoF_Variant", "LoF_Annotation", "HGNC_Symbol",
+                      "Ensembl Code", "HGVSc"]
+ANNOTATION_FIELDS = [0, 1, 3, 4, 10]
+# Parsed configuration files, by path, with the modification time
+# and size of the file they were parsed from
+parsed_configs = {}
 
 
 def open_test_file(input_file):
@@ -86,6 +106,7 @@ def get_human_genes(db_info):
     Args:
         db_info: RuntimeConfig object with database info
     """
+    from pybiomart import Server
     reference = db_info.ref_genome_path
     server = Server(host=reference)
     dataset = (server.marts['ENSEMBL_MART_ENSEMBL']
@@ -101,61 +122,115 @@ def get_human_genes(db_info):
     return genes
 
 
-def get_test_gene_descriptions(genes, db_info, logger, verbose_on):
-    """Filter Ensembl human genes for info related to test genes.
+def load_gene_index(db_info, refresh=False):
+    """Get the local gene-coordinate index for the database's
+        reference genome. The index is built from Ensembl if
+        it doesn't exist yet, and rebuilt when it is older than
+        the configured TTL or a refresh is requested. If Ensembl
+        can't be reached, an existing (stale) index is used.
+
+    Args:
+        db_info: RuntimeConfig object with database info
+        refresh: whether or not to force a rebuild of the index
+    """
+    gene_index = GeneIndex(db_info.ref_genome_name, db_info.ref_genome_path)
+    if not refresh and not gene_index.needs_refresh(db_info.gene_index_ttl):
+        return gene_index
+
+    from filelock import FileLock
+    Path(gene_index.path).parent.mkdir(parents=True, exist_ok=True)
+    lock = FileLock(gene_index.lock_path)
+    with lock.acquire(timeout=600):
+        # another process may have built the index while we waited
+        if not refresh and \
+           not gene_index.needs_refresh(db_info.gene_index_ttl):
+            return gene_index
+        try:
+            gene_index.build(get_human_genes(db_info))
+        except Exception as error:
+            if gene_index.get_meta() is None:
+                raise GeneIndexError("could not build gene index for {} "
+                                     "from {}: {}"
+                                     .format(db_info.ref_genome_name,
+                                             db_info.ref_genome_path,
+                                             error))
+            print("Could not refresh gene index for {} from {}, using "
+                  "existing index".format(db_info.ref_genome_name,
+                                          db_info.ref_genome_path))
+    return gene_index
+
+
+def get_test_gene_descriptions(genes, db_info, logger, verbose_on,
+                               refresh_index=False, gene_descriptions=None):
+    """Look up test genes in the local gene index.
 
     Args:
         genes: list of Gene objects
         db_info: RuntimeConfig object with database info
         logger: Logger object
         verbose_on: boolean for verbose mode
+        refresh_index: whether or not to rebuild the gene index
+                       from Ensembl before use
+        gene_descriptions: gene coordinates already looked up for
+                           a superset of the genes (ex. by gnali
+                           batch), the gene index is queried if None
+
+    Returns:
+        the genes, their coordinates, and their locations by symbol
+        from index_gene_locations()
     """
-    gene_descriptions = get_human_genes(db_info)
-    gene_descriptions.columns = ['hgnc_symbol', 'chromosome_name',
-                                 'start_position', 'end_position']
-    gene_descriptions = gene_descriptions[~gene_descriptions['chromosome_name']
-                                          .str.contains('PATCH')]
     target_gene_names = [gene.name for gene in genes]
-    gene_descriptions = gene_descriptions[(gene_descriptions['hgnc_symbol']
-                                          .isin(target_gene_names))]
-
-    gene_descriptions.reset_index(drop=True, inplace=True)
-
-    unavailable_genes = [gene for gene in target_gene_names if gene not in
-                         list(gene_descriptions['hgnc_symbol'])]
+    if gene_descriptions is None:
+        gene_index = load_gene_index(db_info, refresh_index)
+        gene_descriptions = gene_index.query(target_gene_names)
+    else:
+        # rows keep the gene index's order, as if queried directly
+        gene_descriptions = gene_descriptions[
+            gene_descriptions['hgnc_symbol'].isin(target_gene_names)] \
+            .reset_index(drop=True)
+
+    found_genes = set(gene_descriptions['hgnc_symbol'])
+    unavailable_genes = [gene for gene in dict.fromkeys(target_gene_names)
+                         if gene not in found_genes]
+    locations, duplicate_genes = index_gene_locations(gene_descriptions)
 
     for gene in genes:
-        if gene.name in unavailable_genes:
+        if gene.name not in found_genes:
             gene.set_status("Unknown gene")
-            continue
 
     if len(unavailable_genes) > 0 and verbose_on:
         logger.write("Genes not available in Ensembl {} database (skipping):"
                      .format(db_info.ref_genome_name))
         for gene in unavailable_genes:
             logger.write(gene)
+    if len(duplicate_genes) > 0 and verbose_on:
+        logger.write("Genes with several loci in Ensembl {} database "
+                     "(using the first locus):"
+                     .format(db_info.ref_genome_name))
+        for gene in duplicate_genes:
+            logger.write(gene)
 
-    return genes, gene_descriptions
+    return genes, gene_descriptions, locations
 
 
-def find_test_locations(genes, gene_descs, db_info):
-    """Using results from the Ensembl database, build a list of target genes.
+def find_test_locations(genes, gene_descs, db_info, locations=None):
+    """Using gene coordinates from the gene index, set the location
+        of every target gene.
 
     Args:
         genes: list of Gene objects
-        gene_descriptions: results from Ensembl database
-                           from get_test_gene_descriptions()
+        gene_descs: gene coordinates from get_test_gene_descriptions()
         db_info: RuntimeConfig object
+        locations: locations by symbol from get_test_gene_descriptions(),
+                   built from gene_descs if None
     """
+    if locations is None:
+        locations, _ = index_gene_locations(gene_descs)
     # Format targets for Tabix
     prefix = "chr" if db_info.ref_genome_name == "GRCh38" else ""
     for gene in genes:
         if gene.status is None:
-            index = gene_descs.index[gene_descs.hgnc_symbol == gene.name][0]
-            chrom = gene_descs.loc[gene_descs.index[index], 'chromosome_name']
-            start = gene_descs.loc[gene_descs.index[index], 'start_position']
-            end = gene_descs.loc[gene_descs.index[index], 'end_position']
-
+            chrom, start, end = locations[gene.name]
             gene.set_location(location="{prefix}{}:{}-{}"
                                        .format(chrom, start, end,
                                                prefix=prefix))
@@ -163,6 +238,28 @@ def find_test_locations(genes, gene_descs, db_info):
     return genes
 
 
+def read_config_file(config_file):
+    """Read a configuration file. Files are only parsed again
+        when their modification time or size changes.
+
+    Args:
+        config_file: config file (.yaml) path
+
+    Returns:
+        a copy of the parsed file, that can be modified
+    """
+    stat = os.stat(config_file)
+    source = (stat.st_mtime_ns, stat.st_size)
+    key = os.path.abspath(config_file)
+    cached = parsed_configs.get(key)
+    if cached is None or cached[0] != source:
+        with open(config_file, 'r') as config_stream:
+            config = yaml.load(config_stream.read(), Loader=yaml.FullLoader)
+        cached = (source, config)
+        parsed_configs[key] = cached
+    return copy.deepcopy(cached[1])
+
+
 def get_db_config(config_file, db):
     """Read and parse the database configuration file.
 
@@ -171,11 +268,9 @@ def get_db_config(config_file, db):
         db: database whose config we want to use
     """
     try:
-        with open(config_file, 'r') as config_stream:
-            db_config = Config(db, yaml.load(config_stream.read(),
-                               Loader=yaml.FullLoader))
-            db_config.validate_config()
-            return db_config
+        db_config = Config(db, read_config_file(config_file))
+        db_config.validate_config()
+        return db_config
 
     except InvalidConfigurationError:
         raise
@@ -232,41 +327,19 @@ def transform_filters(db_config, pre_filters, add_filters):
     return filter_objs
 
 
-def tbi_needed(url, dest_path):
-    """Given a tbi url, determine if we must download it.
-        We will download it if it does not yet exist or it
-        exists but the size is not what we expect based on
-        the header info.
-
-    Args:
-        url: tbi url
-        dest_path: path of expected tbi
-    """
-    try:
-        url_req = urllib.request.Request(url, method='HEAD')
-        url_f = urllib.request.urlopen(url_req)
-        file_size = int(url_f.headers['Content-Length'])
-    except (urllib.error.HTTPError, urllib.error.URLError,
-            urllib.error.ContentTooShortError):
-        raise TBIDownloadError("could not get header for .tbi "
-                               "file for {}".format(url))
-    except TimeoutError:
-        raise TimeoutError("could not fetch header for {} \
-              before timeout".format(url))
-    except Exception as error:
-        raise Exception(error)
-    if not Path.is_file(Path(dest_path)) or \
-       file_size != os.path.getsize(dest_path):
-        return True
-    return False
-
-
 def get_db_tbi(file_info, data_path, max_time):
-    """Download the index (.tbi) file for a database.
+    """Get the index (.tbi or .csi) file for a database. Indexes
+        of HTTP databases are kept in the remote index cache, a CSI
+        index is used if the server has no TBI index. Local databases
+        use an up to date index next to them if there is one, their
+        indexes (and compressed copies of uncompressed files) are
+        otherwise kept in the local file cache. Indexes built by
+        gNALI are CSI indexes if the file's index_min_shift is set.
 
     Args:
         file_info: a DataFile object
-        data_path: where to save the index file
+        data_path: where to save the compressed copy and index
+                   of uncompressed HTTP databases
         max_time: maximum time to wait for
                   download. An exception is
                   raised if download doesn't
@@ -277,63 +350,202 @@ def get_db_tbi(file_info, data_path, max_time):
     tbi_path = ''
     if file_info.is_local and not file_info.is_compressed:
         # compress local file to .bgz (required for Tabix)
-        data_bgz = compress_vcf(file_path, data_path, file_name)
+        data_bgz, tbi_path = LocalFileCache().get_compressed(
+            file_path, max_time, file_info.index_min_shift)
         file_info.set_compressed_path(data_bgz)
-        subprocess.run(['tabix', data_bgz])
-        tbi_path = "{}/{}.bgz.tbi".format(data_path, file_name)
 
     elif file_info.is_local and file_info.is_compressed:
-        subprocess.run(['cp', file_info.path, data_path])
-        file_copy = "{}/{}".format(data_path, file_name)
-        subprocess.run(['tabix', file_copy])
-        tbi_path = "{}/{}".format(data_path, file_name)
+        tbi_path = LocalFileCache().get_index(file_path, max_time,
+                                              file_info.index_min_shift)
 
     elif file_info.is_http and file_info.is_compressed:
-        tbi_url = "{}.tbi".format(file_path)
-        tbi_path = "{}/{}.tbi".format(data_path, file_name)
-        tbi_lock_path = "{}.lock".format(tbi_path)
-        # lock access to index file
-        lock = FileLock(tbi_lock_path)
-
-        try:
-            with lock.acquire(timeout=max_time):
-                if tbi_needed(tbi_url, tbi_path):
-                    download_file(tbi_url, tbi_path, max_time)
-        # not able to gain access to index in time
-        except TimeoutError:
-            # download index file to temp directory
-            temp = tempfile.TemporaryDirectory()
-            tbi_path = "{}/{}.tbi".format(temp.name, file_name)
-            download_file(tbi_url, tbi_path, max_time)
-        except Exception as error:
-            raise Exception(error)
+        remote_cache = RemoteIndexCache(ttl=file_info.index_ttl)
+        tbi_path = remote_cache.get_index(file_path, max_time)
 
     elif file_info.is_http and not file_info.is_compressed:
-        local_path = "{}/{}".format(data_path, file_name)
-        download_file(file_path, local_path, max_time)
-        data_bgz = compress_vcf(local_path, data_path, file_name)
+        # compress straight from the server, without a local copy
+        data_bgz = compress_vcf(file_path, data_path, file_name, max_time)
         file_info.set_compressed_path(data_bgz)
-        subprocess.run(['tabix', data_bgz])
-        tbi_path = "{}/{}.bgz.tbi".format(data_path, file_name)
+        tbi_path = build_index(data_bgz, min_shift=file_info.index_min_shift)
 
     return tbi_path
 
 
-def compress_vcf(path, data_path, file_name):
-    data_bgz = None
-    with open(path, 'rb') as data_stream:
-        data_bgz = "{}/{}.bgz".format(data_path, file_name)
-        with open(data_bgz, 'wb') as bgz_stream:
-            with bgzip.BGZipWriter(bgz_stream) as fh:
-                fh.writelines(data_stream.readlines())
-    return data_bgz
+def iter_tasks(function, items, workers, executor=None):
+    """Call a function on every item, on a pool of worker threads
+        if more than one worker is requested. Results are yielded
+        in the order of the items, whatever order they finish in,
+        and only a few items per worker are in flight at once.
+
+    Args:
+        function: function taking a single item
+        items: list of items
+        workers: number of worker threads
+        executor: optional long-lived ThreadPoolExecutor to run
+                  the tasks on instead of a new pool (ex. the query
+                  server's, whose threads keep their Tabix handles)
+    """
+    if workers is None or workers <= 1 or len(items) <= 1:
+        for item in items:
+            yield function(item)
+        return
+    items = iter(items)
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = deque(executor.submit(function, item) for item
+                        in itertools.islice(items, workers * 2))
+        while pending:
+            result = pending.popleft().result()
+            for item in itertools.islice(items, 1):
+                pending.append(executor.submit(function, item))
+            yield result
+    finally:
+        if own_executor:
+            executor.shutdown(wait=True)
+
+
+def run_tasks(function, items, workers, executor=None):
+    """Call a function on every item, on a pool of worker threads
+        if more than one worker is requested. Results are returned
+        in the order of the items, whatever order they finish in.
+
+    Args:
+        function: function taking a single item
+        items: list of items
+        workers: number of worker threads
+        executor: optional ThreadPoolExecutor (see iter_tasks())
+    """
+    return list(iter_tasks(function, items, workers, executor))
+
+
+def process_region(region, records, annot_header, lof_index, db_info,
+                   filter_objs):
+    """Assign the records fetched for a region to the region's genes
+        and filter them. Gene statuses are set on stand-in genes, so
+        that regions can be processed in parallel and merged into the
+        real genes in a fixed order.
+
+    Args:
+        region: Region object
+        records: VCF records of the region as strings
+        annot_header: VCF header line of loss-of-function annotations
+        lof_index: index of loss-of-function indicator in header
+        db_info: configuration of database
+        filter_objs: list of all (predefined and additional)
+                        filters as Filter objects
+
+    Returns:
+        list of (gene, variants passing filtering, status) tuples
+    """
+    region_genes = region.get_genes()
+
+    # parse each record once, then copy it for every
+    # other gene it overlaps
+    gene_records = {gene: [] for gene in region_genes}
+    for record, rec_genes in region.assign_records(records):
+        variant = Variant(rec_genes[0].name, record,
+                          db_info.lof['id'],
+                          db_info.lof['annot'], annot_header)
+        gene_records[rec_genes[0]].append(variant)
+        for gene in rec_genes[1:]:
+            gene_records[gene].append(variant.for_gene(gene.name))
+
+    # filter records
+    stand_ins = [Gene(gene.name) for gene in region_genes]
+    passed = []
+    for gene in region_genes:
+        records = filter_plof(stand_ins, gene_records[gene],
+                              db_info, lof_index)
+        records = apply_filters(stand_ins, records, db_info, filter_objs)
+        passed.append(records)
+    return [(gene, records, stand_in.status) for gene, records, stand_in
+            in zip(region_genes, passed, stand_ins)]
+
+
+def get_annotation_index(header, db_info):
+    """Find the loss-of-function annotation header line and the
+        index of the loss-of-function indicator in it.
+
+    Args:
+        header: VCF header lines
+        db_info: configuration of database
+    """
+    annot_header = [line for line in header
+                    if "ID={}".format(db_info.lof['id'])
+                    in line][0]
+    lof_index = annot_header.split("|").index(db_info.lof['annot'])
+    return annot_header, lof_index
+
+
+def open_db_files(db_info, data_path, workers, max_time=180):
+    """Get the index of every file of a database and open it with
+        Tabix. Files are opened concurrently.
+
+    Args:
+        db_info: configuration of database
+        data_path: where to save the compressed copy and index
+                   of uncompressed HTTP databases
+        workers: number of worker threads
+        max_time: maximum time to wait for an index
+
+    Returns:
+        list of (TabixHandles, VCF header, RegionCache or None)
+        tuples, in the order of the database's files
+    """
+    def open_data_file(data_file):
+        tbi = None
+        handles = None
+        region_cache = None
+        # for files that are local (vcf and vcf.bgz), or HTTP vcf
+        if data_file.is_local or not data_file.is_compressed:
+            tbi = get_db_tbi(data_file, data_path, max_time)
+            handles = TabixHandles(data_file.compressed_path, tbi)
+        # for files that are HTTP vcf.bgz
+        else:
+            tbi = get_db_tbi(data_file, DATA_PATH, max_time)
+            handles = TabixHandles(data_file.path, tbi)
+            if db_info.region_cache_size:
+                region_cache = RegionCache(data_file.path, tbi,
+                                           db_info.region_cache_size)
+        data_file.set_index_path(tbi)
+        return handles, handles.get().header, region_cache
+
+    return run_tasks(open_data_file, db_info.files,
+                     max(workers or 1, len(db_info.files)))
+
+
+def fetch_records(opened_file, region):
+    """Fetch the records of a region from a database file, through
+        the file's region cache if it has one. Raises a ValueError if
+        the region's contig does not exist in the file.
+
+    Args:
+        opened_file: tuple from open_db_files()
+        region: Region object
+    """
+    handles, _, region_cache = opened_file
+    records = None
+    if region_cache is not None:
+        records = region_cache.get(region.contig, region.start, region.end)
+    if records is None:
+        records = list(handles.get().fetch(reference=str(region)))
+        if region_cache is not None:
+            region_cache.put(region.contig, region.start, region.end,
+                             records)
+    return records
 
 
 def get_variants(genes, db_info, filter_objs, output_dir,
-                 logger, verbose_on):
+                 logger, verbose_on, workers=1, on_variants=None,
+                 opened_files=None, executor=None):
     """Query the gnomAD database for variants with Tabix,
         apply loss-of-function filters, user-specified predefined
         filters, and user-specified additional filters.
+        For databases without loss-of-function annotations, the
+        records of all genes and files are annotated in a single
+        VEP/LOFTEE run.
 
     Args:
         genes: list of Gene objects
@@ -343,78 +555,153 @@ def get_variants(genes, db_info, filter_objs, output_dir,
         output_dir: directory to write output to
         logger: Logger object to log errors to
         verbose_on: boolean for verbose mode
+        workers: number of worker threads used to fetch and
+                 filter regions (at least one per database file),
+                 also used as the number of forked VEP processes
+        on_variants: optional function called with (gene, variants,
+                     header, region) as soon as the variants of a gene
+                     from one database file are ready, instead of
+                     adding them to the gene (see stream_results()).
+                     All calls for a region are made before the next
+                     region's
+        opened_files: database files already opened with
+                      open_db_files(), which are then left open
+                      (ex. shared by the jobs of gnali batch)
+        executor: optional long-lived ThreadPoolExecutor regions
+                  are fetched on (see iter_tasks())
     """
-    variants = np.array([])
-    max_time = 180
     header = None
-    temp_dir = tempfile.TemporaryDirectory()
-    temp_name = "{}/".format(temp_dir.name)
+    lof_statuses = ["HC LoF found", "HC LoF found, failed filtering"]
 
     # Tracks if gene was found in any database file
     coverage = {gene.name: False for gene in genes}
+    genes_by_name = {}
+    for gene in genes:
+        genes_by_name.setdefault(gene.name, []).append(gene)
+    # Overlapping and adjacent genes are fetched together
+    regions = plan_regions(genes)
 
-    for data_file in db_info.files:
-        tbi = None
-        tbx = None
-        # for files that are local (vcf and vcf.bgz), or HTTP vcf
-        if data_file.is_local or not data_file.is_compressed:
-            tbi = get_db_tbi(data_file, temp_name, max_time)
-            tbx = pysam.TabixFile(data_file.compressed_path,
-                                  index=tbi)
-        # for files that are HTTP vcf.bgz
-        else:
-            tbi = get_db_tbi(data_file, DATA_PATH, max_time)
-            tbx = pysam.TabixFile(data_file.path, index=tbi)
-        header = tbx.header
-
-        # get records in locations
-        for gene in genes:
-            if gene.location is None:
+    def fetch_region(task):
+        file_index, region = task
+        try:
+            records = fetch_records(opened_files[file_index], region)
+        except ValueError as error:
+            # ValueError means that location used in TabixFile.fetch()
+            # does not exist in the database
+            return None, error
+        if db_info.has_lof_annots:
+            annot_header, lof_index = annotation_indexes[file_index]
+            return process_region(region, records, annot_header,
+                                  lof_index, db_info, filter_objs), None
+        return records, None
+
+    def annotate_region(task_result):
+        (_, region), (records, error) = task_result
+        if error is not None:
+            return None, error
+        records = [add_annotation(record, db_info.lof['id'],
+                                  annotations[record_key(record)])
+                   for record in records
+                   if annotations.get(record_key(record)) is not None]
+        annot_header, lof_index = annotation_index
+        return process_region(region, records, annot_header, lof_index,
+                              db_info, filter_objs), None
+
+    def merge_results(task_results):
+        # merge results into genes in region and file order,
+        # returns whether any region could be fetched
+        fetched = False
+        for (file_index, region), (results, error) in task_results:
+            if error is not None:
+                if verbose_on:
+                    for gene in region.get_genes():
+                        logger.write("Error for gene {}: {}, it is likely "
+                                     "that the region does not exist in "
+                                     "file '{}' in database {}"
+                                     .format(gene.name, error,
+                                             db_info.files[file_index].name,
+                                             db_info.name))
                 continue
-            try:
-                records = tbx.fetch(reference=gene.location)
+            fetched = True
+            for gene, records, status in results:
                 coverage[gene.name] = True
+                if on_variants is not None:
+                    on_variants(gene, records, header, region)
+                else:
+                    gene.add_variants(records)
+                if status in lof_statuses:
+                    for same_gene in genes_by_name[gene.name]:
+                        same_gene.set_status(status)
+        return fetched
+
+    # Database files are always queried concurrently, their indexes
+    # are fetched in parallel and their regions share one pool
+    file_workers = max(workers or 1, len(db_info.files))
+    shared_files = opened_files is not None
+    if not shared_files:
+        opened_files = []
+    tasks = [(file_index, region)
+             for region in regions
+             for file_index in range(len(db_info.files))]
+    try:
+        if not shared_files:
+            temp_dir = tempfile.TemporaryDirectory()
+            opened_files = open_db_files(db_info,
+                                         "{}/".format(temp_dir.name),
+                                         workers)
+        if len(opened_files) > 0:
+            header = opened_files[-1][1]
+        # compile filters with the INFO types declared by the files
+        info_types = {}
+        for _, file_header, _ in opened_files:
+            info_types.update(parse_info_types(file_header))
+        filter_objs = [copy.copy(filter_obj) for filter_obj in filter_objs]
+        for filter_obj in filter_objs:
+            filter_obj.compile(info_types)
+        annotation_index = (None, None)
+        if db_info.has_lof_annots:
+            annotation_indexes = [get_annotation_index(file_header, db_info)
+                                  for _, file_header, _ in opened_files]
+            # results are merged while later regions are still fetched
+            any_fetched = merge_results(zip(tasks, iter_tasks(
+                fetch_region, tasks, file_workers, executor)))
+        else:
+            region_results = run_tasks(fetch_region, tasks, file_workers,
+                                       executor)
+    except Exception as error:
+        print(error)
+        raise
+    finally:
+        if not shared_files:
+            for handles, _, _ in opened_files:
+                handles.close()
+
+    if not db_info.has_lof_annots:
+        # annotate records of all genes and files in one VEP run
+        to_annotate = [record for records, error in region_results
+                       if error is None for record in records]
+        annotations = {}
+        if len(to_annotate) > 0:
+            cache = AnnotationCache(db_info.ref_genome_name,
+                                    db_info.vep_version,
+                                    get_loftee_version(
+                                        db_info.ref_genome_name))
+            header, annotations = VEP.annotate_records(header, to_annotate,
+                                                       db_info, workers,
+                                                       cache)
+            annotation_index = get_annotation_index(header, db_info)
+        any_fetched = merge_results(zip(tasks, iter_tasks(
+            annotate_region, list(zip(tasks, region_results)), workers,
+            executor)))
 
-                if not db_info.has_lof_annots:
-                    header, variants = VEP.annotate_vep_loftee(header,
-                                                               variants,
-                                                               db_info)
-
-                lof_index = None
-                # get index of LoF in header
-                annot_header = [line for line in header
-                                if "ID={}".format(db_info.lof['id'])
-                                in line][0]
-                lof_index = annot_header.split("|") \
-                    .index(db_info.lof['annot'])
-
-                # update to convert to Variants before filter calls
-                records = [Variant(gene.name, record, db_info.lof['id'],
-                           db_info.lof['annot'], annot_header) for
-                           record in records]
-
-                # filter records
-                records = filter_plof(genes, records, db_info, lof_index)
-                records = apply_filters(genes, records, db_info, filter_objs)
-                gene.add_variants(records)
-
-            except ValueError as error:
-                # ValueError means that location used in TabixFile.fetch()
-                # does not exist in the database
-                if verbose_on:
-                    logger.write("Error for gene {}: {}, it is likely that "
-                                 "the region does not exist in file '{}' "
-                                 "in database {}"
-                                 .format(gene.name, error, data_file.name,
-                                         db_info.name))
-            except Exception as error:
-                print(error)
-                raise
-
-    # Set error status for gene if it wasn't found in any database file
     for gene in genes:
-        if not coverage[gene.name] and gene.status is None:
-            gene.set_status("No variants in database")
+        if gene.status is None:
+            # Set error status for gene if it wasn't found in any
+            # database file
+            if any_fetched:
+                gene.set_status("No HC LoF found")
+            elif not coverage[gene.name]:
+                gene.set_status("No variants in database")
 
     return header
 
@@ -501,7 +788,8 @@ def filter_plof(genes, records, db_info, lof_index):
     return passed_variants
 
 
-def extract_lof_annotations(genes, db_info, get_pop_freqs):
+def extract_lof_annotations(genes, db_info, get_pop_freqs,
+                            info_types=None):
     """Take the variants returned from get_variants() and
         organize them into dataframes, then extract the
         loss-of-function annotations.
@@ -511,88 +799,155 @@ def extract_lof_annotations(genes, db_info, get_pop_freqs):
         db_info: database configuration object
         get_pop_freqs: whether or not we additionaly get the
                         population frequencies
+        info_types: INFO field types for typed results
+                    (see build_results())
     """
-    variants = sum([gene.variants for gene in genes], [])
-    variant_records = [variant.record_str for variant in variants]
+    variants = [variant for gene in genes for variant in gene.variants]
     # Remove duplicate VCF records, this can happen with overlapping genes
-    results_as_vcf = list(dict.fromkeys(variant_records))
-    variant_tuples = []
+    results_as_vcf = list(dict.fromkeys(variant.record_str
+                                        for variant in variants))
+    results = build_results(variants, db_info, get_pop_freqs, info_types)
+    return results, results_as_vcf
+
 
+def build_results(variants, db_info, get_pop_freqs, info_types=None,
+                  allow_empty=False):
+    """Build the detailed results table of a list of variants,
+        with one row per transcript. Raises a NoVariantsAvailableError
+        if there are no transcripts, unless allow_empty is set.
+
+    Args:
+        variants: list of Variant objects
+        db_info: database configuration object
+        get_pop_freqs: whether or not we additionaly get the
+                        population frequencies
+        info_types: if given, INFO field types from parse_info_types(),
+                    positions, scores and population frequencies are
+                    then numbers instead of strings (for Parquet and
+                    Arrow output)
+        allow_empty: whether or not to return an empty table, with
+                     the same columns and types as a non-empty one,
+                     if there are no transcripts
+    """
+    import pandas as pd
+    # Fill columns in one pass, one row per transcript
+    record_columns = [[] for _ in RECORD_COLUMNS]
+    annotation_columns = [[] for _ in ANNOTATION_COLUMNS]
     for variant in variants:
+        num_transcripts = len(variant.transcripts)
+        if num_transcripts == 0:
+            continue
+        for column, value in zip(record_columns,
+                                 variant.as_tuple_basic()):
+            column.extend([value] * num_transcripts)
         for trans in variant.transcripts:
-            variant_tuples.append(variant.as_tuple_basic() +
-                                  (str(trans),))
-    results = np.asarray(variant_tuples, dtype=str)
-    results = pd.DataFrame(data=results)
+            fields = str(trans).split("|", ANNOTATION_FIELDS[-1] + 1)
+            for column, index in zip(annotation_columns, ANNOTATION_FIELDS):
+                column.append(fields[index] if index < len(fields)
+                              else None)
 
-    if len(results.columns) == 1:
+    if len(record_columns[0]) == 0 and not allow_empty:
         raise NoVariantsAvailableError
 
-    # Name columns
-    results.columns = ["Chromosome", "Position_Start", "RSID",
-                       "Reference_Allele", "Alternate_Allele",
-                       "Score", "Quality", "VEP"]
+    results = pd.DataFrame(dict(zip(RECORD_COLUMNS + ANNOTATION_COLUMNS,
+                                    record_columns + annotation_columns)),
+                           columns=RECORD_COLUMNS + ANNOTATION_COLUMNS,
+                           dtype=object)
 
-    # Get LoF annotations from VEP field
-    results_codes = pd.DataFrame(results['VEP'].str.split('|', 5).tolist(),
-                                 columns=["LoF_Variant", "LoF_Annotation",
-                                          "Confidence", "HGNC_Symbol",
-                                          "Ensembl Code", "Rest"])
-    results_codes['HGVSc'] = results_codes.Rest.str.split("|", 6).str[5]
-
-    results_codes.drop('Rest', axis=1, inplace=True)
-    results_codes.drop('Confidence', axis=1, inplace=True)
-    results.drop('VEP', axis=1, inplace=True)
-    results = pd.concat([results, results_codes], axis=1)
+    if info_types is not None:
+        results['Position_Start'] = results['Position_Start'] \
+            .astype('int64')
+        results['Score'] = pd.to_numeric(results['Score'], errors='coerce') \
+            .astype('float64')
 
     if get_pop_freqs:
-        pop_freqs = extract_pop_freqs(variants, db_info)
-        results = results.merge(pop_freqs, left_index=True, right_index=True)
+        numeric = info_types is not None
+        pop_freqs = extract_pop_freqs(variants, db_info, numeric)
+        if numeric:
+            for name, group in db_info.population_frequencies.items():
+                if info_types.get(group, (None, None))[1] == 'Integer':
+                    pop_freqs[name] = pop_freqs[name].round() \
+                        .astype('Int64')
+        results = pd.concat([results, pop_freqs], axis=1)
 
-    return results, results_as_vcf
+    return results
 
 
-def extract_pop_freqs(variants, config):
+def stream_results(writer, db_info, get_pop_freqs, typed=False):
+    """Get a get_variants() callback that writes the variants of
+        each gene to the output files as soon as they are ready.
+
+    Args:
+        writer: outputs.StreamWriter object
+        db_info: database configuration object
+        get_pop_freqs: whether or not we additionaly get the
+                        population frequencies
+        typed: whether or not results are typed (see build_results())
+    """
+    # INFO field types are parsed once per header,
+    # all genes of a query share the same header
+    last_header = None
+    info_types = None
+
+    def on_variants(gene, variants, header, region=None):
+        nonlocal last_header, info_types
+        if sum(variant.num_transcripts() for variant in variants) == 0:
+            return
+        if typed and header is not last_header:
+            last_header = header
+            info_types = parse_info_types(header)
+        writer.append_results(build_results(variants, db_info,
+                                            get_pop_freqs, info_types))
+        writer.append_vcf(header, [variant.record_str
+                                   for variant in variants], region)
+    return on_variants
+
+
+def extract_pop_freqs(variants, config, numeric=False):
     """Get population frequencies for variants that passed filtering.
+        Each variant has one row per transcript.
 
     Args:
         variants: list of variants as Variant objects
         config: database config as Config object
+        numeric: if True, columns are numbers (NaN if missing),
+                 otherwise they are strings as written to the
+                 detailed output ('-' if missing, allele frequencies
+                 in exponential form)
     """
-    # Make a tuple list from the population-frequencies section
-    # in config file
+    import numpy as np
+    import pandas as pd
     pop_groups = config.population_frequencies
+    num_transcripts = np.fromiter((variant.num_transcripts()
+                                   for variant in variants),
+                                  dtype=np.int64, count=len(variants))
+
+    columns = {}
+    for name, group in pop_groups.items():
+        values = pd.Series([variant.info.get(group) for variant in variants],
+                           dtype=object)
+        values = values.str.rstrip("\n")
+        missing = values.isna()
+        numbers = pd.to_numeric(values, errors='coerce')
+        if numeric:
+            column = numbers.to_numpy(dtype=float)
+        elif "AF" in group:
+            # Convert allele frequencies to exponential form
+            column = np.char.mod('%.10e', numbers.to_numpy(dtype=float)) \
+                .astype(object)
+            column[(missing | numbers.isna()).to_numpy()] = '-'
+        else:
+            column = values.to_numpy(dtype=object)
+            column[missing.to_numpy()] = '-'
+        columns[name] = np.repeat(column, num_transcripts)
 
-    num_transcripts = [variant.num_transcripts() for variant in variants]
-    total_transcripts = sum(num_transcripts)
-
-    pop_freqs = np.empty(shape=(total_transcripts, len(pop_groups)),
-                         dtype='str')
-    pop_freqs = pd.DataFrame(data=pop_freqs)
-
-    # Fill array with population frequencies by variant
-    for col, group in enumerate(list(pop_groups.values())):
-        row = 0
-        for index, variant in enumerate(variants):
-            if group in variant.info:
-                val = variant.info[group]
-                # Convert allele frequencies to exponential form
-                if "AF" in group:
-                    val = '{:.10e}'.format(float(val))
-                for i in range(0, num_transcripts[index]):
-                    pop_freqs.loc[row, col] = str(val)
-                    row += 1
-            else:
-                for i in range(0, num_transcripts[index]):
-                    pop_freqs.loc[row, col] = '-'
-                    row += 1
-
-    pop_freqs.columns = list(pop_groups.keys())
-    return pop_freqs
+    return pd.DataFrame(columns, columns=list(pop_groups.keys()),
+                        index=pd.RangeIndex(num_transcripts.sum()))
 
 
 def write_results_all(results, genes, header,
-                      results_as_vcf, results_dir, keep_vcf):
+                      results_as_vcf, results_dir, keep_vcf,
+                      output_format='tsv', vcf_format='vcf'):
     """ Write output files:
         - A detailed report outlining the gene variants
         - A basic report listing only the genes with
@@ -607,39 +962,130 @@ def write_results_all(results, genes, header,
         results_as_vcf: records as VCF from get_variants()
         results_dir: directory containing all gNALI results
         keep_vcf: whether or not we create an additional vcf output
+        output_format: format of the detailed output,
+                       one of outputs.RESULTS_FORMATS
+        vcf_format: format of the vcf output, one of outputs.VCF_FORMATS
     """
     write_results_basic(genes, results_dir)
-    write_results_detailed(results, results_dir)
+    write_results_detailed(results, results_dir, output_format)
     if keep_vcf:
-        write_results_vcf(header, results_as_vcf, results_dir)
+        write_results_vcf(header, results_as_vcf, results_dir, vcf_format)
 
 
 def write_results_basic(genes, results_dir):
-    results_basic_file = "Nonessential_Host_Genes_(Basic).txt"
-    results_basic_path = "{}/{}".format(results_dir,
-                                        results_basic_file)
+    import pandas as pd
+    results_basic_path = "{}/{}".format(results_dir, RESULTS_BASIC_FILE)
     data = [[gene.name, gene.status] for gene in genes]
     results_basic = pd.DataFrame(data, columns=['HGNC_Symbol', 'Status'])
     outputs.write_to_tab(results_basic_path, results_basic)
 
 
-def write_results_detailed(results, results_dir):
-    results_file = "Nonessential_Host_Genes_(Detailed).txt"
-    results_path = "{}/{}".format(results_dir, results_file)
-    outputs.write_to_tab(results_path, results)
+def write_run_metadata(db_info, results_dir):
+    """Write the database and the index of each database file
+        used for a run.
+
+    Args:
+        db_info: configuration of database
+        results_dir: output directory
+    """
+    metadata = {'database': db_info.name,
+                'files': {data_file.name: {'path': data_file.path,
+                                           'index': data_file.index_path,
+                                           'index_type': data_file.index_type}
+                          for data_file in db_info.files}}
+    metadata_path = "{}/{}".format(results_dir, RUN_METADATA_FILE)
+    with open(metadata_path, 'w') as stream:
+        yaml.dump(metadata, stream, default_flow_style=False,
+                  sort_keys=False)
+
+
+def write_results_detailed(results, results_dir, output_format='tsv'):
+    results_path = get_results_detailed_path(results_dir, output_format)
+    outputs.write_to_table(results_path, results, output_format)
+
+
+def write_results_vcf(header, results_as_vcf, results_dir,
+                      vcf_format='vcf'):
+    results_vcf_path = get_results_vcf_path(results_dir, vcf_format)
+    if vcf_format == 'bgz':
+        outputs.write_to_bgzf_vcf(results_vcf_path, header, results_as_vcf)
+    else:
+        outputs.write_to_vcf(results_vcf_path, header, results_as_vcf)
+
+
+def get_results_detailed_path(results_dir, output_format='tsv'):
+    name = RESULTS_DETAILED_FILE.rsplit(".", 1)[0]
+    return "{}/{}.{}".format(results_dir, name,
+                             outputs.RESULTS_FORMATS[output_format])
+
+
+def get_results_vcf_path(results_dir, vcf_format='vcf'):
+    name = RESULTS_VCF_FILE.rsplit(".", 1)[0]
+    return "{}/{}.{}".format(results_dir, name,
+                             outputs.VCF_FORMATS[vcf_format])
+
+
+def get_version():
+    """Get the installed version of gNALI."""
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # Python 3.7
+        import pkg_resources
+        return pkg_resources.require("gnali")[0].version
+    return version("gnali")
 
 
-def write_results_vcf(header, results_as_vcf, results_dir):
-    results_vcf_file = "Nonessential_Gene_Variants.vcf"
-    results_vcf_path = "{}/{}".format(results_dir,
-                                      results_vcf_file)
-    outputs.write_to_vcf(results_vcf_path, header, results_as_vcf)
+class VersionAction(argparse.Action):
+    """Show gNALI's version and exit, as argparse's version action,
+        but only look up the version when it is asked for.
+    """
+    def __init__(self, option_strings, dest=argparse.SUPPRESS,
+                 default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super().__init__(option_strings=option_strings, dest=dest,
+                         default=default, nargs=0, help=help)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        print("{} {}".format(parser.prog, get_version()))
+        parser.exit()
+
+
+class CommandLineParser(argparse.ArgumentParser):
+    """Argument parser whose help lists the databases and predefined
+        filters of gNALI's configuration file. The file is only read
+        when the help is shown, not to parse arguments.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.config_helps = []
+
+    def add_config_help(self, action, help_template):
+        """Set the help of an argument from the configuration file.
+
+        Args:
+            action: action of the argument
+            help_template: help text, formatted with the default
+                           database (default), the list of
+                           databases (databases) and the predefined
+                           filters of each database (filters)
+        """
+        self.config_helps.append((action, help_template))
+
+    def format_help(self):
+        if self.config_helps:
+            config = get_db_config(DB_CONFIG_FILE, '')
+            fields = {'default': config.default,
+                      'databases': [db.name for db in config.configs],
+                      'filters': {db.name: db.predefined_filters
+                                  for db in config.configs}}
+            for action, help_template in self.config_helps:
+                action.help = help_template.format(**fields)
+        return super().format_help()
 
 
 def init_parser(id):
-    parser = argparse.ArgumentParser(prog=SCRIPT_NAME,
-                                     description=SCRIPT_INFO)
-    config = get_db_config(DB_CONFIG_FILE, '')
+    parser = CommandLineParser(prog=SCRIPT_NAME, description=SCRIPT_INFO)
 
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('-i', '--input_file',
@@ -652,35 +1098,56 @@ def init_parser(id):
     parser.add_argument('-f', '--force',
                         action='store_true',
                         help='Force existing output folder to be overwritten')
-    parser.add_argument('-d', '--database',
-                        help='Database to query. Default: {}\nOptions: {}'
-                        .format(config.default,
-                                [db.name for db in config.configs]))
+    parser.add_config_help(
+        parser.add_argument('-d', '--database'),
+        'Database to query. Default: {default}\nOptions: {databases}')
     parser.add_argument('--vcf',
                         help='Generate vcf file for filtered variants',
                         action='store_true')
+    parser.add_argument('--vcf_format',
+                        choices=list(outputs.VCF_FORMATS), default='vcf',
+                        help='Format of the vcf file: plain text, or '
+                             'sorted, BGZF-compressed and Tabix-indexed '
+                             '(bgz). Default: vcf')
+    parser.add_argument('--output_format',
+                        choices=list(outputs.RESULTS_FORMATS),
+                        default='tsv',
+                        help='Format of the detailed output file: '
+                             'tab-separated text, Parquet or Arrow IPC '
+                             '(Parquet and Arrow require pyarrow). '
+                             'Default: tsv')
     parser.add_argument('-v', '--verbose',
                         help='increase verbosity',
                         action='store_true')
-    parser.add_argument('-p', '--predefined_filters',
-                        nargs='*',
-                        help='Predefined filters. To use multiple, '
-                             'separate them by spaces. Options: {}'
-                        .format({db.name: db.predefined_filters
-                                 for db in config.configs}))
+    parser.add_config_help(
+        parser.add_argument('-p', '--predefined_filters',
+                            nargs='*'),
+        'Predefined filters. To use multiple, separate them by spaces. '
+        'Options: {filters}')
     parser.add_argument('-a', '--additional_filters',
                         nargs='*',
                         help='Additional filters. To use multiple, '
                              'separate them by spaces. Please enclose each '
                              'in quotes (ex. "AC>3")')
     parser.add_argument('-V', '--version',
-                        action='version',
-                        version='%(prog)s {}'
-                        .format(pkg_resources.require("gnali")[0].version))
+                        action=VersionAction)
     parser.add_argument('-P', '--pop_freqs',
                         help='Get population frequencies '
                              '(in detailed output file)',
                         action='store_true')
+    parser.add_argument('-w', '--workers',
+                        type=int, default=1,
+                        help='Number of worker threads used to fetch and '
+                             'filter variants. Default: 1')
+    parser.add_argument('-s', '--stream',
+                        help='Write variants to the output files as soon '
+                             'as each gene is done, instead of keeping '
+                             'them all in memory until the end',
+                        action='store_true')
+    parser.add_argument('--refresh_gene_index',
+                        help='Rebuild the local gene index from Ensembl '
+                             'before running',
+                        action='store_true')
     parser.add_argument('-c', '--config',
                         help='Use a custom config file. To get started, '
                              'check out the --config_template commands')
@@ -697,6 +1164,19 @@ def init_parser(id):
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'slice':
+        # imported here, gnali.db_slice builds on this module
+        from gnali import db_slice
+        db_slice.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'batch':
+        from gnali import batch
+        batch.main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        from gnali import server
+        server.main(sys.argv[2:])
+        return
     id = uuid.uuid4()
     arg_parser = init_parser(id)
     if len(sys.argv) == 1:
@@ -704,6 +1184,12 @@ def main():
         arg_parser.exit()
     args = arg_parser.parse_args()
     results_dir = args.output_dir
+    typed_results = args.output_format != 'tsv'
+    if typed_results:
+        try:
+            outputs.import_pyarrow(args.output_format)
+        except ImportError as error:
+            arg_parser.error(str(error))
 
     if args.config_template_grch37:
         create_template('grch37')
@@ -732,9 +1218,10 @@ def main():
 
         logger = Logger(results_dir)
         Path(results_dir).mkdir(parents=True, exist_ok=args.force)
-        genes, gene_descs = get_test_gene_descriptions(genes_data, db_config,
-                                                       logger, args.verbose)
-        genes = find_test_locations(genes, gene_descs, db_config)
+        genes, gene_descs, locations = get_test_gene_descriptions(
+            genes_data, db_config, logger, args.verbose,
+            args.refresh_gene_index)
+        genes = find_test_locations(genes, gene_descs, db_config, locations)
 
         validate_filters(db_config, args.predefined_filters,
                          args.additional_filters)
@@ -742,16 +1229,40 @@ def main():
         filters = transform_filters(db_config, args.predefined_filters,
                                     args.additional_filters)
 
-        header = get_variants(genes,
-                              db_config, filters,
-                              results_dir, logger,
-                              args.verbose)
-
-        results, results_as_vcf = \
-            extract_lof_annotations(genes, db_config, args.pop_freqs)
-
-        write_results_all(results, genes, header,
-                          results_as_vcf, results_dir, args.vcf)
+        if args.stream:
+            writer = outputs.StreamWriter(
+                get_results_detailed_path(results_dir, args.output_format),
+                get_results_vcf_path(results_dir, args.vcf_format)
+                if args.vcf else None,
+                args.output_format, args.vcf_format)
+            try:
+                get_variants(genes, db_config, filters, results_dir, logger,
+                             args.verbose, args.workers,
+                             stream_results(writer, db_config,
+                                            args.pop_freqs, typed_results))
+            finally:
+                writer.close()
+            write_run_metadata(db_config, results_dir)
+            # statuses are only final once all genes are done
+            write_results_basic(genes, results_dir)
+            if writer.num_results == 0:
+                raise NoVariantsAvailableError
+        else:
+            header = get_variants(genes,
+                                  db_config, filters,
+                                  results_dir, logger,
+                                  args.verbose, args.workers)
+            write_run_metadata(db_config, results_dir)
+
+            info_types = parse_info_types(header) if typed_results \
+                else None
+            results, results_as_vcf = \
+                extract_lof_annotations(genes, db_config, args.pop_freqs,
+                                        info_types)
+
+            write_results_all(results, genes, header,
+                              results_as_vcf, results_dir, args.vcf,
+                              args.output_format, args.vcf_format)
 
         print("Finished. Output in {}".format(results_dir))
     except FileExistsError:
@@ -24,7 +24,6 @@ import yaml
 import hashlib
 import gzip
 import shutil
-from filelock import FileLock
 from gnali.exceptions import ReferenceDownloadError
 import gnali.cache as cache
 from gnali.files import download_file
@@ -100,6 +99,7 @@ def download_test_refs():
 
 
 def download_references(assembly):
+    from filelock import FileLock
     max_download_time = 1800
     refs = None
     with open(REFS_PATH, 'r') as config_stream:
@@ -219,9 +219,9 @@ def download_all_refs(assembly):
                           .format(assembly), (assembly,))
 
 
-def verify_files_present(assembly, cache_root_path):
+def verify_files_present(assembly, cache_root_path, vep_version=None):
     # check if cache is present
-    cache.verify_cache(assembly, cache_root_path)
+    cache.verify_cache(assembly, cache_root_path, vep_version)
 
     deps_version_file = Dependencies.files[assembly]
     deps_version = Dependencies.versions[assembly]
@@ -0,0 +1,237 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from gnali.files import INDEX_EXTENSIONS, build_index, compress_vcf
+
+GNALI_PATH = Path(__file__).parent.absolute()
+DATA_PATH = "{}/data".format(str(GNALI_PATH))
+LOCAL_CACHE_PATH = "{}/local-cache".format(DATA_PATH)
+# Bump when the layout of the cache changes, older entries are rebuilt
+LOCAL_CACHE_FORMAT = 2
+# Replaced versions of an entry are kept this long (in seconds)
+# for processes that may still be reading them
+LOCAL_CACHE_GRACE_PERIOD = 24 * 60 * 60
+
+
+class LocalFileCache:
+    """Persistent cache of the compressed copies and indexes of
+        local database files, so they are only built again when a
+        file changes. There is one entry per file path, valid as
+        long as the file's size and modification time are the
+        ones it was built from.
+    """
+    def __init__(self, cache_dir=None):
+        """Args:
+            cache_dir: directory holding the cache
+        """
+        if cache_dir is None:
+            cache_dir = LOCAL_CACHE_PATH
+        self.cache_dir = cache_dir
+
+    def _entry_dir(self, path):
+        digest = hashlib.sha256(str(Path(path).absolute()).encode())
+        return "{}/{}".format(self.cache_dir, digest.hexdigest())
+
+    def get_index(self, path, max_time, min_shift=0):
+        """Get an index for a BGZF-compressed VCF file: an up to
+            date .tbi or .csi index next to it if there is one,
+            otherwise an index built in the cache.
+
+        Args:
+            path: path of the compressed VCF file
+            max_time: maximum time to wait for another gNALI
+                      process building the same index
+            min_shift: min shift of the CSI index built (0 to build
+                       a TBI index, see build_index())
+        """
+        index = find_adjacent_index(path)
+        if index is not None:
+            return index
+
+        def build(build_dir):
+            index = build_index(path, build_dir, min_shift)
+            return {'index': os.path.basename(index)}
+
+        entry_dir, entry = self._get_entry(path, build, max_time,
+                                           {'min_shift': min_shift})
+        return "{}/{}".format(entry_dir, entry['index'])
+
+    def get_compressed(self, path, max_time, min_shift=0):
+        """Get a BGZF-compressed copy of an uncompressed VCF file
+            and its index, built in the cache.
+
+        Args:
+            path: path of the uncompressed VCF file
+            max_time: maximum time to wait for another gNALI
+                      process building the same copy
+            min_shift: min shift of the CSI index built (0 to build
+                       a TBI index, see build_index())
+        """
+        file_name = os.path.basename(path)
+
+        def build(build_dir):
+            data_bgz = compress_vcf(path, build_dir, file_name)
+            index = build_index(data_bgz, build_dir, min_shift)
+            return {'compressed': os.path.basename(data_bgz),
+                    'index': os.path.basename(index)}
+
+        entry_dir, entry = self._get_entry(path, build, max_time,
+                                           {'min_shift': min_shift})
+        return "{}/{}".format(entry_dir, entry['compressed']), \
+            "{}/{}".format(entry_dir, entry['index'])
+
+    def _get_entry(self, path, build, max_time, options):
+        """Get the directory and metadata of the cache entry of a
+            file, building it if there is no entry for the file's
+            current size and modification time, and the given build
+            options. Each build is made in a new version directory
+            of the entry, which entry.json is then atomically
+            switched to. Replaced versions are only removed by later
+            builds, once they are older than LOCAL_CACHE_GRACE_PERIOD,
+            so processes still reading them are not affected.
+        """
+        entry_dir = self._entry_dir(path)
+        source = file_source(path)
+        source.update(options)
+        entry = read_entry(entry_dir, source)
+        if entry is not None:
+            return "{}/{}".format(entry_dir, entry['version']), entry
+
+        from filelock import FileLock
+        Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        lock = FileLock("{}.lock".format(entry_dir))
+        with lock.acquire(timeout=max_time):
+            # another process may have built the entry while we waited
+            entry = read_entry(entry_dir, source)
+            if entry is not None:
+                return "{}/{}".format(entry_dir, entry['version']), entry
+            version = uuid.uuid4().hex
+            version_dir = "{}/{}".format(entry_dir, version)
+            Path(version_dir).mkdir(parents=True)
+            try:
+                entry = build(version_dir)
+            except BaseException:
+                shutil.rmtree(version_dir, ignore_errors=True)
+                raise
+            entry['version'] = version
+            entry.update(source)
+            write_entry(entry_dir, entry)
+            remove_old_versions(entry_dir, version)
+        return version_dir, entry
+
+
+def file_source(path):
+    """Get what a cache entry of a file is keyed by, besides its path.
+
+    Args:
+        path: path of the file
+    """
+    stat = os.stat(path)
+    return {'format': LOCAL_CACHE_FORMAT, 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}
+
+
+def read_entry(entry_dir, source):
+    """Read a cache entry, or return None if there is no entry
+        built from the given source or its files are missing.
+
+    Args:
+        entry_dir: directory of the entry
+        source: file_source() of the file the entry is for
+    """
+    try:
+        with open("{}/entry.json".format(entry_dir), 'r') as stream:
+            entry = json.load(stream)
+    except (OSError, ValueError):
+        return None
+    if any(entry.get(key) != value for key, value in source.items()):
+        return None
+    files = [value for key, value in entry.items()
+             if key not in source and key != 'version']
+    if not all(os.path.isfile("{}/{}/{}".format(entry_dir,
+                                                entry.get('version'),
+                                                file_name))
+               for file_name in files):
+        return None
+    return entry
+
+
+def write_entry(entry_dir, entry):
+    """Atomically replace the metadata of a cache entry, processes
+        reading it see either the previous or the new entry.
+
+    Args:
+        entry_dir: directory of the entry
+        entry: metadata of the entry
+    """
+    fd, temp_path = tempfile.mkstemp(dir=entry_dir, suffix=".json")
+    try:
+        with os.fdopen(fd, 'w') as stream:
+            json.dump(entry, stream)
+        os.replace(temp_path, "{}/entry.json".format(entry_dir))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def remove_old_versions(entry_dir, version):
+    """Remove the files of a cache entry that are not part of its
+        current version and are older than LOCAL_CACHE_GRACE_PERIOD.
+        Must be called while holding the entry's lock.
+
+    Args:
+        entry_dir: directory of the entry
+        version: current version of the entry
+    """
+    expired = time.time() - LOCAL_CACHE_GRACE_PERIOD
+    for name in os.listdir(entry_dir):
+        if name in (version, "entry.json"):
+            continue
+        old_path = "{}/{}".format(entry_dir, name)
+        try:
+            if os.stat(old_path).st_mtime >= expired:
+                continue
+            if os.path.isdir(old_path):
+                shutil.rmtree(old_path)
+            else:
+                os.remove(old_path)
+        except OSError:
+            pass
+
+
+def find_adjacent_index(path):
+    """Find an index next to a compressed file (path.tbi or path.csi)
+        that is at least as recent as the file.
+
+    Args:
+        path: path of the compressed file
+    """
+    mtime = os.stat(path).st_mtime_ns
+    for extension in INDEX_EXTENSIONS:
+        index = "{}{}".format(path, extension)
+        if os.path.isfile(index) and os.stat(index).st_mtime_ns >= mtime:
+            return index
+    return None
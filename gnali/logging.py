@@ -29,8 +29,14 @@ class Logger:
 
     def write(self, error):
         if self.logger is None:
-            self.logger = logging.getLogger('factory')
+            # one logger per log file, so that runs in the same
+            # process (ex. gnali batch) don't write to each other's logs
+            self.logger = logging.getLogger('factory.{}'.format(
+                os.path.abspath(self.log_path)))
             self.logger.setLevel(logging.DEBUG)
+            for handler in list(self.logger.handlers):
+                self.logger.removeHandler(handler)
+                handler.close()
 
         if self.fh is None:
             # If there is no file handler and the log file exists,
@@ -16,20 +16,366 @@ CONDITIONS OF ANY KIND, either express or implied. See the License for the
 specific language governing permissions and limitations under the License.
 """
 
+import hashlib
+import heapq
+import os
+import re
+import tempfile
+from contextlib import ExitStack
+from itertools import groupby
+from gnali.files import build_index
+
+# Detailed output formats and the file extensions they are written with
+RESULTS_FORMATS = {'tsv': 'txt', 'parquet': 'parquet', 'arrow': 'arrow'}
+# VCF output formats and the file extensions they are written with
+VCF_FORMATS = {'vcf': 'vcf', 'bgz': 'vcf.gz'}
+
 
 def write_to_tab(path, data):
     data.to_csv(path, sep='\t', mode='w', index=False, header=True)
 
 
+def import_pyarrow(output_format):
+    """Import pyarrow, which is only needed (and installed) for
+        Parquet and Arrow output. Raises an ImportError explaining
+        how to install it if it's missing.
+
+    Args:
+        output_format: output format pyarrow is needed for
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("{} output requires pyarrow, install it with "
+                          "'pip install gnali[arrow]'"
+                          .format(output_format))
+    return pyarrow
+
+
+def get_arrow_schema(pa, data):
+    """Get the Arrow schema of a results table from its dtypes,
+        so that every part of a table written in parts has the
+        same schema, even if a column is empty in some of them.
+
+    Args:
+        pa: pyarrow module
+        data: DataFrame of results
+    """
+    fields = []
+    for name, dtype in data.dtypes.items():
+        if str(dtype) in ('Int64', 'int64'):
+            arrow_type = pa.int64()
+        elif str(dtype) == 'float64':
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(str(name), arrow_type))
+    return pa.schema(fields)
+
+
+class TableWriter:
+    """Write a results table to a tab-separated, Parquet or Arrow
+        IPC file, in one or more parts. The file is only created
+        once there is something to write to it.
+    """
+    def __init__(self, path, output_format='tsv'):
+        """Args:
+            path: path of the output file
+            output_format: one of RESULTS_FORMATS
+        """
+        if output_format not in RESULTS_FORMATS:
+            raise ValueError("unknown output format {}"
+                             .format(output_format))
+        self.path = path
+        self.output_format = output_format
+        self.num_rows = 0
+        self._pa = None
+        self._schema = None
+        self._writer = None
+        self._sink = None
+        if output_format != 'tsv':
+            self._pa = import_pyarrow(output_format)
+
+    def append(self, data):
+        """Append rows to the table, the first rows written create
+            the file (with a header line for tab-separated files).
+
+        Args:
+            data: DataFrame of results
+        """
+        if len(data) == 0:
+            return
+        if self.output_format == 'tsv':
+            first = self.num_rows == 0
+            data.to_csv(self.path, sep='\t', mode='w' if first else 'a',
+                        index=False, header=first)
+        else:
+            pa = self._pa
+            if self._writer is None:
+                self._schema = get_arrow_schema(pa, data)
+                if self.output_format == 'parquet':
+                    self._writer = pa.parquet.ParquetWriter(self.path,
+                                                            self._schema)
+                else:
+                    self._sink = pa.OSFile(self.path, 'wb')
+                    self._writer = pa.ipc.new_file(self._sink, self._schema)
+            table = pa.Table.from_pandas(data, schema=self._schema,
+                                         preserve_index=False)
+            self._writer.write_table(table)
+        self.num_rows += len(data)
+
+    def close(self):
+        """Finish writing the file, Parquet and Arrow files are
+            only readable once closed.
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._sink is not None:
+            self._sink.close()
+            self._sink = None
+
+
+def write_to_table(path, data, output_format='tsv'):
+    writer = TableWriter(path, output_format)
+    try:
+        writer.append(data)
+    finally:
+        writer.close()
+
+
 def write_to_vcf(path, headers, data):
     with open(path, 'w') as stream:
-        for line in headers:
-            line = str(line)
-            stream.write(line)
-            if line[-1] != '\n':
-                stream.write('\n')
-        for line in data:
-            line = str(line)
-            stream.write(line)
-            if line[-1] != '\n':
-                stream.write('\n')
+        write_lines(stream, headers)
+        write_lines(stream, data)
+
+
+def get_contig_order(header):
+    """Get the position of every contig declared in a VCF header
+        (##contig lines), by contig name.
+
+    Args:
+        header: VCF header lines
+    """
+    contigs = {}
+    for line in header:
+        match = re.match(r'##contig=<ID=([^,>]+)', str(line))
+        if match is not None:
+            contigs.setdefault(match.group(1), len(contigs))
+    return contigs
+
+
+def get_contig_sort_key(header):
+    """Get a function giving the sort key of a contig name.
+        Contigs are sorted in the order of the header's ##contig
+        lines, then chromosomes numerically, then other contigs
+        by name.
+
+    Args:
+        header: VCF header lines
+    """
+    contigs = get_contig_order(header)
+
+    def contig_key(contig):
+        name = contig[3:] if contig.startswith("chr") else contig
+        if contig in contigs:
+            return (0, contigs[contig], "")
+        if name.isdigit():
+            return (1, int(name), "")
+        return (2, 0, name)
+    return contig_key
+
+
+def sort_vcf_records(header, records):
+    """Sort VCF records by contig and position, contigs are
+        sorted as by get_contig_sort_key().
+
+    Args:
+        header: VCF header lines
+        records: VCF records as strings
+    """
+    contig_key = get_contig_sort_key(header)
+
+    def sort_key(record):
+        contig, pos, _ = str(record).split("\t", 2)
+        return contig_key(contig), int(pos)
+
+    return sorted(records, key=sort_key)
+
+
+def write_to_bgzf_vcf(path, headers, data):
+    """Write a VCF file sorted by position, compressed with BGZF
+        and indexed with Tabix (path.tbi).
+
+    Args:
+        path: path of the compressed VCF file, ending with .gz
+        headers: VCF header lines
+        data: VCF records as strings
+    """
+    plain_path = path[:-len(".gz")]
+    write_to_vcf(plain_path, headers, sort_vcf_records(headers, data))
+    index_vcf(plain_path)
+
+
+def index_vcf(plain_path):
+    """Compress a sorted VCF file with BGZF to plain_path.gz, index
+        it with Tabix (a CSI index if it has positions TBI can't
+        store) and remove the plain file.
+
+    Args:
+        plain_path: path of the VCF file
+    """
+    import pysam
+    pysam.tabix_compress(plain_path, "{}.gz".format(plain_path),
+                         force=True)
+    os.remove(plain_path)
+    build_index("{}.gz".format(plain_path))
+
+
+def write_lines(stream, lines):
+    for line in lines:
+        line = str(line)
+        stream.write(line)
+        if line[-1] != '\n':
+            stream.write('\n')
+
+
+class StreamWriter:
+    """Append results to output files as they become available,
+        so they don't have to be kept in memory until the end of a
+        run. Files are only created once there is something to
+        write to them.
+    """
+    def __init__(self, results_path, vcf_path=None, output_format='tsv',
+                 vcf_format='vcf'):
+        """Args:
+            results_path: path of the detailed results file
+            vcf_path: path of the VCF file, if one is written
+            output_format: format of the detailed results file,
+                           one of RESULTS_FORMATS
+            vcf_format: format of the VCF file, one of VCF_FORMATS.
+                        Records of compressed VCF files are written
+                        to sorted runs, which close() merges into
+                        a sorted, compressed and indexed file
+        """
+        self.results = TableWriter(results_path, output_format)
+        self.vcf_path = vcf_path
+        self.vcf_format = vcf_format
+        if vcf_path is not None and vcf_format == 'bgz':
+            self.vcf_path = vcf_path[:-len(".gz")]
+        self.num_results = 0
+        self.num_records = 0
+        self._header = None
+        # records of overlapping genes are only written once, regions
+        # are disjoint so only records of the current region are kept
+        self._region = None
+        self._records_seen = set()
+        self._region_records = []
+        # sorted runs of records by contig, as [path, last position]
+        self._runs_dir = None
+        self._runs = {}
+        self._num_runs = 0
+
+    def append_results(self, data):
+        """Append rows to the detailed results file, the first
+            rows written create it.
+
+        Args:
+            data: DataFrame of results
+        """
+        self.results.append(data)
+        self.num_results = self.results.num_rows
+
+    def append_vcf(self, header, records, region=None):
+        """Append records to the VCF file, the first records written
+            create it with the VCF header.
+
+        Args:
+            header: VCF header lines
+            records: VCF records as strings
+            region: regions.Region the records were fetched from,
+                    records are only compared to records of the same
+                    region to find duplicates
+        """
+        if self.vcf_path is None:
+            return
+        if region is not self._region:
+            self._end_region()
+            self._region = region
+        new_records = []
+        for record in records:
+            digest = hashlib.md5(str(record).encode()).digest()
+            if digest not in self._records_seen:
+                self._records_seen.add(digest)
+                new_records.append(record)
+        if len(new_records) == 0:
+            return
+        if self._header is None:
+            self._header = header
+        if self.vcf_format == 'bgz':
+            self._region_records.extend(new_records)
+        elif self.num_records == 0:
+            write_to_vcf(self.vcf_path, header, new_records)
+        else:
+            with open(self.vcf_path, 'a') as stream:
+                write_lines(stream, new_records)
+        self.num_records += len(new_records)
+
+    def _end_region(self):
+        # sort the records of the region and append them to the run
+        # of their contig, or start a new run if they come before it
+        self._records_seen = set()
+        records = sort_vcf_records(self._header or [],
+                                   self._region_records)
+        self._region_records = []
+        if len(records) == 0:
+            return
+        if self._runs_dir is None:
+            self._runs_dir = tempfile.TemporaryDirectory(
+                dir=os.path.dirname(os.path.abspath(self.vcf_path)))
+        for contig, contig_records in groupby(
+                records, key=lambda record: str(record).split("\t", 1)[0]):
+            contig_records = list(contig_records)
+            first, last = [int(str(record).split("\t", 2)[1])
+                           for record in (contig_records[0],
+                                          contig_records[-1])]
+            runs = self._runs.setdefault(contig, [])
+            if len(runs) == 0 or first < runs[-1][1]:
+                self._num_runs += 1
+                runs.append(["{}/{}.vcf".format(self._runs_dir.name,
+                                                self._num_runs), last])
+            with open(runs[-1][0], 'a') as stream:
+                write_lines(stream, contig_records)
+            runs[-1][1] = last
+
+    def _merge_runs(self):
+        # merge the sorted runs of every contig into the VCF file
+        contig_key = get_contig_sort_key(self._header)
+
+        def record_pos(record):
+            return int(record.split("\t", 2)[1])
+
+        with open(self.vcf_path, 'w') as stream:
+            write_lines(stream, self._header)
+            for contig in sorted(self._runs, key=contig_key):
+                with ExitStack() as stack:
+                    runs = [stack.enter_context(open(path, 'r'))
+                            for path, _ in self._runs[contig]]
+                    write_lines(stream, heapq.merge(*runs, key=record_pos))
+
+    def close(self):
+        """Finish writing the output files."""
+        self.results.close()
+        if self.vcf_format != 'bgz' or self.vcf_path is None:
+            return
+        try:
+            self._end_region()
+            if self.num_records > 0:
+                self._merge_runs()
+                index_vcf(self.vcf_path)
+        finally:
+            if self._runs_dir is not None:
+                self._runs_dir.cleanup()
+                self._runs_dir = None
@@ -0,0 +1,167 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import hashlib
+import sqlite3
+import time
+import zlib
+from pathlib import Path
+from gnali.regions import record_interval
+
+GNALI_PATH = Path(__file__).parent.absolute()
+DATA_PATH = "{}/data".format(str(GNALI_PATH))
+REGION_CACHE_PATH = "{}/region-cache".format(DATA_PATH)
+# Bump when the layout of the cache changes, older caches are ignored
+REGION_CACHE_FORMAT = 1
+# Time (in seconds) to wait for another gNALI process writing to the cache
+REGION_CACHE_TIMEOUT = 600
+# Default size (in MB) of the cache, 0 disables it
+DEFAULT_REGION_CACHE_SIZE = 1024
+
+
+class RegionCache:
+    """Read-through cache of the records fetched from a remote
+        database file, stored as an SQLite database. Regions are
+        keyed by the file's url and the digest of its index, so a
+        database that changes on the server (and therefore gets a
+        new index) never returns stale records. The least recently
+        used regions are evicted once the cache is over its size.
+    """
+    def __init__(self, url, index_path, max_size=DEFAULT_REGION_CACHE_SIZE,
+                 cache_dir=None):
+        """Args:
+            url: url of the database file
+            index_path: path of the database file's index
+            max_size: size (in MB) of the cache
+            cache_dir: directory holding the region cache
+        """
+        if cache_dir is None:
+            cache_dir = REGION_CACHE_PATH
+        self.url = url
+        self.validator = file_digest(index_path)
+        self.max_size = int(float(max_size) * 1024 * 1024)
+        self.path = "{}/regions_v{}.sqlite".format(cache_dir,
+                                                   REGION_CACHE_FORMAT)
+
+    def _connect(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=REGION_CACHE_TIMEOUT)
+        conn.execute("CREATE TABLE IF NOT EXISTS regions "
+                     "(url TEXT NOT NULL, validator TEXT NOT NULL, "
+                     "contig TEXT NOT NULL, start_pos INTEGER NOT NULL, "
+                     "end_pos INTEGER NOT NULL, records BLOB NOT NULL, "
+                     "size INTEGER NOT NULL, last_used REAL NOT NULL, "
+                     "PRIMARY KEY (url, validator, contig, start_pos, "
+                     "end_pos))")
+        conn.execute("CREATE INDEX IF NOT EXISTS regions_last_used "
+                     "ON regions (last_used)")
+        return conn
+
+    def get(self, contig, start, end):
+        """Get the records of a region, from the smallest cached
+            region containing it. Returns None if no cached region
+            contains it.
+
+        Args:
+            contig: contig of the region
+            start: start of the region (1-based, inclusive)
+            end: end of the region (1-based, inclusive)
+        """
+        conn = self._connect()
+        try:
+            with conn:
+                row = conn.execute("SELECT start_pos, end_pos, records "
+                                   "FROM regions WHERE url = ? "
+                                   "AND validator = ? AND contig = ? "
+                                   "AND start_pos <= ? AND end_pos >= ? "
+                                   "ORDER BY end_pos - start_pos LIMIT 1",
+                                   (self.url, self.validator, contig,
+                                    start, end)).fetchone()
+                if row is None:
+                    return None
+                cached_start, cached_end, data = row
+                conn.execute("UPDATE regions SET last_used = ? "
+                             "WHERE url = ? AND validator = ? "
+                             "AND contig = ? AND start_pos = ? "
+                             "AND end_pos = ?",
+                             (time.time(), self.url, self.validator,
+                              contig, cached_start, cached_end))
+        finally:
+            conn.close()
+        data = zlib.decompress(data).decode()
+        records = data.split("\n") if len(data) > 0 else []
+        if (cached_start, cached_end) == (start, end):
+            return records
+        # keep the records Tabix would return for the smaller region
+        return [record for record in records
+                if overlaps(record_interval(record), start, end)]
+
+    def put(self, contig, start, end, records):
+        """Add the records of a region to the cache, then evict
+            the least recently used regions if it is over its size.
+            Regions larger than the cache aren't added.
+
+        Args:
+            contig: contig of the region
+            start: start of the region (1-based, inclusive)
+            end: end of the region (1-based, inclusive)
+            records: VCF records as strings (without newlines)
+        """
+        data = zlib.compress("\n".join(records).encode())
+        if len(data) > self.max_size:
+            return
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO regions VALUES "
+                             "(?, ?, ?, ?, ?, ?, ?, ?)",
+                             (self.url, self.validator, contig, start, end,
+                              data, len(data), time.time()))
+                self._evict(conn)
+        finally:
+            conn.close()
+
+    def _evict(self, conn):
+        total, = conn.execute("SELECT COALESCE(SUM(size), 0) "
+                              "FROM regions").fetchone()
+        excess = total - self.max_size
+        if excess <= 0:
+            return
+        evicted = []
+        for row in conn.execute("SELECT url, validator, contig, start_pos, "
+                                "end_pos, size FROM regions "
+                                "ORDER BY last_used"):
+            evicted.append(row[:5])
+            excess -= row[5]
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM regions WHERE url = ? "
+                         "AND validator = ? AND contig = ? "
+                         "AND start_pos = ? AND end_pos = ?", evicted)
+
+
+def overlaps(interval, start, end):
+    return interval[0] <= end and interval[1] >= start
+
+
+def file_digest(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
@@ -0,0 +1,177 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+
+def parse_location(location):
+    """Split a Tabix location string (ex. 3:46411633-46417697)
+        into its contig, start and end (1-based, inclusive).
+
+    Args:
+        location: location string
+    """
+    contig, interval = location.rsplit(":", 1)
+    start, end = interval.split("-")
+    return contig, int(start), int(end)
+
+
+def record_interval(record):
+    """Get the interval (1-based, inclusive) a VCF record covers,
+        the same way Tabix does: from the length of the reference
+        allele, or the END info field if there is one.
+
+    Args:
+        record: VCF record as a string
+    """
+    fields = record.split("\t", 8)
+    start = int(fields[1])
+    end = start + len(fields[3]) - 1
+    info = fields[7] if len(fields) > 7 else ""
+    if info.startswith("END="):
+        value_index = 4
+    else:
+        value_index = info.find(";END=")
+        if value_index >= 0:
+            value_index += 5
+    if value_index >= 0:
+        value = info[value_index:].split(";", 1)[0].strip()
+        if value.isdigit() and int(value) >= start:
+            end = int(value)
+    return start, end
+
+
+class IntervalTree:
+    """Static interval tree over closed intervals, stored as an
+        implicit balanced binary search tree on intervals sorted
+        by start, with the maximum end of every subtree.
+    """
+    def __init__(self, intervals):
+        """Args:
+            intervals: list of (start, end, value) tuples
+        """
+        self.intervals = sorted(intervals, key=lambda item: item[:2])
+        self.max_ends = [0] * len(self.intervals)
+        self._build(0, len(self.intervals))
+
+    def _build(self, low, high):
+        if low >= high:
+            return 0
+        mid = (low + high) // 2
+        self.max_ends[mid] = max(self.intervals[mid][1],
+                                 self._build(low, mid),
+                                 self._build(mid + 1, high))
+        return self.max_ends[mid]
+
+    def overlap(self, start, end):
+        """Get the values of all intervals overlapping [start, end].
+
+        Args:
+            start: start of query interval
+            end: end of query interval
+        """
+        found = []
+        stack = [(0, len(self.intervals))]
+        while stack:
+            low, high = stack.pop()
+            if low >= high:
+                continue
+            mid = (low + high) // 2
+            # no interval in this subtree reaches the query
+            if self.max_ends[mid] < start:
+                continue
+            stack.append((low, mid))
+            int_start, int_end, value = self.intervals[mid]
+            if int_start <= end:
+                if int_end >= start:
+                    found.append(value)
+                stack.append((mid + 1, high))
+        return found
+
+    def __len__(self):
+        return len(self.intervals)
+
+
+class Region:
+    """A merged interval of one or more overlapping or adjacent
+        genes, fetched from a database file in a single query.
+    """
+    def __init__(self, contig, start, end):
+        self.contig = contig
+        self.start = start
+        self.end = end
+        self.genes = []
+        self.tree = None
+
+    def add_gene(self, gene, start, end):
+        self.genes.append((start, end, gene))
+        self.start = min(self.start, start)
+        self.end = max(self.end, end)
+        self.tree = None
+
+    def build_tree(self):
+        self.tree = IntervalTree(self.genes)
+
+    def get_genes(self):
+        return [gene for _, _, gene in self.genes]
+
+    def assign_records(self, records):
+        """Route every record to all genes of the region it overlaps.
+            Yields (record, genes) pairs in record order.
+
+        Args:
+            records: iterable of VCF records as strings
+        """
+        if self.tree is None:
+            self.build_tree()
+        for record in records:
+            start, end = record_interval(record)
+            genes = self.tree.overlap(start, end)
+            if len(genes) > 0:
+                yield record, genes
+
+    def __str__(self):
+        return "{}:{}-{}".format(self.contig, self.start, self.end)
+
+
+def plan_regions(genes):
+    """Sort gene locations by contig and position and merge
+        overlapping or adjacent ones into regions, so that each
+        part of a database file is only fetched once.
+
+    Args:
+        genes: list of Gene objects, genes without a location
+               are skipped
+    """
+    by_contig = {}
+    for gene in genes:
+        if gene.location is None:
+            continue
+        contig, start, end = parse_location(gene.location)
+        by_contig.setdefault(contig, []).append((start, end, gene))
+
+    regions = []
+    for contig, intervals in by_contig.items():
+        intervals.sort(key=lambda item: item[:2])
+        region = None
+        for start, end, gene in intervals:
+            if region is None or start > region.end + 1:
+                region = Region(contig, start, end)
+                regions.append(region)
+            region.add_gene(gene, start, end)
+    for region in regions:
+        region.build_tree()
+    return regions
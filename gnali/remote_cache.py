@@ -0,0 +1,248 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import hashlib
+import json
+import os
+import posixpath
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+from gnali.exceptions import TBIDownloadError
+from gnali.files import INDEX_EXTENSIONS
+
+GNALI_PATH = Path(__file__).parent.absolute()
+DATA_PATH = "{}/data".format(str(GNALI_PATH))
+REMOTE_INDEX_PATH = "{}/remote-index".format(DATA_PATH)
+# Default time (in hours) before a cached index is revalidated
+DEFAULT_REMOTE_INDEX_TTL = 24
+# Time (in seconds) to wait for a revalidation request when there is
+# a cached copy to fall back to
+REVALIDATE_TIMEOUT = 10
+CHUNK_SIZE = 1024 * 1024
+
+
+class RemoteIndexCache:
+    """Local cache of files fetched over HTTP (index files of remote
+        databases). Files are stored by the SHA-256 digest of their
+        content, so that URLs serving the same file share one copy,
+        along with one entry per URL recording the file's digest,
+        ETag and Last-Modified headers. Entries older than the TTL
+        are revalidated with a conditional request, and the cached
+        copy is used if the server can't be reached.
+    """
+    def __init__(self, cache_dir=None, ttl=DEFAULT_REMOTE_INDEX_TTL):
+        """Args:
+            cache_dir: directory holding the cache
+            ttl: time (in hours) before an entry is revalidated,
+                 entries are never revalidated if ttl is 0
+        """
+        if cache_dir is None:
+            cache_dir = REMOTE_INDEX_PATH
+        self.blobs_dir = "{}/blobs".format(cache_dir)
+        self.entries_dir = "{}/entries".format(cache_dir)
+        self.ttl = ttl
+
+    def _entry_path(self, url):
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return "{}/{}.json".format(self.entries_dir, digest)
+
+    def _blob_path(self, entry):
+        return "{}/{}{}".format(self.blobs_dir, entry['digest'],
+                                entry.get('extension', ''))
+
+    def get_entry(self, url):
+        """Get the cache entry of a url, or None if there is no
+            usable entry.
+
+        Args:
+            url: url of the file
+        """
+        try:
+            with open(self._entry_path(url), 'r') as stream:
+                entry = json.load(stream)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') != url or \
+           not os.path.isfile(self._blob_path(entry)):
+            return None
+        return entry
+
+    def is_fresh(self, entry):
+        if not self.ttl:
+            return True
+        age = time.time() - float(entry.get('fetched_at', 0))
+        return age <= float(self.ttl) * 3600
+
+    def get(self, url, max_time):
+        """Get the path of a local copy of a url, downloading or
+            revalidating it if necessary. Raises a TBIDownloadError
+            if the file can't be downloaded and isn't cached.
+
+        Args:
+            url: url of the file
+            max_time: maximum time to wait for the download or
+                      for another gNALI process using the cache
+        """
+        from filelock import FileLock
+        Path(self.blobs_dir).mkdir(parents=True, exist_ok=True)
+        Path(self.entries_dir).mkdir(parents=True, exist_ok=True)
+        lock = FileLock("{}.lock".format(self._entry_path(url)))
+        try:
+            with lock.acquire(timeout=max_time):
+                return self._get_locked(url, max_time)
+        except TimeoutError:
+            # cached files are never modified in place, so they
+            # can be read while another process updates the entry
+            entry = self.get_entry(url)
+            if entry is not None:
+                return self._blob_path(entry)
+            temp = tempfile.mkdtemp()
+            temp_path = "{}/{}".format(temp, url_file_name(url))
+            with open(temp_path, 'wb') as stream:
+                self._fetch(url, {}, stream, max_time)
+            return temp_path
+
+    def get_index(self, url, max_time):
+        """Get the path of a local copy of the index of a remote
+            compressed file, url.tbi or url.csi if the server has
+            no TBI index. The index a url was cached with is tried
+            first. Raises a TBIDownloadError if neither index can
+            be downloaded and none is cached.
+
+        Args:
+            url: url of the compressed file
+            max_time: maximum time to wait for the download or
+                      for another gNALI process using the cache
+        """
+        index_urls = ["{}{}".format(url, extension)
+                      for extension in INDEX_EXTENSIONS]
+        index_urls.sort(key=lambda index_url:
+                        self.get_entry(index_url) is None)
+        first_error = None
+        for index_url in index_urls:
+            try:
+                return self.get(index_url, max_time)
+            except TBIDownloadError as error:
+                first_error = first_error or error
+        raise first_error
+
+    def _get_locked(self, url, max_time):
+        entry = self.get_entry(url)
+        if entry is not None and self.is_fresh(entry):
+            return self._blob_path(entry)
+
+        headers = {}
+        timeout = max_time
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            timeout = min(max_time, REVALIDATE_TIMEOUT)
+
+        temp = tempfile.NamedTemporaryFile(dir=self.blobs_dir,
+                                           suffix=".tmp", delete=False)
+        try:
+            with temp:
+                response = self._fetch(url, headers, temp, timeout)
+            if response is None:
+                # not modified since it was cached
+                entry['fetched_at'] = time.time()
+                self._write_entry(url, entry)
+                return self._blob_path(entry)
+            digest, response_headers = response
+            new_entry = {'url': url,
+                         'digest': digest,
+                         'extension': posixpath.splitext(
+                             url_file_name(url))[1],
+                         'etag': response_headers.get('ETag'),
+                         'last_modified':
+                             response_headers.get('Last-Modified'),
+                         'fetched_at': time.time()}
+            blob_path = self._blob_path(new_entry)
+            if os.path.isfile(blob_path):
+                os.remove(temp.name)
+            else:
+                os.replace(temp.name, blob_path)
+            self._write_entry(url, new_entry)
+            if entry is not None and entry['digest'] != digest:
+                self._remove_unused(entry)
+            return blob_path
+        except TBIDownloadError:
+            if entry is not None:
+                # server is slow or down, use the cached copy
+                return self._blob_path(entry)
+            raise
+        finally:
+            if os.path.exists(temp.name):
+                os.remove(temp.name)
+
+    def _fetch(self, url, headers, stream, timeout):
+        """Download a url to a stream. Returns None if the server
+            answered Not Modified, otherwise the SHA-256 digest of
+            the content and the response headers.
+        """
+        request = urllib.request.Request(url, headers=headers)
+        sha256 = hashlib.sha256()
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as resp:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+                    stream.write(chunk)
+                return sha256.hexdigest(), dict(resp.headers)
+        except urllib.error.HTTPError as error:
+            if error.code == 304:
+                return None
+            raise TBIDownloadError("could not download {}: HTTP {}"
+                                   .format(url, error.code))
+        except (urllib.error.URLError, OSError) as error:
+            raise TBIDownloadError("could not download {}: {}"
+                                   .format(url, error))
+
+    def _write_entry(self, url, entry):
+        path = self._entry_path(url)
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(temp_path, 'w') as stream:
+            json.dump(entry, stream)
+        os.replace(temp_path, path)
+
+    def _remove_unused(self, entry):
+        """Remove the file of a replaced entry, unless another
+            url's entry still uses it.
+        """
+        for file_name in os.listdir(self.entries_dir):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open("{}/{}".format(self.entries_dir, file_name),
+                          'r') as stream:
+                    if json.load(stream).get('digest') == entry['digest']:
+                        return
+            except (OSError, ValueError):
+                continue
+        blob_path = self._blob_path(entry)
+        if os.path.exists(blob_path):
+            os.remove(blob_path)
+
+
+def url_file_name(url):
+    return posixpath.basename(urllib.parse.urlparse(url).path) or "index"
@@ -0,0 +1,181 @@
+"""
+Copyright Government of Canada 2020-2021
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from gnali.api import QueryService
+from gnali.exceptions import InvalidConfigurationError, InvalidFilterError
+
+SERVER_NAME = 'gNALI serve'
+SERVER_INFO = "Serve gNALI queries over HTTP, keeping database \
+               configurations, gene coordinates and Tabix handles \
+               open between queries."
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+# Maximum size (in bytes) of a query
+MAX_QUERY_SIZE = 1024 * 1024
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """HTTP/JSON API of a QueryServer:
+
+        GET /databases: available databases and the default one
+        POST /query: a query, as a JSON object with genes (list of
+            HGNC symbols) and optionally database, predefined_filters,
+            additional_filters and pop_freqs. Answers with the basic
+            and detailed results as lists of JSON objects.
+    """
+    def do_GET(self):
+        service = self.server.service
+        if self.path == '/databases':
+            self.send_json(200, {'databases': service.database_names,
+                                 'default': service.default})
+        else:
+            self.send_json(404, {'error': "Not found"})
+
+    def do_POST(self):
+        if self.path != '/query':
+            self.send_json(404, {'error': "Not found"})
+            return
+        try:
+            query = self.read_query()
+            results = self.server.service.query(
+                query['genes'], query.get('database'),
+                query.get('predefined_filters'),
+                query.get('additional_filters'),
+                bool(query.get('pop_freqs', False)))
+        except (ValueError, InvalidConfigurationError,
+                InvalidFilterError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+        self.send_json(200, {'basic': to_records(results.basic),
+                             'detailed': to_records(results.detailed)})
+
+    def read_query(self):
+        """Read and validate the JSON body of a query, raises a
+            ValueError if it is invalid.
+        """
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_QUERY_SIZE:
+            raise ValueError("Query is too large")
+        query = json.loads(self.rfile.read(length).decode() or "null")
+        if not isinstance(query, dict):
+            raise ValueError("Query must be a JSON object")
+        genes = query.get('genes')
+        if not isinstance(genes, list) or len(genes) == 0 or \
+           not all(isinstance(gene, str) for gene in genes):
+            raise ValueError("Query must have a non-empty list of genes")
+        for key in ['predefined_filters', 'additional_filters']:
+            value = query.get(key)
+            if value is not None and not isinstance(value, list):
+                raise ValueError("{} must be a list".format(key))
+        return query
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class QueryServer(HTTPServer):
+    """HTTP server handling requests on a bounded pool of threads,
+        so that a burst of requests queues up instead of starting
+        one thread per request.
+    """
+    def __init__(self, address, service, workers):
+        """Args:
+            address: (host, port) to listen on
+            service: QueryService running the queries
+            workers: number of requests handled concurrently
+        """
+        super().__init__(address, QueryRequestHandler)
+        self.service = service
+        self.request_executor = ThreadPoolExecutor(max_workers=workers)
+
+    def process_request(self, request, client_address):
+        self.request_executor.submit(self.process_request_thread,
+                                     request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.request_executor.shutdown(wait=True)
+
+
+def to_records(data):
+    """Convert a DataFrame to a list of JSON objects, with missing
+        values as null.
+    """
+    return json.loads(data.to_json(orient='records'))
+
+
+def init_parser():
+    parser = argparse.ArgumentParser(prog=SERVER_NAME,
+                                     description=SERVER_INFO)
+    parser.add_argument('--host',
+                        default=DEFAULT_HOST,
+                        help='Address to listen on. Default: {}'
+                             .format(DEFAULT_HOST))
+    parser.add_argument('--port',
+                        type=int, default=DEFAULT_PORT,
+                        help='Port to listen on. Default: {}'
+                             .format(DEFAULT_PORT))
+    parser.add_argument('-c', '--config',
+                        help='Use a custom config file')
+    parser.add_argument('-d', '--databases',
+                        nargs='*',
+                        help='Databases to open on start. Default: default '
+                             'database of the configuration file')
+    parser.add_argument('-w', '--workers',
+                        type=int, default=4,
+                        help='Number of requests handled concurrently, '
+                             'also used as the number of worker threads '
+                             'used to fetch regions. Default: 4')
+    return parser
+
+
+def main(argv=None):
+    args = init_parser().parse_args(argv)
+    service = QueryService(args.config, args.workers)
+    for database in args.databases or [service.default]:
+        service.get_database(database)
+    server = QueryServer((args.host, args.port), service, args.workers)
+    print("Serving gNALI queries on http://{}:{}"
+          .format(args.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
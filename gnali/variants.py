@@ -16,8 +16,77 @@ CONDITIONS OF ANY KIND, either express or implied. See the License for the
 specific language governing permissions and limitations under the License.
 """
 
+import copy
+from collections import namedtuple
+from functools import lru_cache
+
+CSQSchema = namedtuple('CSQSchema', ['num_delims', 'symbol_index',
+                                     'lof_index'])
+
+
+class InfoFields:
+    """Read-only mapping over the INFO field of a VCF record. The field
+        is parsed lazily: looking up a key only scans the record for
+        that key, so the (possibly hundreds of) other keys are never
+        split into separate strings.
+    """
+    __slots__ = ('record', 'start')
+
+    def __init__(self, record, start=0):
+        """Args:
+            record: VCF record as a string
+            start: index of the INFO field in the record
+        """
+        self.record = record
+        self.start = start
+
+    def get(self, key, default=None):
+        record = self.record
+        target = "{}=".format(key)
+        index = record.find(target, self.start)
+        while index >= 0:
+            # only match whole keys (ex. AC, not controls_AC)
+            if index == self.start or record[index - 1] == ";":
+                value_start = index + len(target)
+                value_end = record.find(";", value_start)
+                if value_end < 0:
+                    value_end = len(record)
+                return record[value_start:value_end]
+            index = record.find(target, index + 1)
+        return default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def to_dict(self):
+        """Parse every key of the INFO field."""
+        return dict([info_item.split("=", 1) for
+                     info_item in self.record[self.start:].split(";")
+                     if len(info_item.split("=", 1)) > 1])
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def keys(self):
+        return self.to_dict().keys()
+
+    def items(self):
+        return self.to_dict().items()
+
 
 class Variant:
+    __slots__ = ('gene_name', 'record_str', 'lof_id', 'lof_annot',
+                 'lof_header', 'chrom', 'pos', 'id', 'ref', 'alt',
+                 'qual', 'filter', 'info', 'transcripts')
 
     def __init__(self, gene, record, lof_id, lof_annot, lof_header):
         """Args:
@@ -30,16 +99,43 @@ class Variant:
 
         self.gene_name = gene
         self.record_str = record
+        self.lof_id = lof_id
+        self.lof_annot = lof_annot
+        self.lof_header = lof_header
         self.chrom, self.pos, self.id, self.ref, \
             self.alt, self.qual, self.filter, \
-            self.info_str = record.split("\t")
-        self.info = dict([info_item.split("=", 1) for
-                         info_item in self.info_str.split(";")
-                         if len(info_item.split("=", 1)) > 1])
+            info_str = record.split("\t")
+        # INFO is only kept in the record string, and parsed on lookup
+        self.info = InfoFields(record, len(record) - len(info_str))
         self.transcripts = []
 
         split_transcripts_from_rec(self, lof_header, lof_id, lof_annot)
 
+    @property
+    def info_str(self):
+        return self.record_str[self.info.start:]
+
+    def for_gene(self, gene):
+        """Get a copy of this variant for another gene (ex. an
+            overlapping gene). The record isn't parsed again, only
+            its transcripts are split for the new gene.
+
+        Args:
+            gene: name of gene
+        """
+        variant = copy.copy(self)
+        variant.gene_name = gene
+        variant.transcripts = []
+        split_transcripts_from_rec(variant, self.lof_header, self.lof_id,
+                                   self.lof_annot)
+        return variant
+
+    def flags(self):
+        """Get the INFO flags (fields without a value) of the record."""
+        return set(info_item for info_item
+                   in self.info_str.rstrip("\n").split(";")
+                   if "=" not in info_item)
+
     def __str__(self):
         if self.info_str[-1] == '\n':
             return "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}" \
@@ -82,6 +178,24 @@ class Variant:
         return len(self.transcripts) > 1
 
 
+@lru_cache(maxsize=None)
+def get_csq_schema(header, lof_annot):
+    """Get the layout of transcript annotations from a
+        loss-of-function header line, computed once per header.
+
+    Args:
+        header: loss-of-function header line
+        lof_annot: loss-of-function tool annotation from a RuntimeConfig
+
+    Returns:
+        CSQSchema with the number of delimiters per transcript and
+        the indexes of the SYMBOL and loss-of-function fields
+    """
+    fields = header.split("|")
+    return CSQSchema(len(fields) - 1, fields.index("SYMBOL"),
+                     fields.index(lof_annot))
+
+
 def split_transcripts_from_rec(variant, header, lof_id, lof_annot):
     """Parse a VCF record for individual transcript loss-of-function
         annotations.
@@ -92,45 +206,36 @@ def split_transcripts_from_rec(variant, header, lof_id, lof_annot):
         lof_id: loss-of-function tool ID from a RuntimeConfig
         lof_annot:  loss-of-function tool annotation from a RuntimeConfig
     """
-    vep_info_str = variant.info[lof_id]
-    num_delims = header.count("|")
-    trans_gene_index = header.split("|").index("SYMBOL")
-
-    start_index = 0
-    last_comma_index = 0
-    delims_seen = 0
-
+    # VCF records may end with a newline
+    vep_info_str = variant.info[lof_id].rstrip("\n")
+    num_delims, symbol_index, lof_index = get_csq_schema(header, lof_annot)
+
+    # Transcripts are separated by commas, but fields can contain commas
+    # too. Every transcript has the same number of fields, so after
+    # splitting on delimiters the last comma of every num_delims-th
+    # part is where one transcript ends and the next one starts.
+    parts = vep_info_str.split("|")
+    last_part = len(parts) - 1
     transcripts = []
-    enough_delims = False
-
-    # Parse VEP annotation character by character
-    for i, char in enumerate(vep_info_str):
-        # edge case for last character
-        if i == len(vep_info_str) - 1:
-            # omit last character, VCF records end with newline
-            trans_str = vep_info_str[start_index:-1]
-            # Don't add transcript if transcript gene is not what is expected
-            # (this can happen with overlapping genes)
-            if trans_str.split("|")[trans_gene_index] == variant.gene_name:
-                transcripts.append(Transcript(trans_str, lof_annot, header))
-            variant.set_transcripts(transcripts)
-            return
-
-        if char == "|" and not enough_delims:
-            delims_seen += 1
-            if delims_seen == num_delims:
-                enough_delims = True
-        # Once we've hit one extra delimiter, backtrack to find where
-        # the last transcript ended
-        elif char == "|" and enough_delims:
-            trans_str = vep_info_str[start_index:last_comma_index]
-            if trans_str.split("|")[trans_gene_index] == variant.gene_name:
-                transcripts.append(Transcript(trans_str, lof_annot, header))
-            delims_seen = 1
-            enough_delims = False
-            start_index = last_comma_index + 1
-        elif enough_delims and char == ",":
-            last_comma_index = i
+    start = 0
+    first_field = parts[0]
+    while start + num_delims <= last_part:
+        end = start + num_delims
+        if end == last_part:
+            last_field, next_field = parts[end], None
+        else:
+            last_field, _, next_field = parts[end].rpartition(",")
+        fields = parts[start:end + 1]
+        fields[0] = first_field
+        fields[-1] = last_field
+        # Don't add transcript if transcript gene is not what is expected
+        # (this can happen with overlapping genes)
+        if fields[symbol_index] == variant.gene_name:
+            transcripts.append(Transcript("|".join(fields),
+                                          fields[lof_index]))
+        first_field = next_field
+        start = end
+    variant.set_transcripts(transcripts)
 
 
 class Gene:
@@ -163,10 +268,15 @@ class Gene:
 
 
 class Transcript:
-    def __init__(self, info_str, lof_annot, header):
+    __slots__ = ('info_str', 'lof')
+
+    def __init__(self, info_str, lof):
+        """Args:
+            info_str: transcript annotation
+            lof: loss-of-function annotation of transcript
+        """
         self.info_str = info_str
-        lof_index = header.split("|").index(lof_annot)
-        self.lof = self.info_str.split("|")[lof_index]
+        self.lof = lof
 
     def __str__(self):
         return self.info_str
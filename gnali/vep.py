@@ -33,13 +33,16 @@ VEP_PATH = "{}/vep".format(DATA_PATH)
 
 class VEP:
     @classmethod
-    def annotate_vep_loftee(cls, header, records, db_config):
+    def annotate_vep_loftee(cls, header, records, db_config, fork=None):
         """Write vcf header and records to a file, then run
             VEP/LOFTEE on that file and return the output.
 
         Args:
             header: vcf header of input file
             records: contents of input file
+            db_config: database configuration as RuntimeConfig object
+            fork: number of VEP processes to fork, VEP runs in
+                  a single process if fork is None or 1
         """
         temp_dir = tempfile.TemporaryDirectory()
         temp_path = temp_dir.name
@@ -92,6 +95,8 @@ class VEP:
                                              conservation=conservation_db,
                                              gerp_form=gerp_format,
                                              gerp_file=gerp_scores)
+        if fork is not None and fork > 1:
+            run_vep_str += " --fork {}".format(fork)
         results = subprocess.run(run_vep_str.split())
         if results.returncode != 0:
             raise VEPRuntimeError("Error while running Ensembl-VEP with "
@@ -107,3 +112,141 @@ class VEP:
             lof_array.extend([line for line in lines if line[0] != "#"])
 
         return header, lof_array
+
+    @classmethod
+    def annotate_records(cls, header, records, db_config, fork=None,
+                         cache=None):
+        """Annotate records from any number of genes and database
+            files in a single VEP/LOFTEE run. Records are deduplicated
+            before the run, and the annotation of each is returned
+            by record key (see record_key()), so that it can be added
+            back to every record it came from. If a cache is given,
+            VEP only runs on records missing from it.
+
+        Args:
+            header: vcf header of input records
+            records: list of VCF records as strings
+            db_config: database configuration as RuntimeConfig object
+            fork: number of VEP processes to fork
+            cache: AnnotationCache object
+
+        Returns:
+            VEP output header, and a dictionary of annotations
+            by record key (None for records VEP didn't annotate)
+        """
+        unique = {}
+        for record in records:
+            unique.setdefault(record_key(record), record)
+
+        annotations = {}
+        vep_lines = None
+        if cache is not None:
+            annotations = cache.lookup(list(unique.keys()))
+            vep_lines = cache.get_header()
+            if vep_lines is None:
+                annotations = {}
+        misses = [record for key, record in unique.items()
+                  if key not in annotations]
+        if len(misses) == 0:
+            return add_header_lines(header, vep_lines), annotations
+
+        vep_header, vep_records = cls.annotate_vep_loftee(
+            header, misses, db_config, fork)
+
+        lof_prefix = "{}=".format(db_config.lof['id'])
+        new_annotations = {record_key(record): None for record in misses}
+        for record in vep_records:
+            info = record.rstrip("\n").split("\t")[7]
+            for info_item in info.split(";"):
+                if info_item.startswith(lof_prefix):
+                    new_annotations[record_key(record)] = \
+                        info_item[len(lof_prefix):]
+                    break
+        if cache is not None:
+            input_lines = set(str(line).rstrip("\n") for line in header)
+            vep_lines = [line.rstrip("\n") for line in vep_header
+                         if line.rstrip("\n") not in input_lines and
+                         not line.startswith("#CHROM")]
+            cache.store(new_annotations, vep_lines)
+        annotations.update(new_annotations)
+        return vep_header, annotations
+
+
+def get_loftee_path(assembly):
+    """Get the directory of the LOFTEE plugin installed for an assembly.
+
+    Args:
+        assembly: name of reference genome (ex. GRCh37)
+    """
+    return LOFTEE_PATH_GRCH38 if assembly == 'GRCh38' \
+        else LOFTEE_PATH_GRCH37
+
+
+def get_loftee_version(assembly):
+    """Get the version of the LOFTEE plugin installed for an
+        assembly, as the commit of its git checkout.
+
+    Args:
+        assembly: name of reference genome (ex. GRCh37)
+    """
+    git_path = "{}/.git".format(get_loftee_path(assembly))
+    try:
+        with open("{}/HEAD".format(git_path), 'r') as stream:
+            head = stream.read().strip()
+        if not head.startswith("ref:"):
+            return head
+        ref = head.split(":", 1)[1].strip()
+        ref_path = "{}/{}".format(git_path, ref)
+        if os.path.isfile(ref_path):
+            with open(ref_path, 'r') as stream:
+                return stream.read().strip()
+        with open("{}/packed-refs".format(git_path), 'r') as stream:
+            for line in stream:
+                if line.rstrip().endswith(" {}".format(ref)):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return "unknown"
+
+
+def add_header_lines(header, lines):
+    """Add VEP/LOFTEE header lines to a VCF header, before
+        its column header line.
+
+    Args:
+        header: VCF header lines
+        lines: lines to add
+    """
+    header = [str(line).rstrip("\n") for line in header]
+    if len(header) > 0 and header[-1].startswith("#CHROM"):
+        return header[:-1] + lines + header[-1:]
+    return header + lines
+
+
+def record_key(record):
+    """Get the key identifying a VCF record across VEP runs and
+        database files: its chromosome, position, reference
+        and alternate alleles.
+
+    Args:
+        record: VCF record as a string
+    """
+    chrom, pos, _, ref, alt = record.split("\t", 5)[:5]
+    return chrom, pos, ref, alt
+
+
+def add_annotation(record, lof_id, annotation):
+    """Add a VEP annotation to the INFO field of a VCF record.
+
+    Args:
+        record: VCF record as a string
+        lof_id: ID of the annotation INFO field (ex. CSQ)
+        annotation: value of the annotation
+    """
+    fields = record.rstrip("\n").split("\t")
+    annotation = "{}={}".format(lof_id, annotation)
+    if fields[7] in ("", "."):
+        fields[7] = annotation
+    else:
+        fields[7] = "{};{}".format(fields[7], annotation)
+    return "\t".join(fields)
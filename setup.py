@@ -18,10 +18,15 @@ import os
 import subprocess
 from setuptools import find_packages, setup
 
+# tabix_index(index=, csi=, min_shift=) and BGZipWriter(num_threads=)
+# are available from pysam 0.15.4 and bgzip 0.3.5
 dependencies = ['pybiomart', 'numpy', 'pandas',
-                'pysam<0.16', 'filelock', 'pyyaml', 'bgzip',
+                'pysam>=0.15.4,<0.16', 'filelock', 'pyyaml', 'bgzip>=0.3.5',
                 'progress', 'python-magic']
 
+# Parquet and Arrow output (--output_format)
+extras = {'arrow': ['pyarrow']}
+
 if os.getenv('PATCH') is not None:
     PATCH = "rc0.dev{}".format(os.getenv('PATCH'))
 else:
@@ -51,6 +56,7 @@ setup(
                        'vep-dependencies-dev.yaml'],
     },
     install_requires=dependencies,
+    extras_require=extras,
     entry_points = {
         'console_scripts': ['gnali=gnali.gnali:main',
                             'gnali_get_data=gnali.gnali_get_data:main'],
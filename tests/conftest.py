@@ -0,0 +1,50 @@
+"""
+Copyright Government of Canada 2020
+
+Written by: Xia Liu, National Microbiology Laboratory,
+            Public Health Agency of Canada
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+this work except in compliance with the License. You may obtain a copy of the
+License at:
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software distributed
+under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+CONDITIONS OF ANY KIND, either express or implied. See the License for the
+specific language governing permissions and limitations under the License.
+"""
+
+import pytest
+from pathlib import Path
+import pandas as pd
+from gnali import gnali, gene_index
+
+TEST_PATH = Path(__file__).parent.absolute()
+GNALI_ROOT_PATH = TEST_PATH.parent
+ENSEMBL_HUMAN_GENES = "{}/data/ensembl_hsapiens_dataset.csv".format(str(TEST_PATH))
+LOCAL_CCR5_DB = "{}/data/exomes_ccr5.vcf.bgz".format(str(TEST_PATH))
+
+
+@pytest.fixture
+def local_db(monkeypatch):
+    """Query the local CCR5 test database: run from the repository root,
+    where the paths of test configurations are relative to, and use the
+    database's Tabix index for every database file."""
+    monkeypatch.chdir(GNALI_ROOT_PATH)
+    def mock_get_db_tbi(data_file, data_path, max_time):
+        return "{}.tbi".format(LOCAL_CCR5_DB)
+    monkeypatch.setattr(gnali, "get_db_tbi", mock_get_db_tbi)
+    return LOCAL_CCR5_DB
+
+
+@pytest.fixture
+def local_gene_index(monkeypatch, tmp_path):
+    """Build gene indexes in a temporary directory, from the test
+    Ensembl dataset instead of Ensembl."""
+    def mock_get_human_genes(db_config):
+        human_genes = pd.read_csv(ENSEMBL_HUMAN_GENES)
+        return human_genes.drop(human_genes.columns[0], axis=1)
+    monkeypatch.setattr(gnali, "get_human_genes", mock_get_human_genes)
+    monkeypatch.setattr(gene_index, "GENE_INDEX_PATH", str(tmp_path / "gene-index"))
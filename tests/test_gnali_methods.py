@@ -19,6 +19,11 @@ specific language governing permissions and limitations under the License.
 import pytest
 import pathlib
 import urllib
+import urllib.error
+import urllib.request
+import shutil
+import io
+import gzip
 from pybiomart import Dataset, Server
 import pysam
 import re
@@ -34,12 +39,20 @@ from pathlib import Path
 import logging
 import subprocess
 from gnali import gnali
-from gnali.exceptions import EmptyFileError, TBIDownloadError, InvalidConfigurationError
+from gnali.exceptions import EmptyFileError, TBIDownloadError, InvalidConfigurationError, \
+                             GeneIndexError, NoVariantsAvailableError, ReferenceDownloadError
 from gnali.variants import Variant, Gene
 from gnali.filter import Filter
 from gnali.dbconfig import Config, RuntimeConfig, DataFile
+from gnali import gene_index
+from gnali.gene_index import GeneIndex, index_gene_locations
 from gnali import gnali_get_data
 from gnali.logging import Logger
+import gnali.outputs as outputs
+from gnali.vep import VEP
+from gnali import annotation_cache
+from gnali import remote_cache
+from gnali import files
 
 TEST_PATH = pathlib.Path(__file__).parent.absolute()
 TEST_INPUT_CSV = "{}/data/test_genes.csv".format(str(TEST_PATH))
@@ -61,14 +74,16 @@ MAX_TIME = 180
 DB_CONFIG_FILE = "{}/data/db-config.yaml".format(str(TEST_PATH))
 DB_CONFIG_NO_DEFAULT = "{}/data/db-config-no-default.yaml".format(str(TEST_PATH))
 DB_CONFIG_MISSING_REQ = "{}/data/db-config-missing-req.yaml".format(str(TEST_PATH))
+DB_CONFIG_LOCAL = "{}/data/db-config-local.yaml".format(str(TEST_PATH))
+LOCAL_CCR5_DB = "{}/data/exomes_ccr5.vcf.bgz".format(str(TEST_PATH))
 
 TEST_LOG_FILE = "{}/data/output_log/gnali_errors.log".format(str(TEST_PATH))
 
 
-class MockHeader:
-    headers = {"Content-Length": 0}
-    def read(self):
-        return ""
+class MockIndexResponse(io.BytesIO):
+    def __init__(self, path):
+        super().__init__(open(path, 'rb').read())
+        self.headers = {'ETag': '"1"'}
 
 class TestGNALIMethods:
 
@@ -104,25 +119,6 @@ class TestGNALIMethods:
     #########################################################
 
 
-    ### Tests for tbi_needed() ##############################
-    def test_tbi_needed_is_needed(self, monkeypatch):
-        def mock_open_header(req, *args, **kwargs):
-            return MockHeader
-        monkeypatch.setattr(urllib.request, "urlopen", mock_open_header)
-        with tempfile.TemporaryDirectory() as temp:
-            assert gnali.tbi_needed(TEST_DB_TBI_URL, temp)
-    
-    def test_tbi_needed_not_needed(self, monkeypatch):
-        def mock_open_header(req, *args, **kwargs):
-            return MockHeader
-        monkeypatch.setattr(urllib.request, "urlopen", mock_open_header)
-        with tempfile.TemporaryDirectory() as temp:
-            shutil.copyfile(TEST_DB_TBI, "{}/{}".format(temp, TEST_DB_TBI_NAME))
-            is_need =  gnali.tbi_needed(TEST_DB_TBI_URL, "{}/{}".format(temp, TEST_DB_TBI_NAME))
-            assert not is_need
-    #########################################################
-
-
     def test_download_file_invalid_url(self, monkeypatch):
         url = "http://badurl.com"
         with tempfile.TemporaryDirectory() as temp:
@@ -131,34 +127,92 @@ class TestGNALIMethods:
 
 
     ### Tests for get_db_tbi() ##############################
-    def test_get_db_tbi_happy(self, monkeypatch):
-        def mock_tbi_needed(url, dest_path):
-            return True
-        monkeypatch.setattr(gnali, "tbi_needed", mock_tbi_needed)
-        def mock_download_file(url, dest_path, max_time):
-            dest_path = tempfile.TemporaryFile().name
-        monkeypatch.setattr(gnali, "download_file", mock_download_file)
+    def test_get_db_tbi_happy(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(remote_cache, "REMOTE_INDEX_PATH", str(tmp_path))
+        def mock_urlopen(req, *args, **kwargs):
+            return MockIndexResponse(TEST_DB_TBI)
+        monkeypatch.setattr(urllib.request, "urlopen", mock_urlopen)
         with tempfile.TemporaryDirectory() as temp:
             db_config_file = open(DB_CONFIG_FILE, 'r')
             db_config = Config(None, yaml.load(db_config_file.read(), Loader=yaml.FullLoader))
             db_config = RuntimeConfig(db_config)
-            assert gnali.get_db_tbi(db_config.files[0], temp, MAX_TIME)
-    
-    def test_get_db_tbi_lock_timeout_exception(self, monkeypatch):
-        with tempfile.TemporaryDirectory() as temp:
-            temp = tempfile.TemporaryDirectory()
-            tbi_path = "{}/{}".format(temp.name, TEST_DB_TBI_NAME)
-            shutil.copyfile(TEST_DB_TBI, tbi_path)
-            def mock_lock_acquire(*args, **kwargs):
-                raise TimeoutError
-            monkeypatch.setattr(filelock.FileLock, "acquire", mock_lock_acquire)
-            def mock_download_file(url, dest_path, max_time):
-                dest_path = tempfile.TemporaryFile().name
-            monkeypatch.setattr(gnali, "download_file", mock_download_file)
-            db_config_file = open(DB_CONFIG_FILE, 'r')
-            db_config = Config(None, yaml.load(db_config_file.read(), Loader=yaml.FullLoader))
-            db_config = RuntimeConfig(db_config)
-            assert gnali.get_db_tbi(db_config.files[0], tbi_path, MAX_TIME)  
+            tbi_path = gnali.get_db_tbi(db_config.files[0], temp, MAX_TIME)
+            assert filecmp.cmp(tbi_path, TEST_DB_TBI, shallow=False)
+            assert tbi_path.startswith(str(tmp_path))
+
+    def test_get_db_tbi_lock_timeout_exception(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(remote_cache, "REMOTE_INDEX_PATH", str(tmp_path))
+        def mock_lock_acquire(*args, **kwargs):
+            raise TimeoutError
+        monkeypatch.setattr(filelock.FileLock, "acquire", mock_lock_acquire)
+        def mock_urlopen(req, *args, **kwargs):
+            return MockIndexResponse(TEST_DB_TBI)
+        monkeypatch.setattr(urllib.request, "urlopen", mock_urlopen)
+        db_config_file = open(DB_CONFIG_FILE, 'r')
+        db_config = Config(None, yaml.load(db_config_file.read(), Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        # index is downloaded outside of the cache
+        tbi_path = gnali.get_db_tbi(db_config.files[0], str(tmp_path), MAX_TIME)
+        assert filecmp.cmp(tbi_path, TEST_DB_TBI, shallow=False)
+        assert not tbi_path.startswith(str(tmp_path))
+
+    def test_get_db_tbi_csi(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(remote_cache, "REMOTE_INDEX_PATH", str(tmp_path / "cache"))
+        data_bgz = str(tmp_path / "exomes.vcf.bgz")
+        shutil.copyfile(LOCAL_CCR5_DB, data_bgz)
+        csi_path = files.build_index(data_bgz, min_shift=14)
+        def mock_urlopen(req, *args, **kwargs):
+            if not req.full_url.endswith(".csi"):
+                raise urllib.error.HTTPError(req.full_url, 404, "Not Found", {}, None)
+            return MockIndexResponse(csi_path)
+        monkeypatch.setattr(urllib.request, "urlopen", mock_urlopen)
+        data_file = DataFile("exomes", {'path': "http://db/exomes.vcf.bgz"})
+        index_path = gnali.get_db_tbi(data_file, str(tmp_path), MAX_TIME)
+        assert filecmp.cmp(index_path, csi_path, shallow=False)
+        data_file.set_index_path(index_path)
+        assert data_file.index_type == 'csi'
+
+        # the index type of each database file is recorded for the run
+        db_config = RuntimeConfig(self.get_db_config(DB_CONFIG_LOCAL, None))
+        db_config.files[0].set_index_path(index_path)
+        gnali.write_run_metadata(db_config, str(tmp_path))
+        metadata = yaml.safe_load(open("{}/{}".format(tmp_path, gnali.RUN_METADATA_FILE)))
+        assert metadata['database'] == db_config.name
+        assert metadata['files'][db_config.files[0].name] == \
+            {'path': db_config.files[0].path, 'index': index_path, 'index_type': 'csi'}
+    ########################################################
+
+
+    ### Tests for compress_vcf() ############################
+    def test_compress_vcf_local(self, monkeypatch, tmp_path):
+        vcf_path = tmp_path / "exomes.vcf"
+        vcf_path.write_bytes(gzip.open(LOCAL_CCR5_DB, 'rb').read())
+        # compress in many small chunks
+        monkeypatch.setattr(files, "COMPRESS_CHUNK_SIZE", 1000)
+        data_bgz = gnali.compress_vcf(str(vcf_path), str(tmp_path), "exomes.vcf",
+                                      num_threads=2)
+        assert data_bgz == "{}/exomes.vcf.bgz".format(tmp_path)
+        with gzip.open(data_bgz, 'rb') as bgz:
+            assert bgz.read() == vcf_path.read_bytes()
+        # a valid BGZF file can be indexed
+        pysam.tabix_index(data_bgz, preset='vcf', force=True)
+        with pysam.TabixFile(data_bgz) as tbx:
+            assert len(list(tbx.fetch("3", 46411632, 46417697))) > 0
+
+    def test_compress_vcf_http(self, monkeypatch, tmp_path):
+        content = gzip.open(LOCAL_CCR5_DB, 'rb').read()
+        def mock_urlopen(url, *args, **kwargs):
+            if url != "http://db/exomes.vcf":
+                raise urllib.error.URLError("not found")
+            return io.BytesIO(content)
+        monkeypatch.setattr(urllib.request, "urlopen", mock_urlopen)
+        data_bgz = gnali.compress_vcf("http://db/exomes.vcf", str(tmp_path), "exomes.vcf",
+                                      MAX_TIME)
+        with gzip.open(data_bgz, 'rb') as bgz:
+            assert bgz.read() == content
+        with pytest.raises(ReferenceDownloadError):
+            gnali.compress_vcf("http://db/genomes.vcf", str(tmp_path), "genomes.vcf", MAX_TIME)
+        assert not os.path.exists("{}/genomes.vcf.bgz".format(tmp_path))
     ########################################################
 
     
@@ -174,16 +228,57 @@ class TestGNALIMethods:
     def test_get_db_config_missing_req(self):
         with pytest.raises(InvalidConfigurationError):
             assert gnali.get_db_config(DB_CONFIG_MISSING_REQ, '')
+
+    def test_read_config_file_cache(self, monkeypatch, tmp_path):
+        loads = []
+        load = yaml.load
+        def mock_load(*args, **kwargs):
+            loads.append(args)
+            return load(*args, **kwargs)
+        monkeypatch.setattr(gnali.yaml, "load", mock_load)
+        config_file = tmp_path / "db-config.yaml"
+        shutil.copyfile(DB_CONFIG_LOCAL, config_file)
+
+        # unchanged files are only parsed once, copies can be modified
+        config = gnali.read_config_file(str(config_file))
+        config['default'] = "modified"
+        assert gnali.get_db_config(str(config_file), None).name == "ccr5-local"
+        assert len(loads) == 1
+
+        # files are parsed again when they change
+        text = config_file.read_text().replace("ccr5-local", "ccr5-changed")
+        config_file.write_text(text)
+        os.utime(config_file, ns=(0, 0))
+        assert gnali.get_db_config(str(config_file), None).name == "ccr5-changed"
+        assert len(loads) == 2
+
+    def test_startup(self):
+        # the command line is parsed without importing heavy modules
+        # or reading the configuration file
+        heavy_modules = ['pandas', 'numpy', 'pybiomart', 'pysam', 'bgzip',
+                         'magic', 'filelock', 'pkg_resources']
+        script = ("import sys\n"
+                  "from gnali import gnali\n"
+                  "gnali.read_config_file = None\n"
+                  "try:\n"
+                  "    gnali.init_parser('id').parse_args(sys.argv[1:])\n"
+                  "except SystemExit:\n"
+                  "    pass\n"
+                  "print(' '.join(name for name in {}\n"
+                  "               if name in sys.modules))\n"
+                  .format(heavy_modules))
+        for args in [["-V"], ["-i", "genes.txt", "-d", "gnomadv3.1.1",
+                              "-p", "homozygous"]]:
+            output = subprocess.run([sys.executable, "-c", script] + args,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.DEVNULL,
+                                    universal_newlines=True).stdout
+            assert output.splitlines()[-1] == ""
     ########################################################
 
 
-    def test_get_test_gene_descs(self, monkeypatch):
+    def test_get_test_gene_descs(self, local_gene_index):
         genes_list = ['CCR5', 'ALCAM']
-        def mock_get_human_genes(db_config):
-            human_genes = pd.read_csv(ENSEMBL_HUMAN_GENES) 
-            human_genes.drop(human_genes.columns[0], axis=1, inplace=True)
-            return human_genes
-        monkeypatch.setattr(gnali, "get_human_genes", mock_get_human_genes)
 
         db_config_file = open(DB_CONFIG_FILE, 'r')
         db_config = Config(None, yaml.load(db_config_file.read(), Loader=yaml.FullLoader))
@@ -207,7 +302,8 @@ class TestGNALIMethods:
         unavailable_genes = [gene for gene in target_gene_names if gene not in
                             list(gene_descriptions['hgnc_symbol'])]
 
-        method_genes, method_gene_descs = gnali.get_test_gene_descriptions(genes_data, db_config, None, False)
+        method_genes, method_gene_descs, method_locations = \
+            gnali.get_test_gene_descriptions(genes_data, db_config, None, False)
 
         for gene in genes_data:
             if gene.name in unavailable_genes:
@@ -217,6 +313,57 @@ class TestGNALIMethods:
 
         assert method_genes == expected_genes
         assert expected_gene_descs.equals(method_gene_descs)
+        assert method_locations == index_gene_locations(expected_gene_descs)[0]
+
+
+    ### Tests for the gene index ##########################
+    def test_gene_index_query(self, tmp_path):
+        human_genes = pd.read_csv(ENSEMBL_HUMAN_GENES)
+        human_genes.drop(human_genes.columns[0], axis=1, inplace=True)
+        index = GeneIndex("GRCh37", "http://grch37.ensembl.org", str(tmp_path))
+        assert index.needs_refresh(720)
+        index.build(human_genes)
+        assert not index.needs_refresh(720)
+
+        method_genes = index.query(['CCR5', 'ALCAM', 'NOTAGENE'])
+        assert list(method_genes['hgnc_symbol']) == ['CCR5', 'ALCAM']
+        ccr5 = method_genes.iloc[0]
+        assert (ccr5['chromosome_name'], ccr5['start_position'], ccr5['end_position']) == \
+               ('3', 46411633, 46417697)
+
+    def test_gene_index_needs_refresh(self, tmp_path):
+        human_genes = pd.read_csv(ENSEMBL_HUMAN_GENES, nrows=10)
+        human_genes.drop(human_genes.columns[0], axis=1, inplace=True)
+        index = GeneIndex("GRCh37", "http://grch37.ensembl.org", str(tmp_path))
+        index.build(human_genes)
+        assert not index.needs_refresh(0)
+        assert index.needs_refresh(-1)
+        # an index built from another host is not reused
+        other_host = GeneIndex("GRCh37", "http://grch37.ensembl.org", str(tmp_path))
+        other_host.ref_genome_path = "http://ensembl.org"
+        assert other_host.needs_refresh(720)
+
+    def test_load_gene_index_offline(self, monkeypatch, tmp_path):
+        monkeypatch.setattr(gene_index, "GENE_INDEX_PATH", str(tmp_path))
+        def mock_get_human_genes(db_config):
+            raise urllib.error.URLError("no network")
+        monkeypatch.setattr(gnali, "get_human_genes", mock_get_human_genes)
+        db_config_file = open(DB_CONFIG_FILE, 'r')
+        db_config = Config(None, yaml.load(db_config_file.read(), Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        # no index to fall back on
+        with pytest.raises(GeneIndexError):
+            gnali.load_gene_index(db_config)
+
+        human_genes = pd.read_csv(ENSEMBL_HUMAN_GENES)
+        human_genes.drop(human_genes.columns[0], axis=1, inplace=True)
+        index = GeneIndex(db_config.ref_genome_name, db_config.ref_genome_path)
+        index.build(human_genes)
+        # an expired index is used when Ensembl can't be reached
+        db_config.gene_index_ttl = 1e-9
+        index = gnali.load_gene_index(db_config)
+        assert list(index.query(['CCR5'])['hgnc_symbol']) == ['CCR5']
+    ########################################################
 
 
     def test_find_test_locations(self):
@@ -249,6 +396,17 @@ class TestGNALIMethods:
     
         assert method_test_locations == genes
 
+    def test_index_gene_locations_duplicates(self):
+        gene_descs = pd.DataFrame({'hgnc_symbol': ['CCR5', 'ALCAM', 'ALCAM', 'CCR5'],
+                                   'chromosome_name': ['3', '3', '3', '3'],
+                                   'start_position': [46411633, 105085753, 105085753, 1],
+                                   'end_position': [46417697, 105295744, 105295744, 2]})
+        locations, duplicates = index_gene_locations(gene_descs)
+        assert locations == {'CCR5': ('3', 46411633, 46417697),
+                             'ALCAM': ('3', 105085753, 105295744)}
+        # ALCAM appears twice with the same locus, only CCR5 has several loci
+        assert duplicates == ['CCR5']
+
     ### Tests for get_plof_variants() ######################
     def test_get_variants_happy(self, monkeypatch):
         target_genes = [Gene('CCR5', location="3:46411633-46417697")]
@@ -277,6 +435,109 @@ class TestGNALIMethods:
         assert expected_variants == method_variants
 
 
+    def test_get_variants_overlapping_genes(self, local_db):
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        db_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        locations = {'CCR5': "3:46411633-46417697", 'RP11-24F11.2': "3:46414000-46416000"}
+
+        # overlapping genes are fetched together and should get the same
+        # variants as when they're fetched separately
+        merged_genes = [Gene(name, location=loc) for name, loc in locations.items()]
+        gnali.get_variants(merged_genes, db_config, [], None, None, False)
+        for gene in merged_genes:
+            single_gene = [Gene(gene.name, location=gene.location)]
+            gnali.get_variants(single_gene, db_config, [], None, None, False)
+            assert [str(var) for var in gene.variants] == \
+                   [str(var) for var in single_gene[0].variants]
+            assert [[str(trans) for trans in var.transcripts] for var in gene.variants] == \
+                   [[str(trans) for trans in var.transcripts] for var in single_gene[0].variants]
+            assert gene.status == single_gene[0].status
+        assert merged_genes[0].num_variants() > 0
+
+    def test_get_variants_workers(self, local_db):
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        db_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        locations = [('CCR5', "3:46411633-46417697"), ('RP11-24F11.2', "3:46414000-46416000"),
+                     ('NOPE', "3:1-1000"), ('GENEY', "Y:1-2")]
+
+        serial_genes = [Gene(name, location=loc) for name, loc in locations]
+        gnali.get_variants(serial_genes, db_config, [Filter("AC", "AC>1")], None, None, False)
+        parallel_genes = [Gene(name, location=loc) for name, loc in locations]
+        gnali.get_variants(parallel_genes, db_config, [Filter("AC", "AC>1")], None, None, False,
+                           workers=4)
+        for serial_gene, parallel_gene in zip(serial_genes, parallel_genes):
+            assert str(serial_gene) == str(parallel_gene)
+            assert [str(var) for var in serial_gene.variants] == \
+                   [str(var) for var in parallel_gene.variants]
+
+    def test_get_variants_multiple_files(self, local_db):
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        single_config = RuntimeConfig(db_config)
+        single_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        db_config.files['copy'] = list(db_config.files.values())[0]
+        multi_config = RuntimeConfig(db_config)
+        for data_file in multi_config.files:
+            data_file.set_compressed_path(LOCAL_CCR5_DB)
+
+        single_genes = [Gene('CCR5', location="3:46411633-46417697")]
+        gnali.get_variants(single_genes, single_config, [], None, None, False)
+        multi_genes = [Gene('CCR5', location="3:46411633-46417697")]
+        gnali.get_variants(multi_genes, multi_config, [], None, None, False,
+                           workers=3)
+        single_variants = [str(var) for var in single_genes[0].variants]
+        # results are merged in file order
+        assert [str(var) for var in multi_genes[0].variants] == \
+               single_variants + single_variants
+        assert multi_genes[0].status == single_genes[0].status
+
+    def test_get_variants_single_vep_run(self, monkeypatch, tmp_path, local_db):
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        annotated_config = RuntimeConfig(db_config)
+        annotated_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        db_config.files['copy'] = list(db_config.files.values())[0]
+        vep_config = RuntimeConfig(db_config)
+        for data_file in vep_config.files:
+            data_file.set_compressed_path(LOCAL_CCR5_DB)
+        vep_config.has_lof_annots = False
+        vep_config.vep_version = 104
+        monkeypatch.setattr(annotation_cache, "ANNOTATION_CACHE_PATH", str(tmp_path))
+
+        # the test database is already annotated, so VEP output is
+        # the input records with the header of the database
+        tbx = pysam.TabixFile(LOCAL_CCR5_DB)
+        vep_header = list(tbx.header)
+        tbx.close()
+        vep_calls = []
+        def mock_annotate_vep_loftee(header, records, db_info, fork=None):
+            vep_calls.append(records)
+            return vep_header, records
+        monkeypatch.setattr(VEP, "annotate_vep_loftee", mock_annotate_vep_loftee)
+
+        locations = [('CCR5', "3:46411633-46417697"), ('RP11-24F11.2', "3:46414000-46416000"),
+                     ('GENEY', "Y:1-2")]
+        annotated_genes = [Gene(name, location=loc) for name, loc in locations]
+        gnali.get_variants(annotated_genes, annotated_config, [], None, None, False)
+        vep_genes = [Gene(name, location=loc) for name, loc in locations]
+        header = gnali.get_variants(vep_genes, vep_config, [], None, None, False,
+                                    workers=2)
+
+        # one VEP run for all genes and files, without duplicate records
+        assert len(vep_calls) == 1
+        assert len(vep_calls[0]) == len(set(vep_calls[0]))
+        assert header == vep_header
+        assert len(annotated_genes[0].variants) > 0
+        for annotated_gene, vep_gene in zip(annotated_genes, vep_genes):
+            assert annotated_gene.status == vep_gene.status
+            assert len(vep_gene.variants) == 2 * len(annotated_gene.variants)
+            assert [var.as_tuple_vep('CSQ') for var in vep_gene.variants] == \
+                   [var.as_tuple_vep('CSQ') for var in annotated_gene.variants] * 2
+
     def test_get_variants_tabix_error(self, monkeypatch, capfd):
         target_list = [Gene('GENE1', location="Y:2000000000-2000000001")]
 
@@ -360,6 +621,148 @@ class TestGNALIMethods:
 
         assert expected_results.equals(method_results)
 
+    def test_extract_lof_annotations_columns(self, local_db):
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        db_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        genes = [Gene('CCR5', location="3:46411633-46417697")]
+        gnali.get_variants(genes, db_config, [], None, None, False)
+
+        results, results_as_vcf = gnali.extract_lof_annotations(genes, db_config, True)
+        assert list(results.columns) == ["Chromosome", "Position_Start", "RSID",
+                                         "Reference_Allele", "Alternate_Allele",
+                                         "Score", "Quality", "LoF_Variant",
+                                         "LoF_Annotation", "HGNC_Symbol", "Ensembl Code",
+                                         "HGVSc"] + list(db_config.population_frequencies)
+        assert len(results) == sum(var.num_transcripts() for var in genes[0].variants)
+        assert len(results_as_vcf) == len(genes[0].variants)
+        first = genes[0].variants[0]
+        fields = str(first.transcripts[0]).split("|")
+        assert results.iloc[0][["Position_Start", "LoF_Annotation", "HGVSc"]].tolist() == \
+               [first.pos, fields[1], fields[10]]
+
+        with pytest.raises(NoVariantsAvailableError):
+            gnali.extract_lof_annotations([Gene('GENE1')], db_config, False)
+
+    def test_stream_results(self, tmp_path, local_db):
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        db_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        locations = [('CCR5', "3:46411633-46417697"), ('RP11-24F11.2', "3:46414000-46416000"),
+                     ('GENEY', "Y:1-2")]
+
+        genes = [Gene(name, location=loc) for name, loc in locations]
+        header = gnali.get_variants(genes, db_config, [], None, None, False)
+        results, results_as_vcf = gnali.extract_lof_annotations(genes, db_config, True)
+        gnali.write_results_all(results, genes, header, results_as_vcf, str(tmp_path), True)
+
+        stream_dir = tmp_path / "stream"
+        stream_dir.mkdir()
+        writer = outputs.StreamWriter("{}/{}".format(stream_dir, gnali.RESULTS_DETAILED_FILE),
+                                      "{}/{}".format(stream_dir, gnali.RESULTS_VCF_FILE))
+        stream_genes = [Gene(name, location=loc) for name, loc in locations]
+        gnali.get_variants(stream_genes, db_config, [], None, None, False, workers=2,
+                           on_variants=gnali.stream_results(writer, db_config, True))
+        gnali.write_results_basic(stream_genes, str(stream_dir))
+
+        # genes don't hold their variants, statuses are the same
+        assert all(gene.num_variants() == 0 for gene in stream_genes)
+        assert [str(gene) for gene in stream_genes] == [str(gene) for gene in genes]
+        for file_name in [gnali.RESULTS_BASIC_FILE, gnali.RESULTS_DETAILED_FILE,
+                          gnali.RESULTS_VCF_FILE]:
+            with open("{}/{}".format(tmp_path, file_name)) as stream:
+                expected = stream.readlines()
+            with open("{}/{}".format(stream_dir, file_name)) as stream:
+                streamed = stream.readlines()
+            assert streamed[0] == expected[0]
+            assert sorted(streamed) == sorted(expected)
+        assert writer.num_results == len(results)
+
+    def test_output_formats(self, tmp_path, local_db):
+        pa = pytest.importorskip("pyarrow")
+        import pyarrow.parquet
+        db_config = Config('ccr5-local', yaml.load(open(DB_CONFIG_LOCAL, 'r').read(),
+                                                   Loader=yaml.FullLoader))
+        db_config = RuntimeConfig(db_config)
+        db_config.files[0].set_compressed_path(LOCAL_CCR5_DB)
+        genes = [Gene('CCR5', location="3:46411633-46417697")]
+        header = gnali.get_variants(genes, db_config, [], None, None, False)
+        info_types = gnali.parse_info_types(header)
+        results, results_as_vcf = gnali.extract_lof_annotations(genes, db_config, True,
+                                                                info_types)
+        gnali.write_results_all(results, genes, header, results_as_vcf[::-1],
+                                str(tmp_path), True, 'parquet', 'bgz')
+
+        table = pa.parquet.read_table(gnali.get_results_detailed_path(str(tmp_path),
+                                                                      'parquet'))
+        assert table.num_rows == len(results)
+        assert table.schema.field('Position_Start').type == pa.int64()
+        assert table.schema.field('Score').type == pa.float64()
+        assert table.schema.field('Chromosome').type == pa.string()
+        for name, group in db_config.population_frequencies.items():
+            expected = pa.int64() if info_types[group][1] == 'Integer' else pa.float64()
+            assert table.schema.field(name).type == expected
+
+        # records are sorted (despite being written in reverse) and indexed
+        vcf_path = gnali.get_results_vcf_path(str(tmp_path), 'bgz')
+        assert os.path.isfile("{}.tbi".format(vcf_path))
+        assert not os.path.exists(vcf_path[:-len(".gz")])
+        with pysam.TabixFile(vcf_path) as vcf:
+            records = list(vcf.fetch("3", 46411633, 46417697))
+        assert records == [record.rstrip("\n") for record in results_as_vcf]
+
+        # streamed Arrow output has the same schema, even when written in parts
+        writer = outputs.StreamWriter(gnali.get_results_detailed_path(str(tmp_path), 'arrow'),
+                                      None, 'arrow')
+        writer.append_results(results.iloc[:3])
+        writer.append_results(results.iloc[3:])
+        writer.close()
+        with pa.ipc.open_file(gnali.get_results_detailed_path(str(tmp_path), 'arrow')) as reader:
+            streamed = reader.read_all()
+        assert streamed.schema.equals(table.schema, check_metadata=False)
+        assert streamed.to_pandas().equals(table.to_pandas())
+
+        # streamed compressed VCF is merged from sorted runs, records are
+        # only deduplicated within a region
+        stream_dir = tmp_path / "stream"
+        stream_dir.mkdir()
+        vcf_path = gnali.get_results_vcf_path(str(stream_dir), 'bgz')
+        writer = outputs.StreamWriter(gnali.get_results_detailed_path(str(stream_dir)),
+                                      vcf_path, 'tsv', 'bgz')
+        first, second = object(), object()
+        writer.append_vcf(header, results_as_vcf[3:][::-1], second)
+        writer.append_vcf(header, results_as_vcf[3:], second)
+        writer.append_vcf(header, results_as_vcf[:3], first)
+        writer.close()
+        assert writer.num_records == len(results_as_vcf)
+        # the runs are removed with the plain file
+        assert sorted(os.listdir(str(stream_dir))) == [os.path.basename(vcf_path),
+                                                       os.path.basename(vcf_path) + ".tbi"]
+        with pysam.TabixFile(vcf_path) as vcf:
+            records = list(vcf.fetch("3", 46411633, 46417697))
+        assert records == [record.rstrip("\n") for record in results_as_vcf]
+
+    def test_extract_pop_freqs(self):
+        header = '##INFO=<ID=CSQ,Description="Format: Allele|SYMBOL|LoF|LoF_info">'
+        records = ["3\t100\t.\tA\tT\t.\tPASS\tAC_afr=3;AF_afr=0.5;CSQ=T|CCR5|HC|,T|CCR5|HC|",
+                   "3\t200\t.\tG\tC\t.\tPASS\tAF_afr=.;CSQ=C|CCR5|HC|"]
+        variants = [Variant("CCR5", record, "CSQ", "LoF", header) for record in records]
+
+        class MockConfig:
+            population_frequencies = {'african-AC': 'AC_afr', 'african-AF': 'AF_afr',
+                                      'male-AF': 'AF_male'}
+        pop_freqs = gnali.extract_pop_freqs(variants, MockConfig)
+        # one row per transcript
+        assert pop_freqs.values.tolist() == [['3', '5.0000000000e-01', '-'],
+                                             ['3', '5.0000000000e-01', '-'],
+                                             ['-', '-', '-']]
+        pop_freqs = gnali.extract_pop_freqs(variants, MockConfig, numeric=True)
+        assert pop_freqs['african-AC'].tolist()[:2] == [3.0, 3.0]
+        assert pop_freqs['african-AF'].tolist()[:2] == [0.5, 0.5]
+        assert pop_freqs.iloc[2].isna().all()
+
     def test_write_results(self):
         results_dir = tempfile.TemporaryDirectory().name
         expected_results_dir = "{}/expected_results".format(results_dir)
@@ -20,12 +20,37 @@ import os
 import pytest
 from pathlib import Path
 import pysam
-from gnali.vep import VEP
+from gnali.vep import VEP, add_annotation, record_key
+from gnali.annotation_cache import AnnotationCache
+from gnali.remote_cache import RemoteIndexCache
+from gnali.region_cache import RegionCache
+from gnali.local_cache import LocalFileCache
+import gnali.local_cache as local_cache
+import gnali.files as files
+import gzip
+import shutil
+import gnali as gnali_package
+from gnali import api, batch, cache, db_slice, environment, gnali, gene_index, \
+    gnali_get_data, server, vep
+import tempfile
+import json
+import threading
+import gnali.remote_cache as remote_cache
+import urllib.error
+import urllib.request
+import io
+import zlib
 import gnali.outputs as outputs
 from gnali.dbconfig import Config, RuntimeConfig
 import yaml
+import sys
+import pandas as pd
 from gnali.gnali_get_data import Dependencies
-from gnali.variants import Variant, split_transcripts_from_rec
+from gnali.variants import Variant, Gene, InfoFields, split_transcripts_from_rec
+from gnali.filter import Filter, parse_info_types
+from gnali.exceptions import InvalidFilterError, TBIDownloadError, \
+    InvalidConfigurationError
+from gnali.regions import IntervalTree, Region, plan_regions, record_interval
 
 TEST_PATH = str(Path(__file__).parent.absolute())
 TEST_DATA_PATH = "{}/data".format(TEST_PATH)
@@ -42,10 +67,34 @@ GNALI_PATH = "{}/gnali".format(str(GNALI_ROOT_PATH))
 DEPS_SUMS_FILE = "{}/dependency_sums.txt".format(TEST_DATA_PATH)
 DEPS_VERSION_FILE = "{}/data/dependency_version.txt".format(GNALI_PATH)
 
+DB_CONFIG_LOCAL = "{}/db-config-local.yaml".format(TEST_DATA_PATH)
+LOCAL_CCR5_DB = "{}/exomes_ccr5.vcf.bgz".format(TEST_DATA_PATH)
+
 TEST_VEP_RECORD = "{}/test_vep_record.txt".format(TEST_DATA_PATH)
 TEST_VEP_RECORD_OUTPUT_1 = "{}/test_vep_record_transcripts.txt".format(TEST_DATA_PATH)
 TEST_VEP_RECORD_OUTPUT_2 = "{}/test_vep_record_transcripts_2.txt".format(TEST_DATA_PATH)
 
+class MockIndexServer:
+    def __init__(self, files):
+        self.files = files
+        self.requests = []
+        self.down = False
+
+    def urlopen(self, request, timeout=None):
+        self.requests.append(dict(request.header_items()))
+        if self.down:
+            raise urllib.error.URLError("timed out")
+        content = self.files.get(request.full_url)
+        if content is None:
+            raise urllib.error.HTTPError(request.full_url, 404, "Not Found", {}, None)
+        etag = '"{}"'.format(content.decode())
+        if request.get_header('If-none-match') == etag:
+            raise urllib.error.HTTPError(request.full_url, 304, "Not Modified", {}, None)
+        response = io.BytesIO(content)
+        response.headers = {'ETag': etag}
+        return response
+
+
 class TestOtherMethods:
 
     def test_vep_annotate(self):
@@ -124,6 +173,653 @@ class TestOtherMethods:
             assert method_transcripts == expected_transcripts
         
 
+    def test_split_transcripts_without_newline(self):
+        with open(TEST_VEP_RECORD, 'r') as stream:
+            lines = stream.readlines()
+            header = [line for line in lines if line[0] == '#'][0]
+            record = [line for line in lines if line[0] != '#'][0]
+        with_newline = MockVariant("COL6A5", record)
+        split_transcripts_from_rec(with_newline, header, "vep", "LoF")
+        # records fetched with Tabix don't end with a newline
+        without_newline = MockVariant("COL6A5", record.rstrip("\n"))
+        split_transcripts_from_rec(without_newline, header, "vep", "LoF")
+        assert [str(trans) for trans in without_newline.transcripts] == \
+               [str(trans) for trans in with_newline.transcripts]
+        assert [trans.lof for trans in with_newline.transcripts][:3] == ['HC', '', 'LC']
+
+    def test_plan_regions(self):
+        genes = [Gene('A', location="3:100-200"), Gene('B', location="3:150-300"),
+                 Gene('C', location="3:301-400"), Gene('D', location="3:500-600"),
+                 Gene('E', location="Y:1-10"), Gene('F')]
+        regions = plan_regions(genes)
+        # overlapping (A, B) and adjacent (B, C) genes are merged
+        assert [str(region) for region in regions] == ["3:100-400", "3:500-600", "Y:1-10"]
+        assert [gene.name for gene in regions[0].get_genes()] == ['A', 'B', 'C']
+
+    def test_interval_tree_overlap(self):
+        intervals = [(start, start + length, (start, length))
+                     for start in range(0, 300, 7) for length in (0, 5, 40)]
+        tree = IntervalTree(intervals)
+        for query_start in range(-10, 320, 3):
+            query_end = query_start + 4
+            expected = sorted(value for start, end, value in intervals
+                              if start <= query_end and end >= query_start)
+            assert sorted(tree.overlap(query_start, query_end)) == expected
+
+    def test_record_interval(self):
+        assert record_interval("3\t100\t.\tAT\tA\t.\tPASS\tAC=1") == (100, 101)
+        assert record_interval("3\t100\t.\tA\t<DEL>\t.\tPASS\tAC=1;END=150\n") == (100, 150)
+        assert record_interval("3\t100\t.\tA\tT\t.\tPASS\tBLEND=150") == (100, 100)
+
+
+    def test_annotation_cache(self, tmp_path):
+        cache = AnnotationCache('GRCh37', 104, 'abc', cache_dir=str(tmp_path))
+        assert cache.lookup([('3', '100', 'A', 'T')]) == {}
+        assert cache.get_header() is None
+        cache.store({('3', '100', 'A', 'T'): 'T|stop_gained|HC',
+                     ('3', '250000', 'G', 'C'): None},
+                    ['##INFO=<ID=CSQ,Format=Allele|Consequence|LoF>'])
+        keys = [('3', '100', 'A', 'T'), ('3', '100', 'A', 'G'),
+                ('3', '250000', 'G', 'C'), ('X', '100', 'A', 'T')]
+        assert cache.lookup(keys) == {('3', '100', 'A', 'T'): 'T|stop_gained|HC',
+                                      ('3', '250000', 'G', 'C'): None}
+        assert cache.get_header() == ['##INFO=<ID=CSQ,Format=Allele|Consequence|LoF>']
+        # other VEP or LOFTEE versions don't see these annotations
+        assert AnnotationCache('GRCh37', 105, 'abc', cache_dir=str(tmp_path)) \
+            .lookup(keys) == {}
+        assert AnnotationCache('GRCh37', 104, 'def', cache_dir=str(tmp_path)) \
+            .lookup(keys) == {}
+
+    def test_annotate_records_cache(self, tmp_path, monkeypatch):
+        header = ['##fileformat=VCFv4.2', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO']
+        vep_line = '##INFO=<ID=CSQ,Number=.,Type=String,Format=Allele|LoF>'
+        records = ["3\t100\trs1\tA\tT\t.\tPASS\tAC=1",
+                   "3\t200\t.\tG\tC\t.\tPASS\tAC=2"]
+        vep_inputs = []
+        def mock_annotate_vep_loftee(header, records, db_config, fork=None):
+            vep_inputs.append(records)
+            vep_header = header[:1] + [vep_line + '\n'] + header[1:]
+            # VEP doesn't annotate the record at position 200
+            return vep_header, [add_annotation(record, 'CSQ', 'T|HC') + '\n'
+                                for record in records if '\t100\t' in record]
+        monkeypatch.setattr(VEP, "annotate_vep_loftee", mock_annotate_vep_loftee)
+        db_config = MockConfig()
+        cache = AnnotationCache('GRCh37', 104, 'abc', cache_dir=str(tmp_path))
+
+        _, annotations = VEP.annotate_records(header, records, db_config, cache=cache)
+        assert annotations == {record_key(records[0]): 'T|HC',
+                               record_key(records[1]): None}
+        # second run is answered from the cache, including the header
+        more_records = records + ["3\t100\trs2\tA\tT\t.\tPASS\tAC=5"]
+        cached_header, cached = VEP.annotate_records(header, more_records, db_config,
+                                                     cache=cache)
+        assert len(vep_inputs) == 1
+        assert cached == annotations
+        assert cached_header == [header[0], vep_line, header[1]]
+
+    def test_remote_index_cache_csi(self, tmp_path, monkeypatch):
+        server = MockIndexServer({'http://db/a.vcf.bgz.csi': b'index-1'})
+        monkeypatch.setattr(urllib.request, "urlopen", server.urlopen)
+        cache = RemoteIndexCache(cache_dir=str(tmp_path), ttl=1)
+        # a CSI index is used when the server has no TBI index
+        path = cache.get_index('http://db/a.vcf.bgz', 10)
+        assert path.endswith(".csi") and open(path, 'rb').read() == b'index-1'
+        assert len(server.requests) == 2
+        # and tried first once it is cached
+        assert cache.get_index('http://db/a.vcf.bgz', 10) == path
+        assert len(server.requests) == 2
+        with pytest.raises(TBIDownloadError):
+            cache.get_index('http://db/b.vcf.bgz', 10)
+
+    def test_remote_index_cache(self, tmp_path, monkeypatch):
+        server = MockIndexServer({'http://db/a.vcf.bgz.tbi': b'index-1',
+                                  'http://mirror/a.vcf.bgz.tbi': b'index-1'})
+        monkeypatch.setattr(urllib.request, "urlopen", server.urlopen)
+        cache = RemoteIndexCache(cache_dir=str(tmp_path), ttl=1)
+
+        path = cache.get('http://db/a.vcf.bgz.tbi', 10)
+        assert path.endswith(".tbi") and open(path, 'rb').read() == b'index-1'
+        # fresh entries are used without contacting the server
+        assert cache.get('http://db/a.vcf.bgz.tbi', 10) == path
+        assert len(server.requests) == 1
+        # urls serving the same file share one copy
+        assert cache.get('http://mirror/a.vcf.bgz.tbi', 10) == path
+        assert len(os.listdir(cache.blobs_dir)) == 1
+
+        # expired entries are revalidated
+        expired = RemoteIndexCache(cache_dir=str(tmp_path), ttl=1)
+        monkeypatch.setattr(remote_cache.time, "time", lambda: 1e12)
+        assert expired.get('http://db/a.vcf.bgz.tbi', 10) == path
+        assert server.requests[-1]['If-none-match'] == '"index-1"'
+        server.files['http://db/a.vcf.bgz.tbi'] = b'index-2'
+        monkeypatch.setattr(remote_cache.time, "time", lambda: 2e12)
+        new_path = expired.get('http://db/a.vcf.bgz.tbi', 10)
+        assert new_path != path and open(new_path, 'rb').read() == b'index-2'
+        # the old copy is still used by the mirror
+        assert os.path.exists(path)
+
+        # cached copies are used when the server is down
+        server.down = True
+        monkeypatch.setattr(remote_cache.time, "time", lambda: 3e12)
+        assert expired.get('http://db/a.vcf.bgz.tbi', 10) == new_path
+        with pytest.raises(TBIDownloadError):
+            expired.get('http://db/b.vcf.bgz.tbi', 10)
+        assert [name for name in os.listdir(cache.blobs_dir)
+                if name.endswith(".tmp")] == []
+
+    def test_region_cache(self, tmp_path):
+        index = tmp_path / "db.vcf.bgz.tbi"
+        index.write_bytes(b"index-1")
+        records = ["3\t100\t.\tA\tT\t.\tPASS\tAC=1",
+                   "3\t150\t.\tACGT\tA\t.\tPASS\tAC=2",
+                   "3\t300\t.\tG\tC\t.\tPASS\tAC=3"]
+        cache = RegionCache("http://db.vcf.bgz", str(index), cache_dir=str(tmp_path))
+        assert cache.get("3", 100, 300) is None
+        cache.put("3", 100, 300, records)
+        cache.put("3", 400, 500, [])
+        assert cache.get("3", 100, 300) == records
+        assert cache.get("3", 400, 500) == []
+        # smaller regions are served from a region containing them,
+        # with the records overlapping them (like Tabix)
+        assert cache.get("3", 152, 299) == records[1:2]
+        assert cache.get("3", 90, 300) is None
+        assert cache.get("X", 100, 300) is None
+        # a new index (database changed on the server) invalidates regions
+        index.write_bytes(b"index-2")
+        assert RegionCache("http://db.vcf.bgz", str(index),
+                           cache_dir=str(tmp_path)).get("3", 100, 300) is None
+
+        # least recently used regions are evicted once over the size
+        size = len(zlib.compress("\n".join(records).encode()))
+        small = RegionCache("http://db.vcf.bgz", str(index), max_size=2.5 * size / 2**20,
+                            cache_dir=str(tmp_path / "small"))
+        small.put("3", 100, 300, records)
+        small.put("4", 100, 300, records)
+        assert small.get("3", 100, 300) == records
+        small.put("5", 100, 300, records)
+        assert small.get("4", 100, 300) is None
+        assert small.get("3", 100, 300) == records
+        assert small.get("5", 100, 300) == records
+
+    def test_shared_region_cache(self):
+        records = ["3\t100\t.\tA\tT\t.\tPASS\tAC=1",
+                   "3\t150\t.\tACGT\tA\t.\tPASS\tAC=2",
+                   "3\t300\t.\tG\tC\t.\tPASS\tAC=3"]
+        fetches = []
+        class MockHandles:
+            def get(self):
+                return self
+            def fetch(self, reference):
+                fetches.append(reference)
+                if not reference.startswith("3:"):
+                    raise ValueError("could not create iterator for region")
+                return records
+        region, other = Region("3", 100, 300), Region("X", 100, 300)
+        cache = batch.SharedRegionCache((MockHandles(), None, None), [region, other])
+        # the whole batch region is fetched once for all its parts
+        assert cache.get("3", 100, 300) == records
+        assert cache.get("3", 152, 299) == records[1:2]
+        assert fetches == ["3:100-300"]
+        assert cache.get("3", 90, 300) is None
+        assert cache.get("4", 100, 300) is None
+        # missing contigs are left to the jobs
+        assert cache.get("X", 100, 300) is None
+        cache.evict(region)
+        assert cache.records == {}
+        assert cache.get("3", 100, 300) == records
+        assert len(fetches) == 3
+
+    def test_batch(self, tmp_path, monkeypatch, capsys, local_db, local_gene_index):
+        fetches = []
+        fetch_records = gnali.fetch_records
+        def mock_fetch_records(opened_file, region):
+            if not isinstance(opened_file[2], batch.SharedRegionCache):
+                fetches.append(str(region))
+            return fetch_records(opened_file, region)
+        monkeypatch.setattr(gnali, "fetch_records", mock_fetch_records)
+        caches = []
+        class MockSharedRegionCache(batch.SharedRegionCache):
+            def __init__(self, *args):
+                super().__init__(*args)
+                caches.append(self)
+        monkeypatch.setattr(batch, "SharedRegionCache", MockSharedRegionCache)
+
+        (tmp_path / "panel1.txt").write_text("CCR5\nCCR2\nNOTAGENE\n")
+        (tmp_path / "panel2.txt").write_text("CCR5\n")
+        (tmp_path / "panel3.txt").write_text("ALCAM\n")
+        jobs = [{'input_file': "panel1.txt", 'output_dir': "batch/panel1"},
+                {'input_file': "panel2.txt", 'output_dir': "batch/panel2",
+                 'predefined_filters': ["homozygous-controls"], 'pop_freqs': True,
+                 'vcf': True},
+                {'input_file': "panel3.txt", 'output_dir': "batch/panel3"}]
+        manifest = tmp_path / "manifest.yaml"
+        manifest.write_text(yaml.dump({'jobs': jobs}))
+        batch.main(["-m", str(manifest), "-c", DB_CONFIG_LOCAL, "-v"])
+        # regions shared by jobs are fetched once, and evicted after the
+        # last job using them
+        assert sorted(fetches) == sorted(set(fetches))
+        assert len(fetches) == 3
+        assert len(caches) == 1 and caches[0].records == {}
+
+        # jobs have the same output as separate gNALI runs
+        for job in jobs:
+            argv = ["gnali", "-i", str(tmp_path / job['input_file']), "-c", DB_CONFIG_LOCAL,
+                    "-o", str(tmp_path / "single" / job['output_dir']), "-v"]
+            if job.get('predefined_filters'):
+                argv += ["-p"] + job['predefined_filters']
+            if job.get('pop_freqs'):
+                argv.append("-P")
+            if job.get('vcf'):
+                argv.append("--vcf")
+            monkeypatch.setattr(sys, "argv", argv)
+            gnali.main()
+            batch_dir = tmp_path / job['output_dir']
+            single_dir = tmp_path / "single" / job['output_dir']
+            assert sorted(os.listdir(str(batch_dir))) == sorted(os.listdir(str(single_dir)))
+            for file_name in os.listdir(str(batch_dir)):
+                assert (batch_dir / file_name).read_bytes() == \
+                    (single_dir / file_name).read_bytes()
+        assert "Unknown gene" in (tmp_path / "batch/panel1" /
+                                  gnali.RESULTS_BASIC_FILE).read_text()
+
+        # jobs need distinct output directories
+        manifest.write_text(yaml.dump({'jobs': [jobs[0], jobs[0]]}))
+        with pytest.raises(InvalidConfigurationError):
+            batch.read_manifest(str(manifest))
+        manifest.write_text(yaml.dump({'jobs': [dict(jobs[0], filters=["AC>1"])]}))
+        with pytest.raises(InvalidConfigurationError):
+            batch.read_manifest(str(manifest))
+
+    def test_query_api(self, monkeypatch, local_db, local_gene_index):
+        gnali.load_gene_index(RuntimeConfig(gnali.get_db_config(DB_CONFIG_LOCAL, None)))
+        # no output directory, log or temporary files are written
+        mkdtemp = tempfile.mkdtemp
+        def no_temp_files(*args, **kwargs):
+            raise AssertionError("temporary file created")
+        monkeypatch.setattr(tempfile, "mkdtemp", no_temp_files)
+        monkeypatch.setattr(tempfile, "NamedTemporaryFile", no_temp_files)
+        files_before = sorted(os.listdir(str(GNALI_ROOT_PATH)))
+
+        results = gnali_package.query(["CCR5", "NOTAGENE"], config_file=DB_CONFIG_LOCAL,
+                                      predefined_filters=["homozygous-controls"],
+                                      pop_freqs=True)
+        assert sorted(os.listdir(str(GNALI_ROOT_PATH))) == files_before
+        assert list(results.basic['Status']) == ["HC LoF found", "Unknown gene"]
+
+        # same results as the command line's output
+        genes = [Gene("CCR5", location="3:46411633-46417697")]
+        db_config = RuntimeConfig(gnali.get_db_config(DB_CONFIG_LOCAL, None))
+        filters = gnali.transform_filters(db_config, ["homozygous-controls"], None)
+        monkeypatch.setattr(tempfile, "mkdtemp", mkdtemp)
+        header = gnali.get_variants(genes, db_config, filters, None, None, False)
+        expected, expected_vcf = gnali.extract_lof_annotations(genes, db_config, True)
+        assert results.detailed.equals(expected)
+        assert list(results.vcf_records) == expected_vcf
+        assert results.vcf_header == header
+
+        typed = api.query("CCR5", config_file=DB_CONFIG_LOCAL, typed=True)
+        assert typed.detailed['Position_Start'].dtype == 'int64'
+        no_variants = api.query(["ALCAM"], config_file=DB_CONFIG_LOCAL)
+        assert no_variants.detailed.empty and list(no_variants.vcf_records) == []
+        # empty results have the same columns and types as results with variants
+        assert list(no_variants.detailed.columns) == \
+            list(api.query("CCR5", config_file=DB_CONFIG_LOCAL).detailed.columns)
+        typed_none = api.query(["ALCAM"], config_file=DB_CONFIG_LOCAL, typed=True,
+                               pop_freqs=True)
+        typed = api.query("CCR5", config_file=DB_CONFIG_LOCAL, typed=True, pop_freqs=True)
+        assert typed_none.detailed.empty
+        assert typed_none.detailed.dtypes.to_dict() == typed.detailed.dtypes.to_dict()
+        with pytest.raises(InvalidConfigurationError):
+            api.query(["CCR5"], database="nope", config_file=DB_CONFIG_LOCAL)
+
+    def test_query_server(self, monkeypatch, local_db, local_gene_index):
+        opened = []
+        def mock_get_db_tbi(data_file, data_path, max_time):
+            opened.append(data_file.name)
+            return "{}.tbi".format(LOCAL_CCR5_DB)
+        monkeypatch.setattr(gnali, "get_db_tbi", mock_get_db_tbi)
+
+        service = server.QueryService(DB_CONFIG_LOCAL, workers=2)
+        query_server = server.QueryServer(("127.0.0.1", 0), service, 2)
+        thread = threading.Thread(target=query_server.serve_forever)
+        thread.start()
+        url = "http://127.0.0.1:{}".format(query_server.server_port)
+        def post(query):
+            request = urllib.request.Request("{}/query".format(url),
+                                             data=json.dumps(query).encode())
+            try:
+                with urllib.request.urlopen(request) as response:
+                    return response.status, json.loads(response.read())
+            except urllib.error.HTTPError as error:
+                return error.code, json.loads(error.read())
+        try:
+            with urllib.request.urlopen("{}/databases".format(url)) as response:
+                assert json.loads(response.read()) == {'databases': ["ccr5-local"],
+                                                       'default': "ccr5-local"}
+            status, results = post({'genes': ["CCR5", "NOTAGENE"]})
+            assert status == 200
+            assert results['basic'] == [{'HGNC_Symbol': "CCR5", 'Status': "HC LoF found"},
+                                        {'HGNC_Symbol': "NOTAGENE", 'Status': "Unknown gene"}]
+            assert len(results['detailed']) > 0
+            assert set(record['HGNC_Symbol'] for record in results['detailed']) == {"CCR5"}
+            # concurrent queries reuse the open database
+            queries = [{'genes': ["CCR5"], 'predefined_filters': ["homozygous-controls"],
+                        'pop_freqs': True}] * 4
+            answers = [None] * len(queries)
+            def run(index):
+                answers[index] = post(queries[index])
+            threads = [threading.Thread(target=run, args=(index,))
+                       for index in range(len(queries))]
+            for query_thread in threads:
+                query_thread.start()
+            for query_thread in threads:
+                query_thread.join()
+            assert all(answer == answers[0] for answer in answers)
+            assert answers[0][0] == 200
+            assert 0 < len(answers[0][1]['detailed']) < len(results['detailed'])
+            assert 'african-AC' in answers[0][1]['detailed'][0]
+            assert opened == ["exomes"]
+
+            assert post({'genes': ["CCR5"], 'database': "nope"})[0] == 400
+            assert post({'genes': ["CCR5"], 'predefined_filters': ["nope"]})[0] == 400
+            assert post({'genes': []})[0] == 400
+            status, results = post({'genes': ["ALCAM"]})
+            assert status == 200 and results['detailed'] == []
+        finally:
+            query_server.shutdown()
+            query_server.server_close()
+            thread.join()
+            service.close()
+
+    def test_query_service_open_database(self, tmp_path, monkeypatch, local_db,
+                                         local_gene_index):
+        config = yaml.load(open(DB_CONFIG_LOCAL, 'r').read(), Loader=yaml.FullLoader)
+        config['databases']['ccr5-slow'] = config['databases']['ccr5-local']
+        config_file = tmp_path / "db-config.yaml"
+        config_file.write_text(yaml.dump(config))
+        opening, release = threading.Event(), threading.Event()
+        open_db_files = gnali.open_db_files
+        def mock_open_db_files(db_config, *args):
+            if db_config.name == "ccr5-slow":
+                opening.set()
+                assert release.wait(10)
+            return open_db_files(db_config, *args)
+        monkeypatch.setattr(gnali, "open_db_files", mock_open_db_files)
+
+        service = api.QueryService(str(config_file))
+        try:
+            slow = threading.Thread(target=service.get_database, args=("ccr5-slow",))
+            slow.start()
+            assert opening.wait(10)
+            # other databases are queried while one is being opened
+            results = service.query(["CCR5"], "ccr5-local")
+            assert list(results.basic['Status']) == ["HC LoF found"]
+            assert slow.is_alive()
+            release.set()
+            slow.join()
+            assert service.get_database("ccr5-slow") is service.databases["ccr5-slow"]
+        finally:
+            release.set()
+            service.close()
+
+    def test_db_slice(self, tmp_path, local_db):
+        bed = tmp_path / "panel.bed"
+        # overlapping and adjacent regions, and a contig missing from the database
+        bed.write_text("3\t46411632\t46414000\tCCR5\n"
+                       "3\t46413000\t46417697\tCCR5-end\n"
+                       "Y\t0\t10\tNONE\n")
+        db_slice.main(['-b', str(bed), '-c', DB_CONFIG_LOCAL, '-o', str(tmp_path / "slice")])
+
+        slice_path = str(tmp_path / "slice" / "exomes.vcf.bgz")
+        assert os.path.isfile("{}.tbi".format(slice_path))
+        with pysam.TabixFile(LOCAL_CCR5_DB) as tbx:
+            expected = list(tbx.fetch("3", 46411632, 46417697))
+            expected_header = list(tbx.header)
+        with pysam.TabixFile(slice_path) as tbx:
+            assert list(tbx.fetch("3", 46411632, 46417697)) == expected
+            assert list(tbx.fetch()) == expected
+            assert list(tbx.header) == expected_header
+
+        # the generated configuration points at the slice
+        config = Config(None, yaml.load(open(str(tmp_path / "slice" / "db-config.yaml")).read(),
+                                        Loader=yaml.FullLoader))
+        config.validate_config()
+        assert config.name == "ccr5-local-slice"
+        assert config.files['exomes']['path'] == slice_path
+        assert config.population_frequencies == \
+            Config(None, yaml.load(open(DB_CONFIG_LOCAL).read(),
+                                   Loader=yaml.FullLoader)).population_frequencies
+
+    def test_local_file_cache(self, tmp_path, monkeypatch):
+        builds = []
+        tabix_index = pysam.tabix_index
+        def mock_tabix_index(*args, **kwargs):
+            builds.append(args[0])
+            return tabix_index(*args, **kwargs)
+        monkeypatch.setattr(pysam, "tabix_index", mock_tabix_index)
+        cache = LocalFileCache(str(tmp_path / "cache"))
+
+        # an up to date index next to the file is used in place
+        data_bgz = str(tmp_path / "db.vcf.bgz")
+        shutil.copyfile(LOCAL_CCR5_DB, data_bgz)
+        shutil.copyfile("{}.tbi".format(LOCAL_CCR5_DB), "{}.tbi".format(data_bgz))
+        assert cache.get_index(data_bgz, 10) == "{}.tbi".format(data_bgz)
+        # otherwise an index is built once in the cache
+        os.utime("{}.tbi".format(data_bgz), ns=(0, 0))
+        index = cache.get_index(data_bgz, 10)
+        assert index.startswith(str(tmp_path / "cache"))
+        assert cache.get_index(data_bgz, 10) == index
+        assert len(builds) == 1
+        with pysam.TabixFile(data_bgz, index=index) as tbx:
+            assert len(list(tbx.fetch("3", 46411632, 46417697))) > 0
+
+        # uncompressed files are compressed and indexed once,
+        # and again when they change
+        data_vcf = tmp_path / "db.vcf"
+        data_vcf.write_bytes(gzip.open(LOCAL_CCR5_DB, 'rb').read())
+        compressed, index = cache.get_compressed(str(data_vcf), 10)
+        assert cache.get_compressed(str(data_vcf), 10) == (compressed, index)
+        assert len(builds) == 2
+        with pysam.TabixFile(compressed, index=index) as tbx:
+            num_records = len(list(tbx.fetch("3", 46411632, 46417697)))
+        lines = data_vcf.read_text().splitlines(True)
+        data_vcf.write_text("".join(lines[:-1]))
+        compressed, index = cache.get_compressed(str(data_vcf), 10)
+        assert len(builds) == 3
+        with pysam.TabixFile(compressed, index=index) as tbx:
+            assert len(list(tbx.fetch("3", 46411632, 46417697))) == num_records - 1
+        # CSI indexes are built when a min shift is set
+        compressed, index = cache.get_compressed(str(data_vcf), 10, 14)
+        assert index.endswith(".csi") and len(builds) == 4
+        assert files.get_index_type(index) == 'csi'
+        os.utime("{}.tbi".format(data_bgz), ns=(0, 0))
+        index = cache.get_index(data_bgz, 10, 14)
+        assert index.endswith(".csi") and len(builds) == 5
+        with pysam.TabixFile(data_bgz, index=index) as tbx:
+            assert len(list(tbx.fetch("3", 46411632, 46417697))) > 0
+
+        # rebuilds go to a new version, the replaced one is kept for
+        # readers until it is older than the grace period
+        old_compressed = compressed
+        data_vcf.write_text("".join(lines[:-2]))
+        compressed, index = cache.get_compressed(str(data_vcf), 10, 14)
+        assert os.path.dirname(compressed) != os.path.dirname(old_compressed)
+        assert os.path.isfile(old_compressed)
+        monkeypatch.setattr(local_cache, "LOCAL_CACHE_GRACE_PERIOD", -1)
+        data_vcf.write_text("".join(lines[:-3]))
+        compressed, index = cache.get_compressed(str(data_vcf), 10, 14)
+        assert not os.path.exists(old_compressed)
+        version_dir = os.path.dirname(compressed)
+        assert sorted(os.listdir(os.path.dirname(version_dir))) \
+            == sorted(["entry.json", os.path.basename(version_dir)])
+
+    def test_build_index(self, tmp_path):
+        data_bgz = str(tmp_path / "db.vcf.bgz")
+        shutil.copyfile(LOCAL_CCR5_DB, data_bgz)
+        index = files.build_index(data_bgz)
+        assert index == "{}.tbi".format(data_bgz)
+        assert files.get_index_type(index) == 'tbi'
+        (tmp_path / "indexes").mkdir()
+        index = files.build_index(data_bgz, str(tmp_path / "indexes"), 14)
+        assert index == str(tmp_path / "indexes" / "db.vcf.bgz.csi")
+        assert files.get_index_type(index) == 'csi'
+        assert files.get_index_type(LOCAL_CCR5_DB) is None
+
+        # positions past 2^29 can't be stored in a TBI index
+        lines = gzip.open(LOCAL_CCR5_DB, 'rt').read().splitlines(True)
+        header = [line for line in lines if line.startswith("#")]
+        record = [line for line in lines if not line.startswith("#")][0].split("\t")
+        record[1] = "700000000"
+        large_vcf = str(tmp_path / "large.vcf")
+        with open(large_vcf, 'w') as stream:
+            stream.write("".join(header + ["\t".join(record)]))
+        large_bgz = "{}.bgz".format(large_vcf)
+        pysam.tabix_compress(large_vcf, large_bgz)
+        index = files.build_index(large_bgz)
+        assert index == "{}.csi".format(large_bgz)
+        assert not os.path.exists("{}.tbi".format(large_bgz))
+        with pysam.TabixFile(large_bgz, index=index) as tbx:
+            assert len(list(tbx.fetch("3", 699999999, 700000001))) == 1
+
+    def test_environment_probes(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(environment, "ENVIRONMENT_CACHE_PATH", str(tmp_path / "cache"))
+        monkeypatch.setattr(environment, "probe_results", {})
+        vep_path = tmp_path / "bin" / "vep"
+        vep_path.parent.mkdir()
+        vep_path.write_text("#!/usr/bin/env perl\n")
+        vep_path.chmod(0o755)
+        monkeypatch.setenv("PATH", "{}{}{}".format(vep_path.parent, os.pathsep,
+                                                   os.environ.get("PATH", "")))
+        probes = []
+        class MockCompletedProcess:
+            stdout = b"#----------#\n ensembl-vep : 104.3\n"
+        def mock_run(command, *args, **kwargs):
+            probes.append(command)
+            return MockCompletedProcess()
+        monkeypatch.setattr(cache.subprocess, "run", mock_run)
+
+        # VEP is run once, later processes use the cached version
+        assert environment.get_vep_version() == 104
+        assert environment.get_vep_version() == 104
+        monkeypatch.setattr(environment, "probe_results", {})
+        assert environment.get_vep_version() == 104
+        assert probes == [["vep", "--help"]]
+
+        # and run again when the executable changes
+        os.utime(vep_path, ns=(0, 0))
+        monkeypatch.setattr(environment, "probe_results", {})
+        assert environment.get_vep_version() == 104
+        assert len(probes) == 2
+
+        # reference files are verified once per process
+        verified = []
+        monkeypatch.setattr(gnali_get_data, "verify_files_present",
+                            lambda *args: verified.append(args))
+        for _ in range(2):
+            environment.verify_files_present('GRCh37', str(tmp_path / "vep"))
+        assert verified == [('GRCh37', str(tmp_path / "vep"), 104)]
+        # and by later processes only once they change
+        monkeypatch.setattr(environment, "probe_results", {})
+        environment.verify_files_present('GRCh37', str(tmp_path / "vep"))
+        assert len(verified) == 1
+        (tmp_path / "vep").mkdir()
+        (tmp_path / "vep" / "cache_index_grch37.txt").write_text("index\n")
+        monkeypatch.setattr(environment, "probe_results", {})
+        environment.verify_files_present('GRCh37', str(tmp_path / "vep"))
+        assert len(verified) == 2
+
+        # so is the LOFTEE checkout
+        loftee_path = tmp_path / "loftee"
+        (loftee_path / ".git").mkdir(parents=True)
+        (loftee_path / ".git" / "HEAD").write_text("a1b2c3\n")
+        monkeypatch.setattr(vep, "get_loftee_path", lambda assembly: str(loftee_path))
+        loftee_reads = []
+        get_loftee_version = vep.get_loftee_version
+        def mock_get_loftee_version(assembly):
+            loftee_reads.append(assembly)
+            return get_loftee_version(assembly)
+        monkeypatch.setattr(vep, "get_loftee_version", mock_get_loftee_version)
+        for _ in range(2):
+            monkeypatch.setattr(environment, "probe_results", {})
+            assert environment.get_loftee_version('GRCh37') == "a1b2c3"
+        assert loftee_reads == ['GRCh37']
+        (loftee_path / ".git" / "HEAD.new").write_text("d4e5f6\n")
+        os.replace(str(loftee_path / ".git" / "HEAD.new"), str(loftee_path / ".git" / "HEAD"))
+        monkeypatch.setattr(environment, "probe_results", {})
+        assert environment.get_loftee_version('GRCh37') == "d4e5f6"
+        assert len(loftee_reads) == 2
+        # probes are kept in the executable's entry
+        entry = environment.EnvironmentCache().read()[str(vep_path)]
+        assert entry['vep_version'] == 104
+        assert list(entry['files']) == ["GRCh37:{}".format(tmp_path / "vep")]
+        assert entry['loftee']['GRCh37']['version'] == "d4e5f6"
+
+        # a database without LoF annotations doesn't run VEP once warm
+        monkeypatch.setattr(environment, "probe_results", {})
+        config = RuntimeConfig(gnali.get_db_config(DB_CONFIG_FILE, 'gnomadv2.1.1nolof'))
+        assert config.vep_version == 104
+        assert len(probes) == 2
+
+    def test_add_annotation(self):
+        assert add_annotation("3\t100\t.\tA\tT\t.\tPASS\tAC=1\n", 'CSQ', 'T|HC') == \
+            "3\t100\t.\tA\tT\t.\tPASS\tAC=1;CSQ=T|HC"
+        assert add_annotation("3\t100\t.\tA\tT\t.\tPASS\t.", 'CSQ', 'T|HC') == \
+            "3\t100\t.\tA\tT\t.\tPASS\tCSQ=T|HC"
+
+
+    def test_filter_parse(self):
+        assert str(Filter("AC", "AC>=3")) == "attribute = AC, operator = >=, value = 3"
+        assert str(Filter("AC", "AC<=3")) == "attribute = AC, operator = <=, value = 3"
+        assert str(Filter("AC", "AC = 3")) == "attribute = AC, operator = =, value = 3"
+        for expression in ["AC", ">3", "AC>3>4"]:
+            with pytest.raises(ValueError):
+                Filter(expression, expression)
+
+    def test_filter_typed_comparisons(self):
+        header = ['##INFO=<ID=AC,Number=A,Type=Integer,Description="Count">',
+                  '##INFO=<ID=AF,Number=A,Type=Float,Description="Frequency">',
+                  '##INFO=<ID=segdup,Number=0,Type=Flag,Description="Duplication">',
+                  '##INFO=<ID=lcr,Number=0,Type=Flag,Description="Low complexity">',
+                  '##INFO=<ID=name,Number=1,Type=String,Description="Name, with commas">']
+        info_types = parse_info_types(header)
+        assert info_types['segdup'] == ('0', 'Flag')
+        record = MockVariant("GENE", "3\t100\t.\tA\tT\t.\tPASS\t"
+                             "AC=10;AF=0.5;segdup;name=b,c;nhomalt=2,0")
+        cases = [("AC>3", True), ("AC=10", True), ("AC!=10", False), ("AC>=11", False),
+                 ("AF<0.75", True), ("AF>=1e-1", True), ("segdup=1", True),
+                 ("segdup=false", False), ("lcr=0", True), ("name=b,c", True),
+                 ("name>a", True), ("nhomalt>1", True), ("nhomalt>2", False),
+                 ("AN>0", False), ("AN!=0", False)]
+        for expression, expected in cases:
+            filter_obj = Filter(expression, expression)
+            filter_obj.compile(info_types)
+            assert filter_obj.apply(record) == expected, expression
+        # without a header, types are inferred from the filter value
+        assert Filter("AC", "AC>3").apply(record)
+        assert not Filter("name", "name>3").apply(MockVariant(
+            "GENE", "3\t100\t.\tA\tT\t.\tPASS\tname=abc"))
+        with pytest.raises(InvalidFilterError):
+            Filter("segdup", "segdup>abc").compile(info_types)
+        with pytest.raises(InvalidFilterError):
+            Filter("AC", "AC>abc").compile(info_types)
+
+
+    def test_info_fields(self):
+        record = "3\t100\t.\tA\tT\t.\tPASS\tcontrols_AC=4;AC=1;segdup;AF=0.5\n"
+        info = InfoFields(record, record.index("controls_AC"))
+        assert info.get("AC") == "1"
+        assert info["controls_AC"] == "4"
+        assert info.get("AF") == "0.5\n"
+        assert "segdup" not in info and "AN" not in info
+        assert info.get("AN", "missing") == "missing"
+        with pytest.raises(KeyError):
+            info["AN"]
+        assert dict(info.items()) == {"controls_AC": "4", "AC": "1", "AF": "0.5\n"}
+
+
+class MockConfig:
+    lof = {'id': 'CSQ', 'annot': 'LoF', 'filters': {'confidence': 'HC'}}
+
 class MockVariant:
     def __init__(self, gene, record):
         self.gene_name = gene
@@ -139,3 +835,7 @@ class MockVariant:
     def set_transcripts(self, transcripts):
         self.transcripts = transcripts
 
+    def flags(self):
+        return set(info_item for info_item in self.info_str.split(";")
+                   if "=" not in info_item)
+